@@ -1,156 +1,343 @@
+import argparse
+import hashlib
+import itertools
 import json
 import os
 import glob
 from collections import defaultdict
-from typing import Dict, List, Any, Set, Tuple
+from typing import Dict, List, Any, BinaryIO, Iterable, Iterator, Optional, Set, Tuple
 
+import instrumentation
+from forest import Flat, build_forest, flatten_forest, merge_flat
+from json_stream import format_json_entry, iter_json_object
+from ndjson_paths import (
+    COMPRESSIONS,
+    NdjsonEncoder,
+    compress_lines,
+    is_ndjson,
+    iter_block_lines,
+    iter_ndjson_calls,
+    run_paths_files,
+    source_of,
+)
+from path_store import CallRecord, Step, iter_call_path_items
 
-def _flatten_tree(tree: List[Dict[str, Any]]) -> Tuple[Dict[int, Dict[str, Any]], Dict[int, int], Dict[int, Set[int]]]:
+
+MANIFEST_NAME = "aggregate_manifest.json"
+MANIFEST_VERSION = 1
+_COPY_CHUNK = 1 << 20
+
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_COPY_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _check_file(path: str, prev: Optional[Dict[str, Any]]) -> Tuple[bool, Dict[str, Any]]:
     """
-    Flatten a tree (or forest) into:
-      - nodes_by_id: rule_id -> {rule_id, text, url}
-      - parent_of: rule_id -> parent_id (0 for roots)
-      - children_map: parent_id -> set(child_ids)
+    Return (unchanged, state) for a per-run file against its previous manifest record.
+    Size+mtime match short-circuits hashing; otherwise the content hash decides.
     """
-    nodes_by_id: Dict[int, Dict[str, Any]] = {}
-    parent_of: Dict[int, int] = {}
-    children_map: Dict[int, Set[int]] = defaultdict(set)
-
-    def walk(node: Dict[str, Any], parent_id: int) -> None:
-        rid = int(node["rule_id"])
-        text = node.get("text") or ""
-        url = node.get("url")
-        if rid not in nodes_by_id:
-            nodes_by_id[rid] = {"rule_id": rid, "text": text, "url": url}
-            parent_of[rid] = parent_id
-        # Prefer first-seen data; if seen again, keep existing
-        children = node.get("children") or []
-        if parent_id is not None:
-            children_map[parent_id].add(rid)
-        for child in children:
-            walk(child, rid)
-
-    # Roots have parent_id = 0
-    for root in tree:
-        walk(root, 0)
-
-    return nodes_by_id, parent_of, children_map
-
-
-def _build_tree(nodes_by_id: Dict[int, Dict[str, Any]], parent_of: Dict[int, int], children_map: Dict[int, Set[int]]) -> List[Dict[str, Any]]:
-    roots = [rid for rid, pid in parent_of.items() if pid == 0]
-
-    def expand(rid: int) -> Dict[str, Any]:
-        node = nodes_by_id[rid]
-        children = []
-        # sort by text then id
-        for child_id in sorted(children_map.get(rid, []), key=lambda x: (nodes_by_id[x]["text"], x)):
-            children.append(expand(child_id))
-        return {"rule_id": rid, "text": node["text"], "url": node.get("url"), "children": children}
-
-    # Deterministic ordering
-    roots_sorted = sorted(roots, key=lambda x: (nodes_by_id[x]["text"], x))
-    return [expand(r) for r in roots_sorted]
-
-
-def aggregate_runs(source_dir: str = "json", output_dir: str = ".") -> None:
+    st = os.stat(path)
+    state = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if prev and prev.get("size") == st.st_size and prev.get("mtime_ns") == st.st_mtime_ns:
+        state["sha256"] = prev.get("sha256")
+        return True, state
+    state["sha256"] = _file_sha256(path)
+    return bool(prev) and prev.get("sha256") == state["sha256"], state
+
+
+def _load_manifest(path: str) -> Dict[str, Any]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") == MANIFEST_VERSION:
+            return manifest
+    except Exception:
+        pass
+    return {"version": MANIFEST_VERSION, "trees": {}, "paths": {}, "paths_out": None}
+
+
+def _tree_contribution(tree_path: str) -> Dict[str, Any]:
+    """Flattened nodes and child links of one per-run tree, as stored in the manifest."""
+    try:
+        with open(tree_path, "r", encoding="utf-8") as f:
+            tree = json.load(f)
+        nodes_by_id, parent_of, children_map = flatten_forest(tree)
+    except Exception:
+        # Malformed: contributes nothing until it changes
+        return {"nodes": [], "children": []}
+    return {
+        "nodes": [[rid, n.get("text") or "", n.get("url"), parent_of.get(rid, 0)] for rid, n in nodes_by_id.items()],
+        "children": [[pid, sorted(ch)] for pid, ch in children_map.items()],
+    }
+
+
+def _merge_tree_contributions(contributions: List[Dict[str, Any]]) -> Tuple[Dict[int, Dict[str, Any]], Dict[int, int], Dict[int, Set[int]]]:
+    merged: Flat = ({}, {}, defaultdict(set))
+    for contrib in contributions:
+        merge_flat(merged, contrib["nodes"], contrib["children"])
+    return merged
+
+
+def _iter_source_calls(paths_file: str) -> Iterator[Tuple[CallRecord, List[Step]]]:
+    """Stream one per-run call paths file (JSON or NDJSON) record by record, stamped with its source."""
+    source = source_of(os.path.basename(paths_file))
+    if is_ndjson(paths_file):
+        for rec, steps in iter_ndjson_calls(paths_file):
+            rec.source = source
+            yield rec, steps
+        return
+    with open(paths_file, "r", encoding="utf-8") as f:
+        # Supports both legacy (list path) and enriched (object with metadata) entries
+        yield from iter_call_path_items(iter_json_object(f), source=source)
+
+
+def _guarded(calls: Iterator[Tuple[CallRecord, List[Step]]]) -> Iterator[Tuple[CallRecord, List[Step]]]:
+    # Malformed input ends the source early; entries decoded so far are kept
+    try:
+        yield from calls
+    except Exception:
+        return
+
+
+class _JsonPathsLayout:
+    """call_paths.all.json: one indent=2 JSON object; source spans are joined by ',\n'."""
+
+    name = "call_paths.all.json"
+    prefix = b"{\n"
+    sep = b",\n"
+    suffix = b"\n}"
+    empty = b"{}"
+
+    def source_chunks(self, calls: Iterable[Tuple[CallRecord, List[Step]]], source: str) -> Iterator[bytes]:
+        for i, (rec, steps) in enumerate(calls):
+            entry = {
+                "source": rec.source,
+                "call_id": rec.call_id,
+                "call_date": rec.call_date,
+                "weekday": rec.weekday,
+                "path": [{"rule_id": rid, "text": text, "url": url} for rid, text, url in steps],
+            }
+            yield (b",\n" if i else b"") + format_json_entry(rec.key, entry).encode("utf-8")
+
+
+class _NdjsonPathsLayout:
+    """call_paths.all.ndjson[.gz|.xz]: header member, then one self-contained block (member) per source."""
+
+    sep = b""
+    suffix = b""
+
+    def __init__(self, compression: str) -> None:
+        self.compression = compression
+        self.name = "call_paths.all.ndjson" + COMPRESSIONS[compression]
+        self.prefix = b"".join(compress_lines([NdjsonEncoder.header()], compression))
+        self.empty = self.prefix
+
+    def source_chunks(self, calls: Iterable[Tuple[CallRecord, List[Step]]], source: str) -> Iterator[bytes]:
+        return compress_lines(iter_block_lines(calls, source), self.compression)
+
+
+def _copy_range(src: BinaryIO, dst: BinaryIO, start: int, length: int) -> None:
+    src.seek(start)
+    while length > 0:
+        chunk = src.read(min(_COPY_CHUNK, length))
+        if not chunk:
+            raise IOError("aggregate output shorter than manifest span")
+        dst.write(chunk)
+        length -= len(chunk)
+
+
+@instrumentation.timed("aggregate")
+def aggregate_runs(
+    source_dir: str = "json",
+    output_dir: str = ".",
+    incremental: bool = True,
+    fmt: str = "json",
+    compression: str = "none",
+) -> Dict[str, Any]:
     """
-    Aggregate all per-run button_tree and call_paths JSONs found in source_dir into:
+    Aggregate all per-run button_tree and call_paths files (JSON or NDJSON) found in source_dir into:
       - <output_dir>/button_tree.all.json (merged forest)
-      - <output_dir>/call_paths.all.json (merged call paths; keys composed as <source>::<call_id>)
+      - <output_dir>/call_paths.all.json (merged call paths; keys composed as <source>::<call_id>),
+        or call_paths.all.ndjson[.gz|.xz] with fmt="ndjson"
+
+    <output_dir>/aggregate_manifest.json records each per-run file's content hash and its
+    contribution (flattened nodes for trees, byte span in call_paths.all.json for paths).
+    Later runs only re-parse new or changed files: unchanged sources are copied as raw byte
+    ranges (or left in place when all changes are at the end), deleted files are dropped.
+    Pass incremental=False to rebuild from scratch.
+
+    Returns a summary with the output paths, node/call counts, and the merged forest under
+    "tree" when it was rebuilt in this call (None when button_tree.all.json was up to date).
     """
-    # Aggregate trees
-    tree_paths = glob.glob(os.path.join(source_dir, "*.button_tree.json"))
-    agg_nodes: Dict[int, Dict[str, Any]] = {}
-    agg_parent_of: Dict[int, int] = {}
-    agg_children_map: Dict[int, Set[int]] = defaultdict(set)
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    old = _load_manifest(manifest_path) if incremental else _load_manifest("")
+    new: Dict[str, Any] = {"version": MANIFEST_VERSION, "trees": {}, "paths": {}, "paths_out": None}
 
-    for tp in tree_paths:
-        try:
-            with open(tp, "r", encoding="utf-8") as f:
-                tree = json.load(f)
-            nodes_by_id, parent_of, children_map = _flatten_tree(tree)
-            # Merge nodes
-            for rid, node in nodes_by_id.items():
-                if rid not in agg_nodes:
-                    agg_nodes[rid] = {"rule_id": rid, "text": node.get("text") or "", "url": node.get("url")}
-                    agg_parent_of[rid] = parent_of.get(rid, 0)
-                else:
-                    # Keep first seen parent; fill missing text/url if any
-                    if not agg_nodes[rid].get("text") and node.get("text"):
-                        agg_nodes[rid]["text"] = node["text"]
-                    if agg_nodes[rid].get("url") is None and node.get("url") is not None:
-                        agg_nodes[rid]["url"] = node["url"]
-                # Merge children links
-            for pid, child_set in children_map.items():
-                agg_children_map[pid].update(child_set)
-        except Exception:
-            # Skip malformed
+    # Aggregate trees (sorted so first-seen merging and output order are deterministic)
+    tree_paths = sorted(glob.glob(os.path.join(source_dir, "*.button_tree.json")))
+    # A missing/ignored manifest (no recorded output) means nothing on disk can be trusted
+    trees_changed = old.get("paths_out") is None or set(old["trees"]) != {os.path.basename(tp) for tp in tree_paths}
+    tree_out = os.path.join(output_dir, "button_tree.all.json")
+    aggregated_tree: Optional[List[Dict[str, Any]]] = None
+    with instrumentation.stage("aggregate.trees", files=len(tree_paths)) as st:
+        for tp in tree_paths:
+            name = os.path.basename(tp)
+            prev = old["trees"].get(name)
+            unchanged, state = _check_file(tp, prev)
+            if unchanged:
+                state["contribution"] = prev["contribution"]
+            else:
+                state["contribution"] = _tree_contribution(tp)
+                trees_changed = True
+            new["trees"][name] = state
+
+        agg_nodes, agg_parent_of, agg_children_map = _merge_tree_contributions([new["trees"][n]["contribution"] for n in sorted(new["trees"])])
+        if trees_changed or not os.path.exists(tree_out):
+            roots = [rid for rid, pid in agg_parent_of.items() if pid == 0]
+            aggregated_tree = build_forest(agg_nodes, agg_children_map, roots) if agg_nodes else []
+            with open(tree_out, "w", encoding="utf-8") as f:
+                json.dump(aggregated_tree, f, ensure_ascii=False, indent=2)
+            st.wrote_file(tree_out)
+        st.info["rebuilt"] = trees_changed
+
+    # Aggregate call paths: classify each source, then reuse old byte spans where possible
+    layout: Any = _NdjsonPathsLayout(compression) if fmt == "ndjson" else _JsonPathsLayout()
+    paths_out = os.path.join(output_dir, layout.name)
+    paths_paths = run_paths_files(source_dir)  # one per source
+    old_out = old.get("paths_out")
+    output_valid = False
+    if old_out and old_out.get("name") == layout.name and os.path.exists(paths_out):
+        st = os.stat(paths_out)
+        output_valid = st.st_size == old_out.get("size") and st.st_mtime_ns == old_out.get("mtime_ns")
+
+    status: Dict[str, str] = {}  # name -> unchanged | changed | deleted
+    for name in sorted(set(paths_paths) | set(old["paths"])):
+        if name not in paths_paths:
+            status[name] = "deleted"
             continue
+        prev = old["paths"].get(name) if output_valid else None
+        unchanged, state = _check_file(paths_paths[name], prev)
+        status[name] = "unchanged" if unchanged else "changed"
+        new["paths"][name] = state
+        if unchanged:
+            state["calls"] = prev["calls"]
+            state["span"] = prev["span"]
 
-    aggregated_tree = _build_tree(agg_nodes, agg_parent_of, agg_children_map) if agg_nodes else []
+    order = list(status)
+    dirty = [i for i, name in enumerate(order) if status[name] != "unchanged"]
+    first_dirty = dirty[0] if dirty else len(order)
+    kept_spans = [old["paths"][n]["span"] for n in order[:first_dirty] if old["paths"][n]["span"][1] > old["paths"][n]["span"][0]]
+    # Changes only at the tail: truncate after the last kept entry and append in place
+    in_place = (
+        output_valid
+        and bool(kept_spans)
+        and all(status[n] != "unchanged" for n in order[first_dirty:])
+    )
 
-    # Aggregate call paths
-    paths_paths = glob.glob(os.path.join(source_dir, "*.call_paths.json"))
-    aggregated_paths: Dict[str, Any] = {}
-    for pp in paths_paths:
+    if dirty or not output_valid:
+        tmp_out = paths_out + ".tmp"
+        if in_place:
+            out = open(paths_out, "r+b")
+            out.seek(kept_spans[-1][1])
+            out.truncate()
+            start_index, wrote_any = first_dirty, True
+        else:
+            out = open(tmp_out, "wb")
+            out.write(layout.prefix)
+            start_index, wrote_any = 0, False
+        old_file = open(paths_out, "rb") if output_valid and not in_place else None
         try:
-            stem = os.path.basename(pp)
-            if stem.endswith(".call_paths.json"):
-                source = stem[: -len(".call_paths.json")]
-            else:
-                source = stem
-            with open(pp, "r", encoding="utf-8") as f:
-                paths = json.load(f)
-            if isinstance(paths, dict):
-                for call_id, entry in paths.items():
-                    key = f"{source}::{call_id}"
-                    # Support both legacy (list path) and enriched (object with metadata)
-                    if isinstance(entry, list):
-                        aggregated_paths[key] = {
-                            "source": source,
-                            "call_id": call_id,
-                            "call_date": None,
-                            "weekday": None,
-                            "path": entry,
-                        }
-                    elif isinstance(entry, dict):
-                        path_list = entry.get("path")
-                        if isinstance(path_list, list):
-                            aggregated_paths[key] = {
-                                "source": source,
-                                "call_id": entry.get("call_id", call_id),
-                                "call_date": entry.get("call_date"),
-                                "weekday": entry.get("weekday"),
-                                "path": path_list,
-                            }
-                        else:
-                            # Unexpected shape: try to coerce
-                            aggregated_paths[key] = {
-                                "source": source,
-                                "call_id": entry.get("call_id", call_id),
-                                "call_date": entry.get("call_date"),
-                                "weekday": entry.get("weekday"),
-                                "path": entry,  # as-is
-                            }
-        except Exception:
-            continue
+            for name in order[start_index:]:
+                if status[name] == "deleted":
+                    continue
+                state = new["paths"][name]
+                if status[name] == "unchanged":
+                    s0, s1 = state["span"]
+                    if s1 > s0:
+                        if wrote_any:
+                            out.write(layout.sep)
+                        start = out.tell()
+                        _copy_range(old_file, out, s0, s1 - s0)
+                        state["span"] = [start, out.tell()]
+                        wrote_any = True
+                    else:
+                        state["span"] = [out.tell(), out.tell()]
+                    continue
+                # Entries are decoded and re-encoded one at a time; no source is held in memory
+                calls = _guarded(_iter_source_calls(paths_paths[name]))
+                first = next(calls, None)
+                if first is None:
+                    state["calls"] = 0
+                    state["span"] = [out.tell(), out.tell()]
+                    continue
+                counted = [0]
 
-    # Write outputs
-    tree_out = os.path.join(output_dir, "button_tree.all.json")
-    with open(tree_out, "w", encoding="utf-8") as f:
-        json.dump(aggregated_tree, f, ensure_ascii=False, indent=2)
+                def counting(it: Iterator[Tuple[CallRecord, List[Step]]]) -> Iterator[Tuple[CallRecord, List[Step]]]:
+                    for item in it:
+                        counted[0] += 1
+                        yield item
+
+                if wrote_any:
+                    out.write(layout.sep)
+                start = out.tell()
+                for chunk in layout.source_chunks(counting(itertools.chain([first], calls)), source_of(name)):
+                    out.write(chunk)
+                state["calls"] = counted[0]
+                state["span"] = [start, out.tell()]
+                wrote_any = True
+            if wrote_any:
+                out.write(layout.suffix)
+            else:
+                out.seek(0)
+                out.truncate()
+                out.write(layout.empty)
+        finally:
+            out.close()
+            if old_file is not None:
+                old_file.close()
+        if not in_place:
+            os.replace(tmp_out, paths_out)
 
-    paths_out = os.path.join(output_dir, "call_paths.all.json")
-    with open(paths_out, "w", encoding="utf-8") as f:
-        json.dump(aggregated_paths, f, ensure_ascii=False, indent=2)
+    st = os.stat(paths_out)
+    new["paths_out"] = {"name": layout.name, "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(new, f, ensure_ascii=False)
 
+    calls = sum(state["calls"] for state in new["paths"].values())
+    changed = sum(1 for v in status.values() if v == "changed")
+    removed = sum(1 for v in status.values() if v == "deleted")
+    rec = instrumentation.current()
+    rec.calls = calls
+    rec.info.update({"path_files": len(paths_paths), "reparsed": changed, "removed": removed, "format": fmt})
     print(f"Aggregated {len(tree_paths)} tree files -> {tree_out} (nodes: {len(agg_nodes)})")
-    print(f"Aggregated {len(paths_paths)} path files -> {paths_out} (calls: {len(aggregated_paths)})")
+    print(f"Aggregated {len(paths_paths)} path files -> {paths_out} (calls: {calls}; re-parsed: {changed}, removed: {removed})")
+    return {
+        "tree_out": tree_out,
+        "paths_out": paths_out,
+        "nodes": len(agg_nodes),
+        "calls": calls,
+        "reparsed": changed,
+        "removed": removed,
+        "tree": aggregated_tree,
+    }
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge per-run JSON outputs in ./json into the .all.json aggregates")
+    parser.add_argument("--full", action="store_true", help="Ignore the manifest and rebuild everything")
+    parser.add_argument("--format", choices=("json", "ndjson"), default="json", help="Aggregate call path format")
+    parser.add_argument("--compress", choices=tuple(COMPRESSIONS), default="none", help="Compression for --format ndjson")
+    args = parser.parse_args()
     here = os.path.dirname(os.path.abspath(__file__))
-    aggregate_runs(source_dir=os.path.join(here, "json"), output_dir=here)
-
-
+    aggregate_runs(
+        source_dir=os.path.join(here, "json"),
+        output_dir=here,
+        incremental=not args.full,
+        fmt=args.format,
+        compression=args.compress,
+    )
@@ -0,0 +1,117 @@
+"""
+Sharded analytics outputs for partial loading (`analyze_calls.py --shards N`).
+
+Whole-tree maps keyed by rule_id (node funnel, entropy, coverage, branch distribution,
+subtree rollups, completion) are split into chunks of at most N keys under <analytics>/shards/<metric>/.
+Each shard is a complete JSON object with one entry per line, so it can be fetched and parsed
+on its own; shards/index.json maps every key to [shard number, byte offset, byte length] of its
+value inside that shard, so a single entry can also be read with one ranged request:
+
+  {"version": 1, "shard_size": N, "metrics": {
+     "node_funnel": {"shards": [{"file": "node_funnel/00000.json", "first": "1", "last": "6801",
+                                 "count": N, "bytes": 12345}, ...],
+                     "keys": {"1": [0, 7, 52], ...}}}}
+
+Keys are ordered numerically when they are all integers (rule_ids), as strings otherwise,
+so any keyed map (per node or per source) shards the same way.
+"""
+import json
+import os
+import shutil
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+DEFAULT_SHARD_SIZE = 512
+SHARDS_DIR = "shards"
+INDEX_FILE = "index.json"
+
+# Metric -> per-key map that is sharded (all keyed by rule_id)
+SHARDED_METRICS = (
+    "branch_distribution",
+    "coverage_ratio",
+    "entropy_complexity",
+    "node_funnel",
+    "subtree_rollups",
+    "completion",
+)
+
+
+def _ordered_keys(data: Mapping[Any, Any]) -> List[str]:
+    keys = [str(k) for k in data]
+    if all(k.lstrip("-").isdigit() for k in keys):
+        return sorted(keys, key=int)
+    return sorted(keys)
+
+
+def _encode(value: Any) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def write_shard(path: str, data: Mapping[Any, Any]) -> Tuple[Dict[str, Any], Dict[str, List[int]]]:
+    """Write one shard file; returns its index entry and key -> [offset, length] of each value."""
+    values = {str(k): v for k, v in data.items()}
+    keys = _ordered_keys(values)
+    offsets: Dict[str, List[int]] = {}
+    with open(path, "wb") as f:
+        pos = f.write(b"{\n")
+        for n, key in enumerate(keys):
+            prefix = _encode(key) + b":"
+            body = _encode(values[key])
+            pos += f.write(prefix)
+            offsets[key] = [pos, len(body)]
+            pos += f.write(body)
+            pos += f.write(b",\n" if n < len(keys) - 1 else b"\n")
+        pos += f.write(b"}\n")
+    entry = {"first": keys[0] if keys else None, "last": keys[-1] if keys else None, "count": len(keys), "bytes": pos}
+    return entry, offsets
+
+
+def write_metric_shards(out_dir: str, metric: str, data: Mapping[Any, Any], shard_size: int) -> Dict[str, Any]:
+    """Shard one keyed map under out_dir/<metric>/; returns its section of the index."""
+    metric_dir = os.path.join(out_dir, metric)
+    os.makedirs(metric_dir, exist_ok=True)
+    by_key = {str(k): v for k, v in data.items()}
+    keys = _ordered_keys(by_key)
+    section: Dict[str, Any] = {"shards": [], "keys": {}}
+    for shard_no, lo in enumerate(range(0, len(keys), shard_size)):
+        rel = f"{metric}/{shard_no:05d}.json"
+        chunk = {k: by_key[k] for k in keys[lo : lo + shard_size]}
+        entry, offsets = write_shard(os.path.join(out_dir, rel), chunk)
+        section["shards"].append({"file": rel, **entry})
+        for key, (offset, length) in offsets.items():
+            section["keys"][key] = [shard_no, offset, length]
+    return section
+
+
+def write_sharded_analytics(analytics_dir: str, outputs: Mapping[str, Any], shard_size: int = DEFAULT_SHARD_SIZE) -> List[str]:
+    """Replace <analytics_dir>/shards/ with shards of every SHARDED_METRICS output; returns the files written."""
+    if shard_size <= 0:
+        raise ValueError("shard size must be positive")
+    out_dir = os.path.join(analytics_dir, SHARDS_DIR)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+    index: Dict[str, Any] = {"version": 1, "shard_size": shard_size, "metrics": {}}
+    written: List[str] = []
+    for metric in SHARDED_METRICS:
+        if metric not in outputs:
+            continue
+        section = write_metric_shards(out_dir, metric, outputs[metric], shard_size)
+        index["metrics"][metric] = section
+        written.extend(os.path.join(out_dir, s["file"]) for s in section["shards"])
+    index_path = os.path.join(out_dir, INDEX_FILE)
+    with open(index_path, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, separators=(",", ":"))
+    written.append(index_path)
+    return written
+
+
+def read_entry(analytics_dir: str, metric: str, key: Any, index: Optional[Mapping[str, Any]] = None) -> Any:
+    """One entry of a sharded metric, read by byte range (KeyError if absent)."""
+    out_dir = os.path.join(analytics_dir, SHARDS_DIR)
+    if index is None:
+        with open(os.path.join(out_dir, INDEX_FILE), "r", encoding="utf-8") as f:
+            index = json.load(f)
+    section = index["metrics"][metric]
+    shard_no, offset, length = section["keys"][str(key)]
+    with open(os.path.join(out_dir, section["shards"][shard_no]["file"]), "rb") as f:
+        f.seek(offset)
+        return json.loads(f.read(length).decode("utf-8"))
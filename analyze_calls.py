@@ -1,178 +1,50 @@
+import argparse
+import datetime as dt
 import json
 import os
 import math
+import shutil
 from collections import defaultdict, Counter
 from typing import Dict, List, Any, Tuple, Optional
 
-
-def load_json(path: str) -> Any:
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+import analytics_shards
+import edge_arrays
+import instrumentation
+from forest import flatten_forest
+from markov_model import MarkovModel, tree_leaves
+from metric_partials import (
+    PARTIALS_SUFFIX,
+    PARTITION_INDEX,
+    PARTITIONS_DIR,
+    UNDATED,
+    MetricsAccumulator,
+    load_json,
+    node_funnel_from_totals,
+)
+from near_duplicates import find_near_duplicates
+from ndjson_paths import COMPRESSIONS, is_ndjson, run_paths_files, source_of
+from sequence_mining import (
+    DEFAULT_NS,
+    SequenceMiner,
+    mine_call_paths,
+    parse_ns,
+    remove_sequence_analytics,
+    write_sequence_analytics,
+)
+from sketches import DEFAULT_CAPACITY, DEFAULT_CM_DEPTH, DEFAULT_CM_WIDTH
+from tree_index import TreeIndex, classify_edges, subtree_rollups
 
 
 def flatten_tree(tree: List[Dict[str, Any]]) -> Tuple[Dict[int, Dict[str, Any]], Dict[int, int], Dict[int, List[int]]]:
-    nodes: Dict[int, Dict[str, Any]] = {}
-    parent_of: Dict[int, int] = {}
-    children: Dict[int, List[int]] = defaultdict(list)
-
-    def walk(node: Dict[str, Any], parent: int) -> None:
-        rid = int(node["rule_id"])
-        if rid not in nodes:
-            nodes[rid] = {"rule_id": rid, "text": node.get("text") or "", "url": node.get("url")}
-            parent_of[rid] = parent
-        # append child relationship once
-        if parent is not None:
-            if rid not in children[parent]:
-                children[parent].append(rid)
-        for child in node.get("children") or []:
-            walk(child, rid)
-
-    for root in tree:
-        walk(root, 0)  # 0 marks root parent
-
+    nodes, parent_of, child_sets = flatten_forest(tree)  # 0 marks root parent
     # deterministic child order
-    for p, ch in children.items():
-        children[p] = sorted(set(ch))
+    children: Dict[int, List[int]] = defaultdict(list)
+    for p, ch in child_sets.items():
+        children[p] = sorted(ch)
     return nodes, parent_of, children
 
 
-def get_paths(call_paths_all: Dict[str, Any]) -> List[Dict[str, Any]]:
-    paths: List[Dict[str, Any]] = []
-    for key, entry in call_paths_all.items():
-        # entry may be a dict with 'path' or legacy list
-        if isinstance(entry, list):
-            paths.append({"source_call": key, "call_id": key.split("::")[-1], "call_date": None, "weekday": None, "path": entry})
-        elif isinstance(entry, dict):
-            p = entry.get("path", [])
-            paths.append({
-                "source_call": key,
-                "call_id": entry.get("call_id") or key.split("::")[-1],
-                "call_date": entry.get("call_date"),
-                "weekday": entry.get("weekday"),
-                "path": p,
-            })
-    return paths
-
-
-def path_rule_ids(path: List[Dict[str, Any]]) -> List[int]:
-    return [int(step["rule_id"]) for step in path if "rule_id" in step]
-
-
-def summarize_lengths(paths: List[Dict[str, Any]]) -> Dict[str, Any]:
-    lengths = [len(p["path"]) for p in paths]
-    if not lengths:
-        return {}
-    lengths_sorted = sorted(lengths)
-    n = len(lengths_sorted)
-    def pct(p: float) -> int:
-        if n == 0:
-            return 0
-        idx = min(n - 1, max(0, int(math.ceil(p * n) - 1)))
-        return lengths_sorted[idx]
-    return {
-        "count": n,
-        "avg": sum(lengths_sorted) / n,
-        "median": pct(0.5),
-        "p90": pct(0.9),
-        "p95": pct(0.95),
-        "min": lengths_sorted[0],
-        "max": lengths_sorted[-1],
-    }
-
-
-def top_intents(paths: List[Dict[str, Any]]) -> List[Tuple[int, int]]:
-    # intent = first node after root (assumes root id=1 appears or path starts at first choice)
-    counts: Counter = Counter()
-    for p in paths:
-        rids = path_rule_ids(p["path"])
-        # find first non-root (if first is 1, take second)
-        if not rids:
-            continue
-        intent = rids[1] if len(rids) > 1 and rids[0] == 1 else rids[0]
-        counts[intent] += 1
-    return counts.most_common()
-
-
-def leaf_analysis(paths: List[Dict[str, Any]]) -> Counter:
-    leaves: Counter = Counter()
-    for p in paths:
-        rids = path_rule_ids(p["path"])
-        if rids:
-            leaves[rids[-1]] += 1
-    return leaves
-
-
-def branch_distribution(paths: List[Dict[str, Any]]) -> Dict[int, Counter]:
-    # For each node, distribution of next steps (by occurrences)
-    dist: Dict[int, Counter] = defaultdict(Counter)
-    for p in paths:
-        rids = path_rule_ids(p["path"])
-        for i in range(len(rids) - 1):
-            dist[rids[i]][rids[i + 1]] += 1
-    return dist
-
-
-def weekday_trends(paths: List[Dict[str, Any]]) -> Dict[Optional[int], int]:
-    by_wd: Dict[Optional[int], int] = defaultdict(int)
-    for p in paths:
-        by_wd[p.get("weekday")] += 1
-    return dict(sorted(by_wd.items(), key=lambda x: (x[0] is None, x[0])))
-
-
-def depth_funnel(paths: List[Dict[str, Any]]) -> Dict[int, int]:
-    depth_counts: Counter = Counter()
-    for p in paths:
-        L = len(p["path"])
-        for d in range(1, L + 1):
-            depth_counts[d] += 1
-    return dict(sorted(depth_counts.items()))
-
-
-def node_funnel(paths: List[Dict[str, Any]]) -> Dict[int, Dict[str, int]]:
-    # For each node: reach (occurrences), transitions (sum of next), drop_off = reach - transitions
-    reach: Counter = Counter()
-    transitions: Dict[int, Counter] = defaultdict(Counter)
-    for p in paths:
-        rids = path_rule_ids(p["path"])
-        for i, rid in enumerate(rids):
-            reach[rid] += 1
-            if i < len(rids) - 1:
-                transitions[rid][rids[i + 1]] += 1
-    result: Dict[int, Dict[str, int]] = {}
-    for rid, r in reach.items():
-        trans_sum = sum(transitions.get(rid, {}).values())
-        result[rid] = {
-            "reach": r,
-            "transitions": trans_sum,
-            "drop_off": r - trans_sum,
-        }
-    return result
-
-
-def dead_ends(paths: List[Dict[str, Any]], children: Dict[int, List[int]]) -> List[Dict[str, Any]]:
-    # Termination rate for each node: last-occurrence / reach
-    reach_occ: Counter = Counter()
-    last_occ: Counter = Counter()
-    for p in paths:
-        rids = path_rule_ids(p["path"])
-        for rid in rids:
-            reach_occ[rid] += 1
-        if rids:
-            last_occ[rids[-1]] += 1
-    out: List[Dict[str, Any]] = []
-    for rid, r in reach_occ.items():
-        last = last_occ.get(rid, 0)
-        out.append({
-            "rule_id": rid,
-            "reach_occurrences": r,
-            "terminations": last,
-            "termination_rate": last / r if r else 0.0,
-            "has_children": len(children.get(rid, [])) > 0
-        })
-    out.sort(key=lambda x: (-x["termination_rate"], -x["reach_occurrences"]))
-    return out
-
-
+@instrumentation.timed("metric.entropy_complexity")
 def entropy_complexity(branch_dist: Dict[int, Counter]) -> Dict[int, Dict[str, float]]:
     out: Dict[int, Dict[str, float]] = {}
     for rid, ctr in branch_dist.items():
@@ -188,32 +60,7 @@ def entropy_complexity(branch_dist: Dict[int, Counter]) -> Dict[int, Dict[str, f
     return out
 
 
-def url_engagement(paths: List[Dict[str, Any]]) -> Counter:
-    ctr: Counter = Counter()
-    for p in paths:
-        for step in p["path"]:
-            url = step.get("url")
-            if url:
-                ctr[url] += 1
-    return ctr
-
-
-def anomalies(paths: List[Dict[str, Any]], children: Dict[int, List[int]]) -> Counter:
-    # Edges observed that are not tree edges
-    bad_edges: Counter = Counter()
-    tree_edges: set = set()
-    for pid, ch in children.items():
-        for c in ch:
-            tree_edges.add((pid, c))
-    for p in paths:
-        rids = path_rule_ids(p["path"])
-        for i in range(len(rids) - 1):
-            edge = (rids[i], rids[i + 1])
-            if edge not in tree_edges:
-                bad_edges[edge] += 1
-    return bad_edges
-
-
+@instrumentation.timed("metric.duplicates_by_text")
 def duplicates_by_text(nodes: Dict[int, Dict[str, Any]]) -> Dict[str, List[int]]:
     buckets: Dict[str, List[int]] = defaultdict(list)
     for rid, node in nodes.items():
@@ -223,11 +70,19 @@ def duplicates_by_text(nodes: Dict[int, Dict[str, Any]]) -> Dict[str, List[int]]
     return {t: rids for t, rids in buckets.items() if len(rids) > 1 and t}
 
 
+@instrumentation.timed("metric.near_duplicates")
+def near_duplicates(nodes: Dict[int, Dict[str, Any]], vectorized: bool = False) -> List[Dict[str, Any]]:
+    # Texts equal after Hebrew normalization or close by shingle Jaccard (MinHash/LSH)
+    return find_near_duplicates({rid: node.get("text") or "" for rid, node in nodes.items()}, vectorized=vectorized)
+
+
+@instrumentation.timed("metric.unreachable_nodes")
 def unreachable_nodes(nodes: Dict[int, Dict[str, Any]], reach_calls: Counter) -> List[int]:
     # Nodes that never appear in any call path
     return sorted([rid for rid in nodes if reach_calls.get(rid, 0) == 0])
 
 
+@instrumentation.timed("metric.coverage_ratio")
 def coverage_ratio(branch_dist: Dict[int, Counter]) -> Dict[int, Dict[str, float]]:
     out: Dict[int, Dict[str, float]] = {}
     for rid, ctr in branch_dist.items():
@@ -245,94 +100,490 @@ def coverage_ratio(branch_dist: Dict[int, Counter]) -> Dict[int, Dict[str, float
     return out
 
 
-def top_paths(paths: List[Dict[str, Any]], top_n: int = 50) -> List[Tuple[Tuple[int, ...], int]]:
-    ctr: Counter = Counter()
-    for p in paths:
-        rids = tuple(path_rule_ids(p["path"]))
-        if rids:
-            ctr[rids] += 1
-    return ctr.most_common(top_n)
-
-
-def save_json(path: str, data: Any) -> None:
+def save_json(path: str, data: Any, compact: bool = False) -> None:
     with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-
-def main() -> None:
-    here = os.path.dirname(os.path.abspath(__file__))
-    analytics_dir = os.path.join(here, "analytics")
-    os.makedirs(analytics_dir, exist_ok=True)
-
-    tree = load_json(os.path.join(here, "button_tree.all.json"))
-    call_paths_all = load_json(os.path.join(here, "call_paths.all.json"))
-
-    nodes, parent_of, children = flatten_tree(tree)
-    paths = get_paths(call_paths_all)
-
-    # Precompute reach by occurrences for unreachable check
-    reach_occ: Counter = Counter()
-    for p in paths:
-        for rid in path_rule_ids(p["path"]):
-            reach_occ[rid] += 1
+        if compact:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        else:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def load_partials(
+    json_dir: str,
+    vectorized: bool = False,
+    approx: Optional[Dict[str, int]] = None,
+    preloaded: Optional[Dict[str, MetricsAccumulator]] = None,
+) -> Optional[MetricsAccumulator]:
+    """
+    Reduce the per-source <name>.metrics.json partials into one accumulator, in the same
+    source order aggregate_runs uses. Returns None if any call_paths file lacks an up-to-date partial.
+    `preloaded` maps sources to accumulators already in memory, which are merged instead of their files.
+    """
+    if not os.path.isdir(json_dir):
+        return None
+    preloaded = preloaded or {}
+    acc = MetricsAccumulator(vectorized, approx)
+    # One paths file per source, so a leftover file in another format never merges a partial twice
+    for name, paths_file in run_paths_files(json_dir).items():
+        source = source_of(name)
+        if source in preloaded:
+            acc.merge(preloaded[source])
+            continue
+        partial = os.path.join(json_dir, source + PARTIALS_SUFFIX)
+        if not os.path.exists(partial) or os.path.getmtime(partial) < os.path.getmtime(paths_file):
+            return None
+        acc.merge(MetricsAccumulator.from_state(load_json(partial)))
+    return acc
+
+
+def load_partition_index(json_dir: str) -> Optional[Dict[str, List[str]]]:
+    """
+    Map each dated day to its partition files (in source order) without opening them.
+    Returns None if any call_paths file lacks an up-to-date partition index.
+    """
+    if not os.path.isdir(json_dir):
+        return None
+    days: Dict[str, List[str]] = defaultdict(list)
+    for name, paths_file in run_paths_files(json_dir).items():
+        source_dir = os.path.join(json_dir, PARTITIONS_DIR, source_of(name))
+        index_path = os.path.join(source_dir, PARTITION_INDEX)
+        if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(paths_file):
+            return None
+        for day in load_json(index_path)["days"]:
+            if day != UNDATED:
+                days[day].append(os.path.join(source_dir, day + PARTIALS_SUFFIX))
+    return dict(sorted(days.items()))
+
+
+def load_date_range(
+    index: Dict[str, List[str]],
+    start: Optional[str],
+    end: Optional[str],
+    vectorized: bool = False,
+    approx: Optional[Dict[str, int]] = None,
+) -> MetricsAccumulator:
+    """Merge only the partitions for days in [start, end] (ISO dates, inclusive; None = open)."""
+    acc = MetricsAccumulator(vectorized, approx)
+    for day, files in index.items():
+        if (start and day < start) or (end and day > end):
+            continue
+        for partial in files:
+            acc.merge(MetricsAccumulator.from_state(load_json(partial)))
+    return acc
+
+
+def series_label(day: str, freq: str) -> str:
+    if freq == "daily":
+        return day
+    if freq == "monthly":
+        return day[:7]
+    year, week, _ = dt.date.fromisoformat(day).isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def write_series(
+    index: Dict[str, List[str]],
+    freq: str,
+    start: Optional[str],
+    end: Optional[str],
+    nodes: Dict[int, Dict[str, Any]],
+    children: Dict[int, List[int]],
+    out_dir: str,
+    vectorized: bool = False,
+    approx: Optional[Dict[str, int]] = None,
+    shard_size: Optional[int] = None,
+    markov: bool = False,
+) -> List[Dict[str, Any]]:
+    """Full analytics per daily/weekly/monthly bucket under out_dir/<label>/, plus out_dir/index.json."""
+    buckets: Dict[str, List[str]] = defaultdict(list)
+    for day in index:
+        if (start and day < start) or (end and day > end):
+            continue
+        buckets[series_label(day, freq)].append(day)
+    entries: List[Dict[str, Any]] = []
+    tree = TreeIndex(children)
+    for label, days in buckets.items():
+        acc = load_date_range({d: index[d] for d in days}, None, None, vectorized, approx)
+        write_analytics(
+            acc, nodes, children, os.path.join(out_dir, label), vectorized, tree, shard_size, forest_metrics=False, markov=markov
+        )
+        entries.append({"label": label, "start": days[0], "end": days[-1], "calls": sum(acc.length_hist.values())})
+    os.makedirs(out_dir, exist_ok=True)
+    save_json(os.path.join(out_dir, "index.json"), entries)
+    return entries
+
+
+def find_call_paths_all(here: str) -> str:
+    """Newest aggregated call paths file in any supported format (JSON if none exist)."""
+    candidates = [os.path.join(here, "call_paths.all.json")] + [
+        os.path.join(here, "call_paths.all.ndjson" + ext) for ext in COMPRESSIONS.values()
+    ]
+    existing = [p for p in candidates if os.path.exists(p)]
+    if not existing:
+        return candidates[0]
+    return max(existing, key=os.path.getmtime)
+
+
+# Metric name -> file written by write_analytics
+ANALYTICS_FILES = {
+    "lengths_summary": "lengths_summary.json",
+    "top_intents": "top_intents.json",
+    "leaf_frequency": "leaf_frequency.json",
+    "branch_distribution": "branch_distribution.top10.json",
+    "weekday_trends": "weekday_trends.json",
+    "depth_funnel": "depth_funnel.json",
+    "node_funnel": "node_funnel.json",
+    "dead_ends": "dead_ends.json",
+    "entropy_complexity": "entropy_complexity.json",
+    "url_engagement": "url_engagement.json",
+    "anomalies": "anomalies.json",
+    "duplicates_by_text": "duplicates_by_text.json",
+    "near_duplicates": "near_duplicates.json",
+    "unreachable_nodes": "unreachable_nodes.json",
+    "coverage_ratio": "coverage_ratio.json",
+    "top_paths": "top_paths.json",
+    "subtree_rollups": "subtree_rollups.json",
+    "anomaly_kinds": "anomaly_kinds.json",
+    "completion": "completion.json",
+    "markov_model": "markov_model.json",
+    "summary": "summary.json",
+    "approx_error_bounds": "approx_error_bounds.json",
+}
+# Machine-readable outputs written without indentation (CSR arrays, per-node completion rows)
+COMPACT_METRICS = {"markov_model", "completion"}
+# Absorbing Markov chain outputs, only computed with markov=True (--markov)
+MARKOV_METRICS = {"completion", "markov_model"}
+# Outputs that depend only on the forest's node texts: the same for every date range or filter,
+# so they are computed once per forest and written to analytics/ only
+FOREST_METRICS = {"near_duplicates"}
+
+
+@instrumentation.timed("analyze.compute")
+def compute_analytics(
+    acc: MetricsAccumulator,
+    nodes: Dict[int, Dict[str, Any]],
+    children: Dict[int, List[int]],
+    vectorized: bool = False,
+    top: Optional[int] = None,
+    tree: Optional[TreeIndex] = None,
+    near_dups: Optional[List[Dict[str, Any]]] = None,
+    forest_metrics: bool = True,
+    markov: bool = False,
+) -> Dict[str, Any]:
+    """
+    Every analytics output keyed by metric name (see ANALYTICS_FILES). `top` replaces the
+    published truncation limits (10 branches per node, 200 dead ends/URLs/anomalies, 100 paths)
+    and also caps the otherwise complete intent/leaf lists. Pass a prebuilt `tree` index and
+    `near_dups` groups when computing several analytics over the same forest; with
+    forest_metrics=False the FOREST_METRICS are left out, and the MARKOV_METRICS are only
+    computed with markov=True.
+    """
+    acc.flush()
+    if tree is None:
+        tree = TreeIndex(children)
+    branch_k = top or 10
+    list_k = top or 200
+    paths_k = top or 100
+
+    # Per-edge metrics: grouped NumPy array ops, or nested Counters per node
+    if vectorized:
+        with instrumentation.stage("metric.edge_table"):
+            table = edge_arrays.EdgeTable(acc.edges)
+            transitions = table.transitions()
+            entropy_map = table.entropy_complexity()
+            coverage = table.coverage_ratio()
+            top_children = table.top_children(branch_k)
+            anomaly_edges = edge_arrays.off_tree_edges(acc.edges, children)
+    else:
+        branch_dist = acc.branch_distribution()
+        transitions = {rid: sum(ctr.values()) for rid, ctr in branch_dist.items()}
+        entropy_map = entropy_complexity(branch_dist)
+        coverage = coverage_ratio(branch_dist)
+        top_children = {rid: ctr.most_common(branch_k) for rid, ctr in branch_dist.items()}
+        anomaly_edges = acc.anomalies(children)
 
     # Metrics
-    lengths_summary = summarize_lengths(paths)
-    intents = top_intents(paths)
-    leaves_ctr = leaf_analysis(paths)
-    branch_dist = branch_distribution(paths)
-    weekday_vol = weekday_trends(paths)
-    depth_fn = depth_funnel(paths)
-    node_fn = node_funnel(paths)
-    dead_end_list = dead_ends(paths, children)
-    entropy_map = entropy_complexity(branch_dist)
-    url_ctr = url_engagement(paths)
-    anomaly_edges = anomalies(paths, children)
+    lengths_summary = acc.lengths_summary()
+    intents = acc.top_intents()
+    leaves_ctr = acc.leaves
+    weekday_vol = acc.weekday_trends()
+    depth_fn = acc.depth_funnel()
+    node_fn = node_funnel_from_totals(acc.reach, transitions)
+    dead_end_list = acc.dead_ends(children)
+    url_ctr = acc.urls
     dup_text = duplicates_by_text(nodes)
-    unreachable = unreachable_nodes(nodes, reach_occ)
-    coverage = coverage_ratio(branch_dist)
-    top_paths_list = top_paths(paths, top_n=100)
-
-    # Outputs
-    save_json(os.path.join(analytics_dir, "lengths_summary.json"), lengths_summary)
-    save_json(os.path.join(analytics_dir, "top_intents.json"), [{"rule_id": rid, "count": c, "text": nodes.get(rid, {}).get("text", "")} for rid, c in intents])
-    save_json(os.path.join(analytics_dir, "leaf_frequency.json"), [{"rule_id": rid, "count": c, "text": nodes.get(rid, {}).get("text", "")} for rid, c in leaves_ctr.most_common()])
+    if forest_metrics and near_dups is None:
+        near_dups = near_duplicates(nodes, vectorized)
+    unreachable = unreachable_nodes(nodes, acc.reach)
+    top_paths_list = acc.top_paths(top_n=paths_k)
+    rollups = subtree_rollups(tree, nodes, acc.reach, acc.leaves)
+    anomaly_kinds = classify_edges(tree, anomaly_edges.items())
+    if markov:
+        with instrumentation.stage("metric.markov_model"):
+            model = MarkovModel(acc.edges, acc.leaves).solve(vectorized)
+            leaf_ids = tree_leaves(children)
+        if model.unconverged_states:
+            print(
+                f"Warning: Markov solve stopped early for {model.unconverged_states} state(s) "
+                f"(max residual {model.max_residual:.3g}); use --backend numpy for an exact solve"
+            )
+
+    out: Dict[str, Any] = {}
+    out["lengths_summary"] = lengths_summary
+    out["top_intents"] = [{"rule_id": rid, "count": c, "text": nodes.get(rid, {}).get("text", "")} for rid, c in intents[:top]]
+    out["leaf_frequency"] = [{"rule_id": rid, "count": c, "text": nodes.get(rid, {}).get("text", "")} for rid, c in leaves_ctr.most_common(top)]
     # Branch distribution: for size reasons, keep top 10 per node
     branch_out = {}
-    for rid, ctr in branch_dist.items():
-        branch_out[str(rid)] = [{"child": cid, "count": ctr[cid], "text": nodes.get(cid, {}).get("text", "")} for cid, _ in ctr.most_common(10)]
-    save_json(os.path.join(analytics_dir, "branch_distribution.top10.json"), branch_out)
-    save_json(os.path.join(analytics_dir, "weekday_trends.json"), weekday_vol)
-    save_json(os.path.join(analytics_dir, "depth_funnel.json"), depth_fn)
-    save_json(os.path.join(analytics_dir, "node_funnel.json"), node_fn)
-    save_json(os.path.join(analytics_dir, "dead_ends.json"), dead_end_list[:200])
-    save_json(os.path.join(analytics_dir, "entropy_complexity.json"), entropy_map)
-    save_json(os.path.join(analytics_dir, "url_engagement.json"), url_ctr.most_common(200))
-    save_json(os.path.join(analytics_dir, "anomalies.json"), [{"from": a, "to": b, "count": c} for (a, b), c in anomaly_edges.most_common(200)])
-    save_json(os.path.join(analytics_dir, "duplicates_by_text.json"), dup_text)
-    save_json(os.path.join(analytics_dir, "unreachable_nodes.json"), [{"rule_id": rid, "text": nodes.get(rid, {}).get("text", "")} for rid in unreachable])
-    save_json(os.path.join(analytics_dir, "coverage_ratio.json"), coverage)
-    save_json(os.path.join(analytics_dir, "top_paths.json"), [{"path": list(p), "count": c} for p, c in top_paths_list])
+    for rid, top_list in top_children.items():
+        branch_out[str(rid)] = [{"child": cid, "count": c, "text": nodes.get(cid, {}).get("text", "")} for cid, c in top_list]
+    out["branch_distribution"] = branch_out
+    out["weekday_trends"] = weekday_vol
+    out["depth_funnel"] = depth_fn
+    out["node_funnel"] = node_fn
+    out["dead_ends"] = dead_end_list[:list_k]
+    out["entropy_complexity"] = entropy_map
+    url_top = url_ctr.most_common(list_k)
+    out["url_engagement"] = url_top
+    out["anomalies"] = [
+        {"from": a, "to": b, "count": c, "kind": tree.classify(a, b)} for (a, b), c in anomaly_edges.most_common(list_k)
+    ]
+    out["duplicates_by_text"] = dup_text
+    if forest_metrics:
+        out["near_duplicates"] = near_dups
+    out["unreachable_nodes"] = [{"rule_id": rid, "text": nodes.get(rid, {}).get("text", "")} for rid in unreachable]
+    out["coverage_ratio"] = coverage
+    out["top_paths"] = [{"path": list(p), "count": c} for p, c in top_paths_list]
+    out["subtree_rollups"] = rollups
+    out["anomaly_kinds"] = anomaly_kinds
+    if markov:
+        out["completion"] = model.completion(leaf_ids, nodes)
+        out["markov_model"] = model.to_sparse(leaf_ids)
 
     # Summary file
-    summary = {
+    out["summary"] = {
         "lengths_summary": lengths_summary,
         "weekday_trends": weekday_vol,
         "top_intents_top10": [{"rule_id": rid, "count": c, "text": nodes.get(rid, {}).get("text", "")} for rid, c in intents[:10]],
         "dead_ends_top20": dead_end_list[:20],
         "entropy_complexity_top20": sorted(
             [{"rule_id": rid, **vals, "text": nodes.get(rid, {}).get("text", "")} for rid, vals in entropy_map.items()],
-            key=lambda x: (-x["entropy_bits"], -branch_dist.get(x["rule_id"], Counter()).total() if hasattr(Counter, "total") else -sum(branch_dist.get(x["rule_id"], Counter()).values()))
+            key=lambda x: (-x["entropy_bits"], -transitions.get(x["rule_id"], 0))
         )[:20],
     }
-    save_json(os.path.join(analytics_dir, "summary.json"), summary)
-    print(f"Wrote analytics to: {analytics_dir}")
 
+    # Error bounds for the sketched outputs (--approx)
+    if acc.approx is not None:
+        out["approx_error_bounds"] = {
+            "top_paths": acc.paths.error_report(top_paths_list),
+            "url_engagement": acc.urls.error_report(url_top),
+        }
+    return out
 
-if __name__ == "__main__":
-    main()
 
+def write_analytics(
+    acc: MetricsAccumulator,
+    nodes: Dict[int, Dict[str, Any]],
+    children: Dict[int, List[int]],
+    analytics_dir: str,
+    vectorized: bool = False,
+    tree: Optional[TreeIndex] = None,
+    shard_size: Optional[int] = None,
+    forest_metrics: bool = True,
+    markov: bool = False,
+) -> None:
+    """
+    Write every ANALYTICS_FILES output; with shard_size also the per-node shards and their index.
+    Date-range and series outputs pass forest_metrics=False (FOREST_METRICS live in analytics/).
+    """
+    os.makedirs(analytics_dir, exist_ok=True)
+    outputs = compute_analytics(acc, nodes, children, vectorized, tree=tree, forest_metrics=forest_metrics, markov=markov)
+    with instrumentation.stage("analyze.write", out=analytics_dir) as st:
+        for metric, filename in ANALYTICS_FILES.items():
+            path = os.path.join(analytics_dir, filename)
+            if metric in outputs:
+                save_json(path, outputs[metric], compact=metric in COMPACT_METRICS)
+                st.wrote_file(path)
+            elif os.path.exists(path):
+                # Exact runs drop a stale approx_error_bounds.json, range runs stale forest outputs,
+                # runs without --markov stale completion/markov_model files
+                os.remove(path)
+        if shard_size:
+            for path in analytics_shards.write_sharded_analytics(analytics_dir, outputs, shard_size):
+                st.wrote_file(path)
+        else:
+            # Unsharded runs drop stale shards so they never disagree with the full files
+            shutil.rmtree(os.path.join(analytics_dir, analytics_shards.SHARDS_DIR), ignore_errors=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compute call analytics from the aggregated tree and call paths")
+    parser.add_argument(
+        "--partials",
+        action="store_true",
+        help="Merge per-source json/*.metrics.json partials instead of scanning the aggregated call paths (falls back to a scan if any are missing or stale)",
+    )
+    parser.add_argument(
+        "--paths",
+        default=None,
+        help="Aggregated call paths (call_paths.all.json or .ndjson[.gz|.xz]). Default: the newest one next to this script",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["auto", "python", "numpy"],
+        default="auto",
+        help="Edge/entropy computation backend. auto uses NumPy when it is installed (default: auto)",
+    )
+    parser.add_argument(
+        "--approx",
+        action="store_true",
+        help="Count full paths and URLs with fixed-memory Space-Saving/Count-Min sketches; writes analytics/approx_error_bounds.json",
+    )
+    parser.add_argument(
+        "--sketch-capacity",
+        type=int,
+        default=DEFAULT_CAPACITY,
+        help=f"Keys monitored per sketch with --approx; counts over-estimate by at most total/capacity (default: {DEFAULT_CAPACITY})",
+    )
+    parser.add_argument(
+        "--cm-width",
+        type=int,
+        default=DEFAULT_CM_WIDTH,
+        help=f"Count-Min counters per row with --approx (default: {DEFAULT_CM_WIDTH})",
+    )
+    parser.add_argument(
+        "--cm-depth",
+        type=int,
+        default=DEFAULT_CM_DEPTH,
+        help=f"Count-Min rows with --approx (default: {DEFAULT_CM_DEPTH})",
+    )
+    parser.add_argument("--start", default=None, help="First day (YYYY-MM-DD, inclusive) of a date-range analysis")
+    parser.add_argument("--end", default=None, help="Last day (YYYY-MM-DD, inclusive) of a date-range analysis")
+    parser.add_argument("--last", type=int, default=None, help="Analyze the last N days, ending at --end or the newest day with calls")
+    parser.add_argument(
+        "--series",
+        choices=["daily", "weekly", "monthly"],
+        default=None,
+        help="Write full analytics per day / ISO week / month (optionally bounded by --start/--end/--last)",
+    )
+    parser.add_argument(
+        "--out",
+        default=None,
+        help="Output directory for date-range/series runs (default: analytics/range_<start>_<end> or analytics/series/<freq>)",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        nargs="?",
+        const=analytics_shards.DEFAULT_SHARD_SIZE,
+        default=None,
+        metavar="N",
+        help=f"Also write per-node maps as chunks of N keys under <out>/shards/ with a key -> shard/byte-offset index (default N: {analytics_shards.DEFAULT_SHARD_SIZE})",
+    )
+    parser.add_argument(
+        "--markov",
+        action="store_true",
+        help="Also solve the absorbing Markov chain over rule_id transitions (completion.json, markov_model.json)",
+    )
+    parser.add_argument(
+        "--sequences",
+        action="store_true",
+        help="Also mine frequent rule_id n-grams, within-call loops and per-node rework (ngrams.json, loops.json, rework.json)",
+    )
+    parser.add_argument(
+        "--ngram-sizes",
+        type=parse_ns,
+        default=DEFAULT_NS,
+        help="Comma-separated n-gram sizes for --sequences (default: 2,3,4)",
+    )
+    args = parser.parse_args()
+    for flag in ("start", "end"):
+        value = getattr(args, flag)
+        if value is not None:
+            try:
+                dt.date.fromisoformat(value)
+            except ValueError:
+                parser.error(f"--{flag} must be a YYYY-MM-DD date, got {value!r}")
+    if args.last is not None and args.last <= 0:
+        parser.error("--last must be positive")
+    if args.shards is not None and args.shards <= 0:
+        parser.error("--shards must be positive")
+    if args.sequences and (args.start or args.end or args.last or args.series):
+        parser.error("--sequences needs the aggregated call paths; date-range partitions hold no paths")
+    if args.backend == "numpy" and not edge_arrays.available():
+        parser.error("--backend numpy requires NumPy (pip install numpy)")
+    vectorized = args.backend == "numpy" or (args.backend == "auto" and edge_arrays.available())
+    approx = None
+    if args.approx:
+        if min(args.sketch_capacity, args.cm_width, args.cm_depth) <= 0:
+            parser.error("--sketch-capacity, --cm-width and --cm-depth must be positive")
+        approx = {"capacity": args.sketch_capacity, "cm_width": args.cm_width, "cm_depth": args.cm_depth}
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    analytics_dir = os.path.join(here, "analytics")
+    json_dir = os.path.join(here, "json")
 
+    tree = load_json(os.path.join(here, "button_tree.all.json"))
+    nodes, parent_of, children = flatten_tree(tree)
 
+    if args.start or args.end or args.last or args.series:
+        # Date-range analytics read only the json/by_date partitions for the requested days
+        index = load_partition_index(json_dir)
+        if index is None:
+            raise SystemExit("Date partitions missing or stale; re-run generate_button_tree.py first")
+        start, end = args.start, args.end
+        if args.last:
+            last_day = end or (max(index) if index else None)
+            if last_day:
+                end = last_day
+                start = (dt.date.fromisoformat(last_day) - dt.timedelta(days=args.last - 1)).isoformat()
+        if args.series:
+            out_dir = args.out or os.path.join(analytics_dir, "series", args.series)
+            entries = write_series(
+                index, args.series, start, end, nodes, children, out_dir, vectorized, approx, args.shards, args.markov
+            )
+            print(f"Wrote {len(entries)} {args.series} buckets to: {out_dir}")
+        else:
+            out_dir = args.out or os.path.join(analytics_dir, f"range_{start or 'first'}_{end or 'last'}")
+            acc = load_date_range(index, start, end, vectorized, approx)
+            write_analytics(
+                acc, nodes, children, out_dir, vectorized, shard_size=args.shards, forest_metrics=False, markov=args.markov
+            )
+            print(f"Wrote analytics for {start or 'first day'}..{end or 'last day'} ({sum(acc.length_hist.values())} calls) to: {out_dir}")
+        return
+
+    miner = SequenceMiner(args.ngram_sizes) if args.sequences else None
+    with instrumentation.stage("analyze.partials") as st:
+        acc = load_partials(json_dir, vectorized, approx) if args.partials else None
+        st.info["used"] = acc is not None
+    if acc is None:
+        if args.partials:
+            print("Partial metrics missing or stale; scanning aggregated call paths")
+        paths_file = args.paths or find_call_paths_all(here)
+        # Single scan over all calls; every metric (and the sequence miner) reads from it
+        with instrumentation.stage("analyze.scan", paths=os.path.basename(paths_file)) as st:
+            acc = MetricsAccumulator(vectorized, approx)
+            acc.sequences = miner
+            acc = acc.add_ndjson(paths_file) if is_ndjson(paths_file) else acc.add_json_stream(paths_file)
+            st.read_file(paths_file)
+            st.calls = sum(acc.length_hist.values())
+            st.steps = sum(length * n for length, n in acc.length_hist.items())
+    elif miner is not None:
+        # Partials hold no per-call sequences; mine them in one streaming pass
+        paths_file = args.paths or find_call_paths_all(here)
+        with instrumentation.stage("analyze.sequences", paths=os.path.basename(paths_file)) as st:
+            miner = mine_call_paths(paths_file, args.ngram_sizes)
+            st.read_file(paths_file)
+            st.calls = miner.calls
+
+    write_analytics(acc, nodes, children, analytics_dir, vectorized, shard_size=args.shards, markov=args.markov)
+    if miner is not None:
+        with instrumentation.stage("analyze.sequences.write"):
+            write_sequence_analytics(miner.outputs(nodes), analytics_dir)
+    else:
+        # Runs without --sequences drop stale ngrams/loops/rework files
+        remove_sequence_analytics(analytics_dir)
+    print(f"Wrote analytics to: {analytics_dir}")
 
 
+if __name__ == "__main__":
+    main()
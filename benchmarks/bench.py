@@ -0,0 +1,312 @@
+"""
+Pipeline benchmark harness.
+
+For each size, generates (or reuses) a synthetic dataset with synth_data.py, then runs every
+stage in its own subprocess so peak RSS is per stage:
+
+  decode     iter_csv_rows over the synthetic CSVs (CSV decoding only)
+  generate   process_many_csvs over the synthetic CSVs
+  aggregate  aggregate_runs (full rebuild)
+  analyze    one scan of call_paths.all.json, then each metric timed separately (markov is
+             the opt-in --markov solve; write_analytics runs the default analytics)
+
+Results are printed as a table (seconds, rows/s, peak MB) and compared with stored baselines
+(benchmarks/baselines.json); --save-baseline records the current run as the new baseline.
+
+  python benchmarks/bench.py --sizes 10k,100k,1m
+  python benchmarks/bench.py --sizes 10m --workers 4 --stream
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+sys.path.insert(0, REPO)
+sys.path.insert(0, HERE)
+
+DEFAULT_BASELINES = os.path.join(HERE, "baselines.json")
+DEFAULT_WORK_DIR = os.path.join(HERE, ".work")
+DEFAULT_TOLERANCE = 1.25
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().lower().replace("_", "")
+    scale = {"k": 1_000, "m": 1_000_000, "g": 1_000_000_000}.get(text[-1:], 1)
+    number = text[:-1] if text[-1:] in "kmg" else text
+    try:
+        return int(float(number) * scale)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Bad size: {text!r} (use e.g. 10k, 1m, 250000)")
+
+
+def size_label(rows: int) -> str:
+    for unit, scale in (("m", 1_000_000), ("k", 1_000)):
+        if rows >= scale and rows % scale == 0:
+            return f"{rows // scale}{unit}"
+    return str(rows)
+
+
+def peak_rss_kb() -> Optional[int]:
+    # ru_maxrss is KiB on Linux, bytes on macOS; unavailable on Windows
+    if resource is None:
+        return None
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    peak = max(own, kids)
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+# --- stages (run inside a child process via --stage) ---
+def stage_decode(work: str, args: argparse.Namespace) -> Dict[str, Any]:
+    from generate_button_tree import iter_csv_rows
+
+    data_dir = os.path.join(work, "data")
+    csvs = [os.path.join(data_dir, n) for n in sorted(os.listdir(data_dir)) if n.endswith(".csv")]
+    t = time.perf_counter()
+    for path in csvs:
+        for _ in iter_csv_rows(path):
+            pass
+    return {"seconds": time.perf_counter() - t}
+
+
+def stage_generate(work: str, args: argparse.Namespace) -> Dict[str, Any]:
+    from generate_button_tree import process_many_csvs
+
+    data_dir = os.path.join(work, "data")
+    json_dir = os.path.join(work, "json")
+    shutil.rmtree(json_dir, ignore_errors=True)
+    os.makedirs(json_dir)
+    csvs = [os.path.join(data_dir, n) for n in sorted(os.listdir(data_dir)) if n.endswith(".csv")]
+    t = time.perf_counter()
+    process_many_csvs(csvs, json_dir, workers=args.workers, stream=args.stream, fmt=args.format, compression=args.compress)
+    return {"seconds": time.perf_counter() - t}
+
+
+def stage_aggregate(work: str, args: argparse.Namespace) -> Dict[str, Any]:
+    from aggregate_runs import aggregate_runs
+
+    t = time.perf_counter()
+    aggregate_runs(os.path.join(work, "json"), work, incremental=False, fmt=args.format, compression=args.compress)
+    return {"seconds": time.perf_counter() - t}
+
+
+def stage_analyze(work: str, args: argparse.Namespace) -> Dict[str, Any]:
+    import analyze_calls as ac
+    from metric_partials import node_funnel_from_counts
+
+    metrics: Dict[str, float] = {}
+
+    def timed(name: str, fn: Callable[[], Any]) -> Any:
+        t = time.perf_counter()
+        out = fn()
+        metrics[name] = time.perf_counter() - t
+        return out
+
+    start = time.perf_counter()
+    nodes, _, children = timed("load_tree", lambda: ac.flatten_tree(ac.load_json(os.path.join(work, "button_tree.all.json"))))
+    paths_file = ac.find_call_paths_all(work)
+    if ac.is_ndjson(paths_file):
+        acc = timed("scan", lambda: ac.MetricsAccumulator().add_ndjson(paths_file))
+    else:
+        acc = timed("scan", lambda: ac.MetricsAccumulator().add_json_stream(paths_file))
+    branch = timed("branch_distribution", acc.branch_distribution)
+    timed("lengths_summary", acc.lengths_summary)
+    timed("top_intents", acc.top_intents)
+    timed("leaf_frequency", lambda: acc.leaves.most_common())
+    timed("weekday_trends", acc.weekday_trends)
+    timed("depth_funnel", acc.depth_funnel)
+    timed("node_funnel", lambda: node_funnel_from_counts(acc.reach, branch))
+    timed("dead_ends", lambda: acc.dead_ends(children))
+    timed("entropy_complexity", lambda: ac.entropy_complexity(branch))
+    timed("url_engagement", lambda: acc.urls.most_common(200))
+    timed("anomalies", lambda: acc.anomalies(children).most_common(200))
+    timed("duplicates_by_text", lambda: ac.duplicates_by_text(nodes))
+    timed("unreachable_nodes", lambda: ac.unreachable_nodes(nodes, acc.reach))
+    timed("coverage_ratio", lambda: ac.coverage_ratio(branch))
+    timed("top_paths", lambda: acc.top_paths(top_n=100))
+    timed("near_duplicates", lambda: ac.near_duplicates(nodes))
+    timed("subtree_rollups", lambda: ac.subtree_rollups(ac.TreeIndex(children), nodes, acc.reach, acc.leaves))
+
+    def markov() -> Any:
+        model = ac.MarkovModel(acc.edges, acc.leaves).solve()
+        leaf_ids = ac.tree_leaves(children)
+        return model.completion(leaf_ids, nodes), model.to_sparse(leaf_ids)
+
+    timed("markov", markov)
+    timed("write_analytics", lambda: ac.write_analytics(acc, nodes, children, os.path.join(work, "analytics")))
+    return {"seconds": time.perf_counter() - start, "metrics": metrics}
+
+
+STAGES = {"decode": stage_decode, "generate": stage_generate, "aggregate": stage_aggregate, "analyze": stage_analyze}
+
+
+def run_stage_child(name: str, work: str, args: argparse.Namespace) -> None:
+    result = STAGES[name](work, args)
+    result["peak_rss_kb"] = peak_rss_kb()
+    print(json.dumps(result))
+
+
+# --- harness ---
+def dataset_dir(args: argparse.Namespace, rows: int) -> str:
+    key = f"rows{rows}_f{args.files}_d{args.depth}_fo{args.fanout}_{args.path_length.replace(':', '-').replace(',', '-')}_ot{args.off_tree}_s{args.seed}"
+    return os.path.join(args.work_dir, key)
+
+
+def ensure_dataset(args: argparse.Namespace, rows: int) -> Dict[str, Any]:
+    from synth_data import generate
+
+    work = dataset_dir(args, rows)
+    stats_path = os.path.join(work, "dataset.json")
+    if os.path.exists(stats_path) and not args.regenerate:
+        with open(stats_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    shutil.rmtree(work, ignore_errors=True)
+    t = time.perf_counter()
+    stats = generate(
+        os.path.join(work, "data"),
+        rows,
+        files=args.files,
+        depth=args.depth,
+        fanout=args.fanout,
+        path_length=args.path_length,
+        off_tree=args.off_tree,
+        seed=args.seed,
+    )
+    stats["csv_bytes"] = sum(os.path.getsize(os.path.join(work, "data", n)) for n in os.listdir(os.path.join(work, "data")))
+    print(f"  generated {stats['rows']} rows / {stats['calls']} calls in {time.perf_counter() - t:.1f}s", flush=True)
+    with open(stats_path, "w", encoding="utf-8") as f:
+        json.dump(stats, f)
+    return stats
+
+
+def run_stage(name: str, work: str, args: argparse.Namespace) -> Dict[str, Any]:
+    cmd = [
+        sys.executable, os.path.abspath(__file__), "--stage", name, "--stage-dir", work,
+        "--workers", str(args.workers), "--format", args.format, "--compress", args.compress,
+    ]
+    if args.stream:
+        cmd.append("--stream")
+    proc = subprocess.run(cmd, capture_output=True, text=True, cwd=REPO)
+    if proc.returncode != 0:
+        raise RuntimeError(f"stage {name} failed:\n{proc.stderr[-2000:]}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def machine_info() -> Dict[str, Any]:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def load_baselines(path: str) -> Dict[str, Any]:
+    if not os.path.exists(path):
+        return {"machine": None, "results": {}}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare(current: Optional[float], baseline: Optional[float], tolerance: float) -> str:
+    if current is None or not baseline:
+        return "-"
+    ratio = current / baseline
+    if max(current, baseline) < 0.01:
+        return f"{ratio:.2f}x"  # sub-10ms timings are too noisy to flag
+    flag = "  REGRESSION" if ratio > tolerance else ("  faster" if ratio < 1 / tolerance else "")
+    return f"{ratio:.2f}x{flag}"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark generate/aggregate/analyze on synthetic call-center data")
+    parser.add_argument("--sizes", default="10k,100k", help="Comma-separated CSV row counts, e.g. 10k,100k,1m,10m (default: 10k,100k)")
+    parser.add_argument("--stages", default="decode,generate,aggregate,analyze", help="Stages to run (default: all)")
+    parser.add_argument("--files", type=int, default=4, help="CSV files per dataset (default: 4)")
+    parser.add_argument("--depth", type=int, default=5, help="Synthetic tree depth (default: 5)")
+    parser.add_argument("--fanout", type=int, default=6, help="Synthetic tree maximum fan-out (default: 6)")
+    parser.add_argument("--path-length", default="geometric:5", help="Path length distribution (see synth_data.py)")
+    parser.add_argument("--off-tree", type=float, default=0.02, help="Per-step off-tree jump probability (default: 0.02)")
+    parser.add_argument("--seed", type=int, default=0, help="Dataset seed (default: 0)")
+    parser.add_argument("--workers", type=int, default=1, help="generate_button_tree worker processes (default: 1)")
+    parser.add_argument("--stream", action="store_true", help="Use the bounded-memory streaming ingest")
+    parser.add_argument("--format", choices=("json", "ndjson"), default="json", help="Call path format (default: json)")
+    parser.add_argument("--compress", choices=("none", "gzip", "lzma"), default="none", help="Compression for --format ndjson")
+    parser.add_argument("--work-dir", default=DEFAULT_WORK_DIR, help="Where datasets and outputs are kept (default: benchmarks/.work)")
+    parser.add_argument("--regenerate", action="store_true", help="Regenerate datasets even if cached")
+    parser.add_argument("--baselines", default=DEFAULT_BASELINES, help="Baseline file (default: benchmarks/baselines.json)")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run's results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Slowdown/memory ratio flagged as a regression (default: 1.25)")
+    parser.add_argument("--json-out", default=None, help="Also write the raw results to this JSON file")
+    # Internal: run one stage in this (child) process
+    parser.add_argument("--stage", choices=tuple(STAGES), help=argparse.SUPPRESS)
+    parser.add_argument("--stage-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.stage:
+        run_stage_child(args.stage, args.stage_dir, args)
+        return
+
+    try:
+        sizes = [parse_size(s) for s in args.sizes.split(",") if s.strip()]
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        parser.error(f"Unknown stage(s): {', '.join(unknown)}")
+
+    baselines = load_baselines(args.baselines)
+    base_results = baselines.get("results", {})
+    if baselines.get("machine") and baselines["machine"] != machine_info():
+        print("Note: baselines were recorded on a different machine; ratios are indicative only.")
+
+    results: Dict[str, Any] = {}
+    for rows in sizes:
+        label = size_label(rows)
+        print(f"== {label} rows", flush=True)
+        stats = ensure_dataset(args, rows)
+        work = dataset_dir(args, rows)
+        results[label] = {"dataset": stats, "stages": {}}
+        for stage in stages:
+            res = run_stage(stage, work, args)
+            res["rows_per_sec"] = stats["rows"] / res["seconds"] if res["seconds"] else None
+            results[label]["stages"][stage] = res
+
+        print(f"  {'stage':<22} {'seconds':>9} {'rows/s':>11} {'peak MB':>9}   {'time vs base':<18} {'mem vs base'}")
+        base = base_results.get(label, {}).get("stages", {})
+        for stage, res in results[label]["stages"].items():
+            b = base.get(stage, {})
+            peak_mb = f"{res['peak_rss_kb'] / 1024:.1f}" if res["peak_rss_kb"] is not None else "-"
+            print(
+                f"  {stage:<22} {res['seconds']:>9.3f} {res['rows_per_sec'] or 0:>11,.0f} {peak_mb:>9}"
+                f"   {compare(res['seconds'], b.get('seconds'), args.tolerance):<18} {compare(res['peak_rss_kb'], b.get('peak_rss_kb'), args.tolerance)}"
+            )
+            for metric, secs in res.get("metrics", {}).items():
+                base_secs = b.get("metrics", {}).get(metric)
+                print(f"    {metric:<20} {secs:>9.4f}   {'':>22}   {compare(secs, base_secs, args.tolerance)}")
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump({"machine": machine_info(), "results": results}, f, indent=2)
+    if args.save_baseline:
+        base_results.update(results)
+        with open(args.baselines, "w", encoding="utf-8") as f:
+            json.dump({"machine": machine_info(), "results": base_results}, f, indent=2)
+        print(f"Saved baselines to {args.baselines}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Synthetic call-center CSV generator for benchmarks.
+
+Writes CSVs in the production schema (call_id,call_date,rule_id,rule_parent_id,rule_text,popUpURL)
+from a random protocol tree: Hebrew node texts, Zipf-skewed branch choices, a configurable
+path-length distribution and a share of off-tree transitions (which show up in anomalies.json).
+Output is deterministic for a given seed.
+"""
+import argparse
+import csv
+import datetime as dt
+import math
+import os
+import random
+from typing import Dict, List, Optional, Tuple
+
+HEBREW_WORDS = [
+    "תלונה", "כללי", "מטיילים", "בדיקה", "תור", "רופא", "מרפאה", "תשלום", "החזר", "מרשם",
+    "תרופה", "הפניה", "ביטוח", "חירום", "ילדים", "נשים", "עיניים", "שיניים", "עור", "לב",
+    "ריאות", "אורתופדיה", "צילום", "רנטגן", "אולטראסאונד", "מעבדה", "תוצאות", "ביטול", "שינוי", "זימון",
+    "מידע", "כתובת", "שעות", "פעילות", "טלפון", "אישור", "טופס", "מחיר", "ביקור", "מנוי",
+]
+ROOT_TEXT = "תלונה עיקרית"
+ROOT_ID = 1
+FIRST_RULE_ID = 1000
+FIRST_CALL_ID = 2_000_000
+HEADER = ["call_id", "call_date", "rule_id", "rule_parent_id", "rule_text", "popUpURL"]
+
+
+class SynthTree:
+    """Random protocol tree: rule_id -> (parent_id, text, url), children lists with Zipf weights."""
+
+    def __init__(self, rng: random.Random, depth: int, fanout: int, url_share: float) -> None:
+        self.parent: Dict[int, int] = {ROOT_ID: 0}
+        self.text: Dict[int, str] = {ROOT_ID: ROOT_TEXT}
+        self.url: Dict[int, Optional[str]] = {ROOT_ID: None}
+        self.children: Dict[int, List[int]] = {}
+        self.weights: Dict[int, List[float]] = {}
+        next_id = FIRST_RULE_ID
+        level = [ROOT_ID]
+        for _ in range(depth):
+            nxt: List[int] = []
+            for pid in level:
+                kids = list(range(next_id, next_id + rng.randint(1, fanout)))
+                next_id += len(kids)
+                self.children[pid] = kids
+                self.weights[pid] = [1.0 / (rank + 1) for rank in range(len(kids))]  # Zipf(1) branch skew
+                for cid in kids:
+                    self.parent[cid] = pid
+                    self.text[cid] = " ".join(rng.sample(HEBREW_WORDS, rng.randint(1, 3)))
+                    self.url[cid] = f"https://example.org/protocol/{cid}" if rng.random() < url_share else None
+                nxt.extend(kids)
+            level = nxt
+        self.all_ids = list(self.parent)
+
+    def __len__(self) -> int:
+        return len(self.parent)
+
+
+def parse_length_dist(spec: str) -> Tuple[str, List[float]]:
+    """'geometric:MEAN', 'uniform:LO,HI' or 'fixed:N'."""
+    kind, _, params = spec.partition(":")
+    try:
+        values = [float(v) for v in params.split(",") if v]
+    except ValueError:
+        raise ValueError(f"Bad path-length spec: {spec!r}")
+    expected = {"geometric": 1, "uniform": 2, "fixed": 1}
+    if kind not in expected or len(values) != expected[kind]:
+        raise ValueError(f"Bad path-length spec: {spec!r} (use geometric:MEAN, uniform:LO,HI or fixed:N)")
+    return kind, values
+
+
+def sample_length(rng: random.Random, dist: Tuple[str, List[float]]) -> int:
+    kind, values = dist
+    if kind == "fixed":
+        return max(1, int(values[0]))
+    if kind == "uniform":
+        return rng.randint(max(1, int(values[0])), max(1, int(values[1])))
+    # Geometric on {1, 2, ...} with the given mean
+    p = 1.0 / max(values[0], 1.0)
+    if p >= 1.0:
+        return 1
+    return 1 + int(math.log(1.0 - rng.random()) / math.log(1.0 - p))
+
+
+def sample_path(rng: random.Random, tree: SynthTree, length: int, off_tree: float) -> List[int]:
+    path = [ROOT_ID]
+    node = ROOT_ID
+    while len(path) < length:
+        kids = tree.children.get(node)
+        if rng.random() < off_tree:
+            node = rng.choice(tree.all_ids)  # jump outside the tree structure
+        elif kids:
+            node = rng.choices(kids, weights=tree.weights[node])[0]
+        else:
+            break
+        path.append(node)
+    return path
+
+
+def generate(
+    out_dir: str,
+    rows: int,
+    files: int = 4,
+    depth: int = 5,
+    fanout: int = 6,
+    path_length: str = "geometric:5",
+    off_tree: float = 0.02,
+    url_share: float = 0.05,
+    days: int = 300,
+    start_date: str = "2025-01-01",
+    seed: int = 0,
+) -> Dict[str, int]:
+    """Write `files` CSVs with about `rows` rows in total. Returns counts of rows, calls and tree nodes."""
+    rng = random.Random(seed)
+    tree = SynthTree(rng, depth, fanout, url_share)
+    dist = parse_length_dist(path_length)
+    first_day = dt.date.fromisoformat(start_date)
+    os.makedirs(out_dir, exist_ok=True)
+
+    written = 0
+    calls = 0
+    call_id = FIRST_CALL_ID
+    per_file = max(1, rows // max(files, 1))
+    for file_no in range(files):
+        target = rows if file_no == files - 1 else written + per_file
+        # Each file covers a consecutive slice of the date range, like the monthly exports
+        day_lo = days * file_no // files
+        day_hi = max(day_lo, days * (file_no + 1) // files - 1)
+        path = os.path.join(out_dir, f"synthetic_{file_no + 1:02d}.csv")
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(HEADER)
+            while written < target:
+                day = first_day + dt.timedelta(days=rng.randint(day_lo, day_hi))
+                date_raw = f"{day.month}/{day.day}/{day.year}"
+                for rid in sample_path(rng, tree, sample_length(rng, dist), off_tree):
+                    w.writerow([call_id, date_raw, rid, tree.parent[rid], tree.text[rid], tree.url[rid] or "NULL"])
+                    written += 1
+                call_id += 1
+                calls += 1
+    return {"rows": written, "calls": calls, "nodes": len(tree)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate synthetic call-center CSVs for benchmarking")
+    parser.add_argument("out_dir", help="Directory to write synthetic_NN.csv files into")
+    parser.add_argument("--rows", type=int, default=100_000, help="Approximate total CSV rows (default: 100000)")
+    parser.add_argument("--files", type=int, default=4, help="Number of CSV files (default: 4)")
+    parser.add_argument("--depth", type=int, default=5, help="Tree depth below the root (default: 5)")
+    parser.add_argument("--fanout", type=int, default=6, help="Maximum children per node (default: 6)")
+    parser.add_argument(
+        "--path-length",
+        default="geometric:5",
+        help="Call path length distribution: geometric:MEAN, uniform:LO,HI or fixed:N (default: geometric:5)",
+    )
+    parser.add_argument("--off-tree", type=float, default=0.02, help="Per-step probability of an off-tree jump (default: 0.02)")
+    parser.add_argument("--url-share", type=float, default=0.05, help="Share of nodes with a popUpURL (default: 0.05)")
+    parser.add_argument("--days", type=int, default=300, help="Days covered by the calls (default: 300)")
+    parser.add_argument("--start-date", default="2025-01-01", help="First call date, YYYY-MM-DD (default: 2025-01-01)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    args = parser.parse_args()
+    try:
+        parse_length_dist(args.path_length)
+    except ValueError as e:
+        parser.error(str(e))
+
+    stats = generate(
+        args.out_dir,
+        args.rows,
+        files=args.files,
+        depth=args.depth,
+        fanout=args.fanout,
+        path_length=args.path_length,
+        off_tree=args.off_tree,
+        url_share=args.url_share,
+        days=args.days,
+        start_date=args.start_date,
+        seed=args.seed,
+    )
+    print(f"Wrote {stats['rows']} rows ({stats['calls']} calls, {stats['nodes']} tree nodes) to {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
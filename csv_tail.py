@@ -0,0 +1,447 @@
+"""
+Append-aware ingestion of a CSV that keeps growing (`generate_button_tree.py --tail`).
+
+A checkpoint next to the per-run outputs (json/<source>.tail.json) records how far the CSV has
+been read and what is needed to continue without reading it again:
+  offset        byte offset just past the last complete record ingested
+  head / tail   digests of the file's first bytes and of the bytes before offset
+  last_call     the last complete call in output order with its rule_ids (it may still be open)
+  open_calls    that call and any calls after it that came from an unterminated last row,
+                with the rule_ids/urls needed to take them back out of the metrics partials
+  paths_tail    byte offset in the call paths file where the open calls start
+  nodes         node table and parent -> children links, so the tree can be rebuilt
+
+A refresh parses only the bytes after offset. It truncates the call paths file at paths_tail
+and writes the last call again, extended by any new rows, followed by the new calls. Run and
+day metrics are recovered by subtracting the open calls from the written partials (see
+metric_partials.subtract_state) and extended with the rewritten calls; only the days those calls
+touch are rewritten. Outputs match a full run over the file as it is (compressed NDJSON is
+written as several members that decompress to the same lines).
+
+A final record without a line terminator is parsed like a full run would, but provisionally:
+the offset stays before it and the checkpoint excludes it, so the next refresh reads it again
+(completed or not) and replaces what it contributed. Rows that would land before a complete
+call are left out until their record is complete.
+
+Cost of a refresh: the appended (and unterminated) bytes are parsed, and the open calls and
+new calls are rewritten. Files that are single JSON objects are rewritten whole: the run's
+metrics partial (one entry per distinct length/node/edge/url/path), the touched day partitions,
+the tree and the checkpoint's node table. Their size follows the number of distinct nodes,
+edges and paths seen rather than the number of rows, but for a long-lived file it is the part
+that does not shrink with the size of the append.
+
+In-place appending needs every new row to belong to the last call or to a call whose id sorts
+after it. Otherwise, or when the CSV shrank or was replaced or the outputs changed since the
+checkpoint, the file is read again from the start.
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import instrumentation
+from generate_button_tree import (
+    NodeRegistry,
+    Row,
+    build_tree,
+    call_day,
+    call_sort_key,
+    checkpoint_path,
+    decode_csv_rows,
+    group_rows,
+    metrics_out_path,
+    run_output_paths,
+    sniff_csv_layout,
+    write_tree,
+)
+from json_stream import format_json_entry
+from metric_partials import UNDATED, DatePartitions, MetricsAccumulator, load_json, subtract_state
+from ndjson_paths import NdjsonEncoder, compress_lines, is_ndjson, remove_other_paths_files, source_of
+from path_store import CallRecord
+
+CHECKPOINT_VERSION = 2
+FINGERPRINT_BYTES = 4096  # bytes hashed at the file start and before the offset
+
+# (call_id, {call_date, weekday}, rule_ids) in output order
+Planned = List[Tuple[str, Dict[str, Any], List[int]]]
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _fingerprint(f: Any, offset: int) -> Tuple[str, str]:
+    f.seek(0)
+    head = f.read(min(offset, FINGERPRINT_BYTES))
+    f.seek(max(0, offset - FINGERPRINT_BYTES))
+    return _digest(head), _digest(f.read(offset - max(0, offset - FINGERPRINT_BYTES)))
+
+
+def complete_prefix(data: bytes) -> int:
+    """Length of the longest prefix of data (which starts on a record) ending at an unquoted newline."""
+    nl = data.rfind(b"\n")
+    if nl < 0:
+        return 0
+    quotes = data.count(b'"', 0, nl)
+    while quotes % 2:
+        prev = data.rfind(b"\n", 0, nl)
+        if prev < 0:
+            return 0
+        quotes -= data.count(b'"', prev, nl)
+        nl = prev
+    return nl + 1
+
+
+def _empty_state(outputs: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "version": CHECKPOINT_VERSION,
+        **outputs,                  # format, compression, tree_out, paths_out
+        "offset": 0,
+        "layout": None,             # [delimiter, column positions] once the header is read
+        "calls": 0,                 # complete calls written (the open part counts last_call only)
+        "last_call": None,
+        "open_calls": [],
+        "size": 0,                  # CSV size and digest of the bytes after offset at the last refresh
+        "pending": None,
+        "paths_tail": 0,
+        "paths_size": 0,
+        "pending_meta": {},         # calls after last_call seen only in malformed rows so far
+        "ndjson_nodes": [],         # NDJSON block node table before the open calls
+        "nodes": [],
+        "children": [],
+        "inconsistent": 0,
+        "outputs": {"roots": 0, "nodes": 0, "calls": 0, "inconsistent": 0},
+    }
+
+
+def load_checkpoint(path: str, f: Any, size: int, expect: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """The checkpoint if it still describes this CSV and these outputs, else None."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as fc:
+            state = json.load(fc)
+    except (OSError, ValueError):
+        return None
+    if state.get("version") != CHECKPOINT_VERSION or any(state.get(k) != v for k, v in expect.items()):
+        return None
+    offset = state["offset"]
+    if offset > size or [state["head"], state["tail"]] != list(_fingerprint(f, offset)):
+        return None
+    paths_out = state["paths_out"]
+    if not os.path.exists(paths_out) or os.path.getsize(paths_out) != state["paths_size"]:
+        return None
+    if not os.path.exists(state["tree_out"]) or not os.path.exists(metrics_out_path(paths_out)):
+        return None
+    return state
+
+
+def _registry(state: Dict[str, Any]) -> NodeRegistry:
+    registry = NodeRegistry()
+    for rid, parent, text, url in state["nodes"]:
+        registry.nodes_by_id[rid] = {"rule_id": rid, "parent_id": parent, "text": text, "url": url}
+        registry.parent_of[rid] = parent
+    for pid, kids in state["children"]:
+        registry.children_map[pid] = set(kids)
+    return registry
+
+
+def _read_rows(data: bytes, state: Dict[str, Any]) -> Tuple[int, Any, List[Row]]:
+    """
+    (bytes consumed, rows of the complete records, rows of an unterminated final record) for
+    data; reads the header first if needed. The final rows are parsed as a full read would.
+    """
+    consumed = 0
+    if state["layout"] is None:
+        # Same header line as sniff_csv_layout on the whole file: up to the first newline
+        nl = data.find(b"\n")
+        if nl < 0:
+            return 0, iter(()), []
+        consumed = nl + 1
+        state["layout"] = list(sniff_csv_layout(io.StringIO(data[:consumed].decode("utf-8-sig"), newline="")))
+    body = data[consumed:]
+    cut = complete_prefix(body)
+    delimiter, positions = state["layout"]
+    reader = csv.reader(io.StringIO(body[:cut].decode("utf-8"), newline=""), delimiter=delimiter)
+    unterminated: List[Row] = []
+    if cut < len(body):
+        try:
+            text = body[cut:].decode("utf-8")
+        except UnicodeDecodeError:
+            text = ""  # cut inside a multi-byte character: wait for the rest of the row
+        unterminated = list(decode_csv_rows(csv.reader(io.StringIO(text, newline=""), delimiter=delimiter), positions))
+    return consumed + cut, decode_csv_rows(reader, positions), unterminated
+
+
+def _plan(state: Dict[str, Any], call_events: Dict[str, Any], call_meta: Dict[str, Dict[str, Any]]) -> Optional[Planned]:
+    """Calls to (re)write from paths_tail on, in output order; None if new rows land before the last call."""
+    last = state["last_call"]
+    last_key = call_sort_key(last["call_id"]) if last else None
+    fresh_ids = []
+    for cid in call_events:
+        if last and cid == last["call_id"]:
+            continue
+        if last and not call_sort_key(cid) > last_key:
+            return None
+        fresh_ids.append(cid)
+    calls: Planned = []
+    if last:
+        meta = {"call_date": last["call_date"], "weekday": last["weekday"]}
+        calls.append((last["call_id"], meta, last["rule_ids"] + list(call_events.get(last["call_id"], ()))))
+    pending = state["pending_meta"]
+    for cid in sorted(fresh_ids, key=call_sort_key):
+        calls.append((cid, pending.get(cid) or call_meta.get(cid, {}), list(call_events[cid])))
+    return calls
+
+
+def _with_unterminated(
+    state: Dict[str, Any], committed: Planned, call_events: Dict[str, Any], call_meta: Dict[str, Dict[str, Any]], rows: List[Row]
+) -> Optional[Planned]:
+    """Calls to write when the unterminated rows are added, or None if they would change a complete call."""
+    extra_events, extra_meta = group_rows(rows, NodeRegistry())
+    events = {cid: list(rids) for cid, rids in call_events.items()}
+    for cid, rids in extra_events.items():
+        events.setdefault(cid, []).extend(rids)
+    meta = {**extra_meta, **call_meta}
+    calls = _plan(state, events, meta)
+    keep = max(len(committed) - 1, 0)
+    if calls is None or calls[:keep] != committed[:keep]:
+        return None
+    return calls
+
+
+def _entry(cid: str, meta: Dict[str, Any], rids: List[int], registry: NodeRegistry) -> Dict[str, Any]:
+    return {
+        "call_id": cid,
+        "call_date": meta.get("call_date"),
+        "weekday": meta.get("weekday"),
+        "path": [registry.step(rid) for rid in rids],
+    }
+
+
+def _open_states(open_calls: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], Dict[str, Dict[str, Any]]]:
+    """Partial metric states of the open calls: for the run and per call day."""
+    acc = MetricsAccumulator()
+    days: Dict[str, MetricsAccumulator] = defaultdict(MetricsAccumulator)
+    for call in open_calls:
+        rids = [rid for rid, _ in call["steps"]]
+        urls = [url for _, url in call["steps"]]
+        for target in (acc, days[call_day(call["call_date"]) or UNDATED]):
+            target.add_call(len(rids), call["weekday"], rids, urls)
+    return acc.to_state(), {day: day_acc.to_state() for day, day_acc in days.items()}
+
+
+def _write_paths(
+    path: str, state: Dict[str, Any], entries: List[Tuple[str, Dict[str, Any]]], fresh: bool, keep: int
+) -> Tuple[int, int, List[Any]]:
+    """
+    Rewrite the call paths file from paths_tail. entries[keep:] are the open calls; returns
+    (byte offset where they start, file size, NDJSON node table before them).
+    """
+    with open(path, "wb" if fresh else "r+b") as f:
+        if not fresh:
+            f.seek(state["paths_tail"])
+            f.truncate()
+        if not is_ndjson(path):
+            tail = f.tell()
+            if fresh:
+                f.write(b"{\n" if entries else b"{}")
+            for i, (cid, entry) in enumerate(entries):
+                if i:
+                    f.write(b",\n")
+                if i == keep:
+                    tail = f.tell()
+                f.write(format_json_entry(cid, entry).encode("utf-8"))
+            if entries:
+                f.write(b"\n}")
+            return tail, f.tell(), []
+
+        # NDJSON: the open calls go in their own (compressed) member so they can be cut off next time
+        enc = NdjsonEncoder([tuple(step) for step in state["ndjson_nodes"]])
+        compression = state["compression"]
+        lines = [enc.header(), enc.block("")] if fresh else []
+        lines.extend(enc.call(_record(cid, entry), _steps(entry)) for cid, entry in entries[:keep])
+        if lines:
+            for chunk in compress_lines(lines, compression):
+                f.write(chunk)
+        tail = f.tell()
+        nodes = enc.nodes()
+        open_lines = [enc.call(_record(cid, entry), _steps(entry)) for cid, entry in entries[keep:]]
+        if open_lines:
+            for chunk in compress_lines(open_lines, compression):
+                f.write(chunk)
+        return tail, f.tell(), [list(step) for step in nodes]
+
+
+def _record(cid: str, entry: Dict[str, Any]) -> CallRecord:
+    return CallRecord("", cid, entry["call_id"], entry["call_date"], entry["weekday"])
+
+
+def _steps(entry: Dict[str, Any]) -> List[Tuple[int, str, Any]]:
+    return [(s["rule_id"], s["text"], s["url"]) for s in entry["path"]]
+
+
+def tail_csv(
+    input_csv: str,
+    json_dir: str,
+    tree_out: Optional[str] = None,
+    paths_out: Optional[str] = None,
+    fmt: str = "json",
+    compression: str = "none",
+    keep_metrics: bool = False,
+) -> Dict[str, Any]:
+    """
+    Bring one CSV's per-run outputs up to date with the rows appended since its checkpoint
+    (everything, on the first run) and return the same summary as process_single_csv plus a
+    "tail" entry: {bytes, pending_bytes, calls_written, rebuilt}. pending_bytes is an
+    unterminated final record, included provisionally and read again next time.
+    """
+    tree_out_path, paths_out_path = run_output_paths(input_csv, json_dir, tree_out, paths_out, fmt, compression)
+    expect = {"format": fmt, "compression": compression, "tree_out": tree_out_path, "paths_out": paths_out_path}
+    ckpt_path = checkpoint_path(paths_out_path)
+    out_dir = os.path.dirname(paths_out_path)
+    source = source_of(os.path.basename(paths_out_path))
+    consumed = 0
+    calls: Planned = []
+
+    with instrumentation.stage("generate.tail", csv=os.path.basename(input_csv), format=fmt) as st, open(input_csv, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        state = load_checkpoint(ckpt_path, f, size, expect)
+        rebuilt = state is None
+        f.seek(state["offset"] if state else 0)
+        unchanged = state is not None and state["size"] == size and state["pending"] == _digest(f.read())
+        while not unchanged:
+            if state is None:
+                state = _empty_state(expect)
+            start = state["offset"]
+            f.seek(start)
+            with instrumentation.stage("read_appended"):
+                consumed, rows, unterminated = _read_rows(f.read(size - start), state)
+                registry = _registry(state)
+                call_events, call_meta = group_rows(rows, registry)
+            committed = _plan(state, call_events, call_meta)
+            if committed is not None:
+                break
+            # A row for an earlier call: the outputs cannot be extended in place
+            state, rebuilt = None, True
+
+        if not unchanged:
+            st.bytes_read = consumed
+            fresh = state["last_call"] is None
+            # The checkpoint keeps the registry as of the last complete record
+            nodes = [[rid, n["parent_id"], n["text"], n["url"]] for rid, n in registry.nodes_by_id.items()]
+            children = [[pid, sorted(kids)] for pid, kids in registry.children_map.items()]
+            inconsistent = state["inconsistent"] + len(registry.inconsistent_parent_ids)
+            calls = committed
+            if unterminated:
+                with_rows = _with_unterminated(state, committed, call_events, call_meta, unterminated)
+                if with_rows is not None:
+                    calls = with_rows
+                    group_rows(unterminated, registry)
+            keep = max(len(committed) - 1, 0)
+
+            with instrumentation.stage("write_paths"):
+                entries = [(cid, _entry(cid, meta, rids, registry)) for cid, meta, rids in calls]
+                paths_tail, paths_size, ndjson_nodes = _write_paths(paths_out_path, state, entries, fresh, keep)
+            with instrumentation.stage("metrics"):
+                parts = DatePartitions()
+                if fresh:
+                    acc = MetricsAccumulator()
+                else:
+                    # Take the open calls back out of the written partials, then add them again extended
+                    run_open, days_open = _open_states(state["open_calls"])
+                    acc = MetricsAccumulator.from_state(subtract_state(load_json(metrics_out_path(paths_out_path)), run_open))
+                    for day, day_open in days_open.items():
+                        written = parts.load(out_dir, source, day).to_state()
+                        parts.days[day] = MetricsAccumulator.from_state(subtract_state(written, day_open))
+                for cid, entry in entries:
+                    day = call_day(entry["call_date"])
+                    acc.add(entry)
+                    (parts.get(day) if fresh else parts.load(out_dir, source, day)).add(entry)
+            with instrumentation.stage("write_partials"):
+                with open(metrics_out_path(paths_out_path), "w", encoding="utf-8") as fo:
+                    json.dump(acc.to_state(), fo, ensure_ascii=False)
+                if fresh:
+                    parts.write(out_dir, source)
+                else:
+                    parts.update(out_dir, source)
+            with instrumentation.stage("build_tree"):
+                tree = build_tree(registry.nodes_by_id, registry.children_map)
+            with instrumentation.stage("write_tree"):
+                with open(tree_out_path, "w", encoding="utf-8") as fo:
+                    write_tree(tree, fo)
+
+            last_call = None
+            final_key = None
+            if committed:
+                last_id, last_meta, last_rids = committed[-1]
+                final_key = call_sort_key(last_id)
+                last_call = {"call_id": last_id, "call_date": last_meta.get("call_date"), "weekday": last_meta.get("weekday"), "rule_ids": last_rids}
+            metas = {**call_meta, **state["pending_meta"]}
+            offset = start + consumed
+            head, tail = _fingerprint(f, offset)
+            f.seek(offset)
+            complete_calls = state["calls"] + len(committed) - (0 if fresh else 1)
+            state.update(
+                offset=offset,
+                head=head,
+                tail=tail,
+                size=size,
+                pending=_digest(f.read(size - offset)),
+                calls=complete_calls,
+                last_call=last_call,
+                open_calls=[
+                    {
+                        "call_date": entry["call_date"],
+                        "weekday": entry["weekday"],
+                        "steps": [[s["rule_id"], s["url"]] for s in entry["path"]],
+                    }
+                    for _, entry in entries[keep:]
+                ],
+                paths_tail=paths_tail,
+                paths_size=paths_size,
+                pending_meta={
+                    cid: meta
+                    for cid, meta in metas.items()
+                    if cid not in call_events and (final_key is None or call_sort_key(cid) > final_key)
+                },
+                ndjson_nodes=ndjson_nodes,
+                nodes=nodes,
+                children=children,
+                inconsistent=inconsistent,
+                outputs={
+                    "roots": len(tree),
+                    "nodes": len(registry.nodes_by_id),
+                    "calls": complete_calls + len(calls) - len(committed),
+                    "inconsistent": state["inconsistent"] + len(registry.inconsistent_parent_ids),
+                },
+            )
+            # Written last (atomically): a refresh interrupted before this starts over next time
+            tmp_path = ckpt_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as fo:
+                json.dump(state, fo, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp_path, ckpt_path)
+            remove_other_paths_files(paths_out_path)
+            st.rows = registry.rows
+            st.wrote_file(paths_out_path)
+        elif keep_metrics:
+            acc = MetricsAccumulator.from_state(load_json(metrics_out_path(paths_out_path)))
+        st.calls = len(calls)
+
+    outputs = state["outputs"]
+    summary = {
+        "input_csv": input_csv,
+        "tree_out": tree_out_path,
+        "paths_out": paths_out_path,
+        "roots": outputs["roots"],
+        "nodes": outputs["nodes"],
+        "calls": outputs["calls"],
+        "inconsistent_parent_ids": outputs["inconsistent"],
+        "tail": {"bytes": consumed, "pending_bytes": size - state["offset"], "calls_written": len(calls), "rebuilt": rebuilt},
+    }
+    if keep_metrics:
+        summary["metrics"] = acc
+    return summary
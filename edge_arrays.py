@@ -0,0 +1,180 @@
+"""
+Optional NumPy backend for the per-step and per-edge analytics in analyze_calls.
+
+Edges are counted from flat rule_id arrays with np.unique instead of one dict update per
+step, and per-node entropy / coverage / top children / tree-edge membership are computed as
+grouped array operations over the (from, to, count) edge table. Results are identical to the
+pure-Python functions: groups and ties keep first-seen order, entropy terms are summed in the
+same order, and log2/pow go through the math module on the distinct values only.
+"""
+import math
+from array import array
+from collections import Counter
+from typing import Any, Dict, List, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; analyze_calls falls back to pure Python
+    np = None
+
+
+def available() -> bool:
+    return np is not None
+
+
+def _first_seen_unique(values: Any) -> Tuple[Any, Any, Any]:
+    """np.unique reordered by first occurrence: (uniques, counts, inverse into that order)."""
+    uniq, first, inverse, counts = np.unique(values, return_index=True, return_inverse=True, return_counts=True)
+    order = np.argsort(first, kind="stable")
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return uniq[order], counts[order], rank[inverse.reshape(-1)]
+
+
+def _apply_math(fn: Any, values: Any) -> Any:
+    # Evaluate with the math module on each distinct value so results are bit-identical
+    uniq, inverse = np.unique(values, return_inverse=True)
+    mapped = np.array([fn(v) for v in uniq.tolist()], dtype=np.float64)
+    return mapped[inverse.reshape(-1)]
+
+
+class StepBuffer:
+    """
+    Collects rule_id sequences call by call and folds them into reach / edge Counters in
+    batches. Counters are updated in first-seen order, exactly as the per-step loop would.
+    """
+
+    def __init__(self, batch_steps: int = 1 << 20) -> None:
+        self.batch_steps = batch_steps
+        self.rids = array("q")
+        self.ends = array("q")  # cumulative end offset of each buffered call
+
+    def __len__(self) -> int:
+        return len(self.rids)
+
+    def add(self, rids: List[int]) -> bool:
+        """Buffer one call; returns True once the batch is full and should be flushed."""
+        self.rids.extend(rids)
+        self.ends.append(len(self.rids))
+        return len(self.rids) >= self.batch_steps
+
+    def flush(self, reach: Counter, edges: Counter) -> None:
+        if not self.rids:
+            return
+        seq = np.frombuffer(self.rids, dtype=np.int64)
+        ends = np.frombuffer(self.ends, dtype=np.int64)
+        nodes, counts, dense = _first_seen_unique(seq)
+        reach.update(dict(zip(nodes.tolist(), counts.tolist())))
+
+        # Consecutive pairs, minus the ones that straddle a call boundary
+        keep = np.ones(max(len(seq) - 1, 0), dtype=bool)
+        keep[ends[:-1][ends[:-1] < len(seq)] - 1] = False
+        if keep.any():
+            n = np.int64(len(nodes))
+            keys = dense[:-1][keep] * n + dense[1:][keep]
+            pairs, pair_counts, _ = _first_seen_unique(keys)
+            src = nodes[pairs // n].tolist()
+            dst = nodes[pairs % n].tolist()
+            edges.update(dict(zip(zip(src, dst), pair_counts.tolist())))
+
+        self.rids = array("q")
+        self.ends = array("q")
+
+
+class EdgeTable:
+    """
+    (from, to, count) arrays grouped by source node. Groups follow the first-seen order of
+    their source and edges inside a group keep their first-seen order, matching the nested
+    Counters that MetricsAccumulator.branch_distribution() builds.
+    """
+
+    def __init__(self, edges: Counter) -> None:
+        m = len(edges)
+        src = np.fromiter((a for a, _ in edges), dtype=np.int64, count=m)
+        dst = np.fromiter((b for _, b in edges), dtype=np.int64, count=m)
+        cnt = np.fromiter(edges.values(), dtype=np.int64, count=m)
+
+        self.sources, self.degree, group = _first_seen_unique(src) if m else (src, src, src)
+        order = np.argsort(group, kind="stable")
+        self.src = src[order]
+        self.dst = dst[order]
+        self.count = cnt[order]
+        self.group = group[order]
+        self.starts = np.concatenate(([0], np.cumsum(self.degree)[:-1])).astype(np.int64) if m else src
+        self.totals = np.add.reduceat(self.count, self.starts) if m else cnt
+
+    def __len__(self) -> int:
+        return len(self.sources)
+
+    def transitions(self) -> Dict[int, int]:
+        return dict(zip(self.sources.tolist(), self.totals.tolist()))
+
+    def entropy_complexity(self) -> Dict[int, Dict[str, float]]:
+        if not len(self):
+            return {}
+        p = self.count / self.totals[self.group]
+        terms = p * _apply_math(math.log2, p)
+        # Sum each group's terms left to right (as the Python loop does), vectorized across groups
+        by_degree = np.argsort(-self.degree, kind="stable")
+        deg_sorted = self.degree[by_degree]
+        starts = self.starts[by_degree]
+        H = np.zeros(len(self))
+        for k in range(int(deg_sorted[0]) if len(deg_sorted) else 0):
+            active = int(np.searchsorted(-deg_sorted, -k, side="left"))  # groups with degree > k
+            H[:active] -= terms[starts[:active] + k]
+        entropy = np.empty(len(self))
+        entropy[by_degree] = H
+        perplexity = _apply_math(lambda h: math.pow(2, h), entropy)
+        out: Dict[int, Dict[str, float]] = {}
+        for rid, h, ppl, deg in zip(self.sources.tolist(), entropy.tolist(), perplexity.tolist(), self.degree.tolist()):
+            out[rid] = {"entropy_bits": h, "perplexity": ppl, "branching_factor": float(deg)}
+        return out
+
+    def _ranked(self) -> Any:
+        # Edge order within each group by descending count, ties in first-seen order
+        return np.lexsort((np.arange(len(self.count)), -self.count, self.group))
+
+    def coverage_ratio(self) -> Dict[int, Dict[str, float]]:
+        if not len(self):
+            return {}
+        ranked = self.count[self._ranked()]
+        top1 = ranked[self.starts]
+        second = np.where(self.degree > 1, ranked[np.minimum(self.starts + 1, len(ranked) - 1)], 0)
+        top1_cov = (top1 / self.totals).tolist()
+        top2_cov = ((top1 + second) / self.totals).tolist()
+        return {
+            rid: {"top1_coverage": c1, "top2_coverage": c2}
+            for rid, c1, c2 in zip(self.sources.tolist(), top1_cov, top2_cov)
+        }
+
+    def top_children(self, k: int) -> Dict[int, List[Tuple[int, int]]]:
+        """Per source node, its k most frequent next steps (Counter.most_common order)."""
+        if not len(self):
+            return {}
+        ranked = self._ranked()
+        pos = np.arange(len(ranked)) - self.starts[self.group[ranked]]
+        sel = ranked[pos < k]
+        out: Dict[int, List[Tuple[int, int]]] = {rid: [] for rid in self.sources.tolist()}
+        for a, b, c in zip(self.src[sel].tolist(), self.dst[sel].tolist(), self.count[sel].tolist()):
+            out[a].append((b, c))
+        return out
+
+
+def off_tree_edges(edges: Counter, children: Dict[int, List[int]]) -> Counter:
+    """Observed edges that are not parent->child tree edges, in first-seen order."""
+    if not edges:
+        return Counter()
+    m = len(edges)
+    src = np.fromiter((a for a, _ in edges), dtype=np.int64, count=m)
+    dst = np.fromiter((b for _, b in edges), dtype=np.int64, count=m)
+    cnt = np.fromiter(edges.values(), dtype=np.int64, count=m)
+    tree_src = np.fromiter((p for p, ch in children.items() for _ in ch), dtype=np.int64)
+    tree_dst = np.fromiter((c for ch in children.values() for c in ch), dtype=np.int64)
+    # Pack (from, to) into one sortable key for membership tests
+    both = np.concatenate((src, dst, tree_src, tree_dst))
+    base = np.int64(both.max() - both.min() + 1) if len(both) else np.int64(1)
+    lo = both.min() if len(both) else 0
+    keys = (src - lo) * base + (dst - lo)
+    tree_keys = (tree_src - lo) * base + (tree_dst - lo)
+    off = ~np.isin(keys, tree_keys)
+    return Counter(dict(zip(zip(src[off].tolist(), dst[off].tolist()), cnt[off].tolist())))
@@ -0,0 +1,99 @@
+"""
+Iterative build / flatten / merge of rule_id forests, shared by generate_button_tree,
+aggregate_runs and analyze_calls.
+
+A forest is the nested JSON form ([{rule_id, text, url, children: [...]}, ...]); its flat
+form is (nodes, parent_of, children):
+  nodes      rule_id -> {rule_id, text, url}, in first-seen preorder
+  parent_of  rule_id -> first-seen parent (0 for roots)
+  children   parent_id -> set of child ids, keys in first-seen order
+No function recurses, so depth is bounded only by memory. Building sorts each node's
+children once (by text, then rule_id); total work is O(n log n) in the number of links.
+"""
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+Flat = Tuple[Dict[int, Dict[str, Any]], Dict[int, int], Dict[int, Set[int]]]
+
+
+def flatten_forest(tree: List[Dict[str, Any]]) -> Flat:
+    """Flatten a nested forest in preorder; a node seen again keeps its first text/url/parent."""
+    nodes: Dict[int, Dict[str, Any]] = {}
+    parent_of: Dict[int, int] = {}
+    children: Dict[int, Set[int]] = defaultdict(set)
+    # (node, parent_id) pairs; children are pushed reversed so they pop in document order
+    stack = [(root, 0) for root in reversed(tree)]  # roots have parent_id 0
+    while stack:
+        node, parent = stack.pop()
+        rid = int(node["rule_id"])
+        if rid not in nodes:
+            nodes[rid] = {"rule_id": rid, "text": node.get("text") or "", "url": node.get("url")}
+            parent_of[rid] = parent
+        children[parent].add(rid)
+        kids = node.get("children")
+        if kids:
+            stack.extend((child, rid) for child in reversed(kids))
+    return nodes, parent_of, children
+
+
+def merge_flat(
+    into: Flat,
+    node_rows: Iterable[Tuple[int, str, Any, int]],
+    child_rows: Iterable[Tuple[int, Iterable[int]]],
+) -> Flat:
+    """
+    Merge (rule_id, text, url, parent) rows and (parent, child ids) rows into a flat forest.
+    First-seen parent/text/url win; a missing text or url is filled from later rows.
+    """
+    nodes, parent_of, children = into
+    for rid, text, url, parent in node_rows:
+        node = nodes.get(rid)
+        if node is None:
+            nodes[rid] = {"rule_id": rid, "text": text, "url": url}
+            parent_of[rid] = parent
+            continue
+        if not node.get("text") and text:
+            node["text"] = text
+        if node.get("url") is None and url is not None:
+            node["url"] = url
+    for pid, child_ids in child_rows:
+        children[pid].update(child_ids)
+    return into
+
+
+def sorted_children(nodes: Dict[int, Dict[str, Any]], children: Dict[int, Iterable[int]]) -> Dict[int, List[int]]:
+    """Each parent's children ordered by (text, rule_id), computed once per parent."""
+    return {pid: sorted(ch, key=lambda rid: (nodes[rid]["text"], rid)) for pid, ch in children.items()}
+
+
+def build_forest(nodes: Dict[int, Dict[str, Any]], children: Dict[int, Iterable[int]], roots: Iterable[int]) -> List[Dict[str, Any]]:
+    """
+    Nested forest from flat form. Roots and every child list are ordered by (text, rule_id).
+    A node linked under several parents is expanded under each; a link back to a node on the
+    current path (a cycle) is dropped instead of expanding forever.
+    """
+    ordered = sorted_children(nodes, children)
+    forest: List[Dict[str, Any]] = []
+    for root in sorted(roots, key=lambda rid: (nodes[rid]["text"], rid)):
+        top = _node_dict(nodes[root], root)
+        forest.append(top)
+        on_path = {root}
+        stack = [(top, root, iter(ordered.get(root, ())))]
+        while stack:
+            out, rid, kids = stack[-1]
+            for child in kids:
+                if child in on_path:
+                    continue
+                child_out = _node_dict(nodes[child], child)
+                out["children"].append(child_out)
+                on_path.add(child)
+                stack.append((child_out, child, iter(ordered.get(child, ()))))
+                break
+            else:
+                stack.pop()
+                on_path.discard(rid)
+    return forest
+
+
+def _node_dict(node: Dict[str, Any], rid: int) -> Dict[str, Any]:
+    return {"rule_id": rid, "text": node["text"], "url": node.get("url"), "children": []}
@@ -1,11 +1,51 @@
 import csv
 import json
 import argparse
+import heapq
+import io
+import itertools
+import mmap
+import multiprocessing
 import os
+import pickle
 import re
+import tempfile
 import datetime as dt
-from collections import defaultdict, OrderedDict
-from typing import Dict, List, Optional, Tuple, Set, Any
+import functools
+from array import array
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple, Set, Any, Iterable, Iterator, IO
+
+import instrumentation
+from forest import build_forest
+from json_stream import write_json_object
+from metric_partials import PARTIALS_SUFFIX, DatePartitions, MetricsAccumulator
+from ndjson_paths import COMPRESSIONS, is_ndjson, remove_other_paths_files, source_of, write_ndjson_paths
+from path_store import CallRecord, PathStore
+
+# Tail-mode checkpoint written next to the per-run outputs (see csv_tail)
+CHECKPOINT_SUFFIX = ".tail.json"
+# Rows buffered per sorted run before spilling to disk in streaming mode
+DEFAULT_SPILL_ROWS = 1_000_000
+# Smallest byte range worth a parse worker (--parse-workers); smaller files are read sequentially
+MIN_RANGE_BYTES = 8 << 20
+# How far past a split point to look for the next call_id change
+CALL_ALIGN_BYTES = 1 << 20
+_QUOTE_BLOCK = 16 << 20
+# Sentinel record appended after a byte range to detect a split inside a quoted field
+_RANGE_END = "\ue000range-end\ue000"
+
+# One parsed CSV row: (call_id, call_date_raw, rule_id or None if malformed, parent_id, text, url)
+Row = Tuple[str, str, Optional[int], int, Optional[str], Optional[str]]
+
+
+# Columns read from each CSV, in Row order
+CSV_COLUMNS = ("call_id", "call_date", "rule_id", "rule_parent_id", "rule_text", "popUpURL")
+# Delimiters tried when sniffing a file's header (the first that yields the expected columns wins)
+CSV_DELIMITERS = (",", ";", "\t", "|")
+# Accepted call_date formats, in priority order (ambiguous dates resolve to the first match)
+DATE_FORMATS = ("%m/%d/%Y", "%m/%d/%y", "%d/%m/%Y", "%d/%m/%y", "%Y-%m-%d", "%d-%m-%Y", "%m-%d-%Y")
 
 
 def coerce_null(value: Optional[str]) -> Optional[str]:
@@ -17,29 +57,756 @@ def coerce_null(value: Optional[str]) -> Optional[str]:
     return s
 
 
+@functools.lru_cache(maxsize=None)
+def _date_formats_for(shape: Tuple[str, int, int]) -> Tuple[str, ...]:
+    """
+    Formats that can match a date of this shape (separator, digits in first/last field).
+    Only formats whose literal separator or 4-digit/2-digit year width rule out a match are
+    dropped, so the first format that parses is the same as when trying all of them.
+    """
+    sep, first_len, last_len = shape
+    out = []
+    for fmt in DATE_FORMATS:
+        if sep not in fmt:
+            continue
+        if fmt.startswith("%Y") and first_len != 4:
+            continue
+        if fmt.endswith("%Y") and last_len != 4:
+            continue
+        if fmt.endswith("%y") and last_len != 2:
+            continue
+        out.append(fmt)
+    return tuple(out)
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_date_maybe(s: Optional[str]) -> Optional[dt.date]:
+    # Memoized: a file has a few hundred distinct dates, and every call carries one
+    if not s:
+        return None
+    s = s.strip()
+    sep = "/" if "/" in s else "-"
+    fields = s.split(sep)
+    for fmt in _date_formats_for((sep, len(fields[0]), len(fields[-1]))):
+        try:
+            return dt.datetime.strptime(s, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+@functools.lru_cache(maxsize=65536)
+def call_day(call_date_raw: Optional[str]) -> Optional[str]:
+    # ISO day used to partition per-source metrics (see metric_partials.DatePartitions)
+    parsed = parse_date_maybe(call_date_raw)
+    return parsed.isoformat() if parsed else None
+
+
+def call_meta_for(call_date_raw: str) -> Dict[str, Any]:
+    parsed = parse_date_maybe(call_date_raw)
+    weekday = parsed.isoweekday() if parsed else None  # 1=Mon .. 7=Sun
+    return {"call_date": call_date_raw or None, "weekday": weekday}
+
+
+def call_sort_key(x: str) -> Tuple[int, Any]:
+    # Sort call_ids numerically when possible for readability
+    try:
+        return (0, int(x))
+    except Exception:
+        return (1, x)
+
+
+def run_output_paths(
+    input_csv: str,
+    json_dir: str,
+    tree_out: Optional[str] = None,
+    paths_out: Optional[str] = None,
+    fmt: str = "json",
+    compression: str = "none",
+) -> Tuple[str, str]:
+    csv_basename = os.path.basename(input_csv)
+    csv_stem = os.path.splitext(csv_basename)[0]
+    safe_stem = re.sub(r"[^A-Za-z0-9_.-]+", "_", csv_stem).strip("_")
+    tree_out_path = tree_out or os.path.join(json_dir, f"{safe_stem}.button_tree.json")
+    paths_name = f"{safe_stem}.call_paths.json" if fmt == "json" else f"{safe_stem}.call_paths.ndjson{COMPRESSIONS[compression]}"
+    paths_out_path = paths_out or os.path.join(json_dir, paths_name)
+    return tree_out_path, paths_out_path
+
+
+def metrics_out_path(paths_out_path: str) -> str:
+    # Partial metrics state lives next to the per-run call paths
+    return os.path.join(os.path.dirname(paths_out_path), source_of(os.path.basename(paths_out_path)) + PARTIALS_SUFFIX)
+
+
+def checkpoint_path(paths_out_path: str) -> str:
+    # Tail-mode checkpoint (byte offset, open call, node table) for this run's source
+    return os.path.join(os.path.dirname(paths_out_path), source_of(os.path.basename(paths_out_path)) + CHECKPOINT_SUFFIX)
+
+
+def write_run_paths(items: Iterable[Tuple[str, Dict[str, Any]]], path: str) -> int:
+    """Write per-run call paths as indent=2 JSON or NDJSON (chosen by the file name). Returns calls written."""
+    if is_ndjson(path):
+        calls = (
+            (
+                CallRecord("", cid, entry["call_id"], entry["call_date"], entry["weekday"]),
+                [(s["rule_id"], s["text"], s["url"]) for s in entry["path"]],
+            )
+            for cid, entry in items
+        )
+        return write_ndjson_paths(path, calls)
+    with open(path, "w", encoding="utf-8") as fo:
+        return write_json_object(items, fo)
+
+
+def sniff_csv_layout(f: IO[str]) -> Tuple[str, List[Optional[int]]]:
+    """
+    Read the header line and return (delimiter, column positions in CSV_COLUMNS order).
+    Missing columns get None; a repeated column name maps to its last position, like DictReader.
+    """
+    header_line = f.readline()
+    delimiter = ","
+    header: List[str] = []
+    for candidate in CSV_DELIMITERS:
+        fields = next(csv.reader([header_line], delimiter=candidate), [])
+        if "call_id" in fields and "rule_id" in fields:
+            delimiter, header = candidate, fields
+            break
+    else:
+        header = next(csv.reader([header_line]), [])
+    position = {name: i for i, name in enumerate(header)}
+    return delimiter, [position.get(col) for col in CSV_COLUMNS]
+
+
+def _to_int(value: str) -> Optional[int]:
+    # Slow path for values str.isdecimal() rejects (signs, inner spaces, junk)
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def iter_csv_rows(input_csv: str) -> Iterator[Row]:
+    # Read CSV (utf-8-sig handles BOM if present); columns are located once from the header
+    with open(input_csv, "r", encoding="utf-8-sig", newline="") as f:
+        delimiter, positions = sniff_csv_layout(f)
+        yield from decode_csv_rows(csv.reader(f, delimiter=delimiter), positions)
+
+
+def decode_csv_rows(reader: Iterable[List[str]], positions: List[Optional[int]]) -> Iterator[Row]:
+    """Turn raw CSV records into Rows, given the column positions from sniff_csv_layout."""
+    # Short rows are padded with empty strings; absent columns read a trailing "" (index -1)
+    width = max([p for p in positions if p is not None], default=-1) + 1
+    pad = [""] * width
+    missing = None in positions
+    i_call, i_date, i_rule, i_parent, i_text, i_url = (-1 if p is None else p for p in positions)
+    for row in reader:
+        if not row:
+            continue  # blank line (DictReader skips these too)
+        if len(row) < width:
+            row.extend(pad[len(row):])
+        if missing:
+            row.append("")
+        call_id = row[i_call].strip()
+        call_date_raw = row[i_date].strip()
+        # Parse IDs
+        rule_s = row[i_rule].strip()
+        rule_id = int(rule_s) if rule_s.isdecimal() else _to_int(rule_s)
+        if rule_id is None:
+            # Malformed: still counts for call metadata, but carries no step
+            yield call_id, call_date_raw, None, 0, None, None
+            continue
+        parent_s = row[i_parent].strip()
+        parent_id = int(parent_s) if parent_s.isdecimal() else (_to_int(parent_s) or 0)
+        text = row[i_text].strip()
+        url = row[i_url].strip()
+        yield (
+            call_id,
+            call_date_raw,
+            rule_id,
+            parent_id,
+            None if not text or (len(text) == 4 and text.upper() == "NULL") else text,
+            None if not url or (len(url) == 4 and url.upper() == "NULL") else url,
+        )
+
+
+class NodeRegistry:
+    """Node table and parent->children links accumulated from CSV rows (first-seen attributes win)."""
+
+    def __init__(self) -> None:
+        self.nodes_by_id: Dict[int, Dict[str, Any]] = {}       # rule_id -> node
+        self.parent_of: Dict[int, int] = {}                    # rule_id -> parent_id (first-seen)
+        self.children_map: Dict[int, Set[int]] = defaultdict(set)  # parent_id -> set(child_id)
+        # Optional data quality flags
+        self.inconsistent_parent_ids: List[Tuple[int, int, int]] = []  # (rule_id, first_parent, seen_parent)
+        self.rows = 0  # CSV data rows read, malformed ones included
+
+    def add(self, rule_id: int, parent_id: int, text: Optional[str], url: Optional[str]) -> None:
+        # Register node (prefer first-seen attributes if repeated)
+        if rule_id not in self.nodes_by_id:
+            self.nodes_by_id[rule_id] = {
+                "rule_id": rule_id,
+                "parent_id": parent_id,
+                "text": text or "",
+                "url": url,
+            }
+            self.parent_of[rule_id] = parent_id
+        else:
+            if self.parent_of[rule_id] != parent_id:
+                self.inconsistent_parent_ids.append((rule_id, self.parent_of[rule_id], parent_id))
+            # Keep first seen parent/text/url for stability
+
+        # Build structure link
+        self.children_map[parent_id].add(rule_id)
+
+    def step(self, rule_id: int) -> Dict[str, Any]:
+        n = self.nodes_by_id[rule_id]
+        return {"rule_id": rule_id, "text": n["text"], "url": n["url"]}
+
+
 def build_tree(nodes_by_id: Dict[int, Dict[str, Any]], children_map: Dict[int, Set[int]]) -> List[Dict[str, Any]]:
     """
     Build a hierarchical tree (or forest) from nodes and parent->children mapping.
-    Roots are nodes whose parent_id == 0 (as seen in the dataset).
+    Roots are nodes whose parent_id == 0 (as seen in the dataset); children are sorted by
+    text (Hebrew-safe) then rule_id for determinism.
+    """
+    roots = [rid for rid, n in nodes_by_id.items() if n["parent_id"] == 0]
+    return build_forest(nodes_by_id, children_map, roots)
+
+
+def group_rows(rows: Iterable[Row], registry: NodeRegistry) -> Tuple[Dict[str, array], Dict[str, Dict[str, Any]]]:
+    """Register nodes and collect each call's rule_ids (file order) and first-row metadata."""
+    call_events: Dict[str, array] = defaultdict(lambda: array("q"))  # call_id -> rule_ids in file order
+    call_meta: Dict[str, Dict[str, Any]] = {}  # call_id -> {call_date, weekday}
+    n = 0
+    for n, (call_id, call_date_raw, rule_id, parent_id, text, url) in enumerate(rows, 1):
+        if call_id and call_id not in call_meta:
+            call_meta[call_id] = call_meta_for(call_date_raw)
+        if rule_id is None:
+            continue
+        registry.add(rule_id, parent_id, text, url)
+        # Preserve file order per call
+        call_events[call_id].append(rule_id)
+    registry.rows += n
+    return call_events, call_meta
+
+
+def build_store(registry: NodeRegistry, call_events: Dict[str, array], call_meta: Dict[str, Dict[str, Any]]) -> PathStore:
+    """Per-call paths in call order, in the compact store (text/url interned once per rule_id)."""
+    call_paths = PathStore()
+    step_of: Dict[int, int] = {
+        rid: call_paths.nodes.intern(rid, n["text"], n["url"]) for rid, n in registry.nodes_by_id.items()
+    }
+    for cid in sorted(call_events, key=call_sort_key):
+        meta = call_meta.get(cid, {})
+        call_paths.add_call(
+            CallRecord("", cid, cid, meta.get("call_date"), meta.get("weekday")),
+            (step_of[rid] for rid in call_events.pop(cid) if rid in step_of),
+        )
+    return call_paths
+
+
+def ingest_in_memory(input_csv: str, registry: NodeRegistry) -> PathStore:
+    """Read the whole CSV, then group rows per call and sort calls."""
+    call_events, call_meta = group_rows(iter_csv_rows(input_csv), registry)
+    return build_store(registry, call_events, call_meta)
+
+
+class _RecordCursor:
+    """
+    Walks forward over a memory-mapped CSV, tracking the parity of quote characters since the
+    file start: a newline seen with an even count is outside any quoted field.
+    """
+
+    def __init__(self, mm: mmap.mmap) -> None:
+        self.mm = mm
+        self.pos = 0
+        self.quotes = 0
+
+    def _advance(self, to: int) -> None:
+        mm = self.mm
+        for lo in range(self.pos, to, _QUOTE_BLOCK):
+            self.quotes += mm[lo:min(to, lo + _QUOTE_BLOCK)].count(b'"')
+        self.pos = max(self.pos, to)
+
+    def record_start(self, target: int) -> int:
+        """First record start at or after target (just past an unquoted newline), or EOF."""
+        mm = self.mm
+        self._advance(target)
+        while not (self.quotes % 2 == 0 and mm[self.pos - 1:self.pos] == b"\n"):
+            nl = mm.find(b"\n", self.pos)
+            if nl == -1:
+                self._advance(len(mm))
+                return self.pos
+            self._advance(nl + 1)
+        return self.pos
+
+    def call_id_at(self, pos: int, delimiter: str, i_call: int) -> Optional[str]:
+        end = self.mm.find(b"\n", pos)
+        line = self.mm[pos:end if end != -1 else len(self.mm)].decode("utf-8", errors="replace")
+        fields = next(csv.reader([line], delimiter=delimiter), [])
+        return fields[i_call].strip() if i_call < len(fields) else None
+
+
+def split_csv_ranges(
+    input_csv: str, parts: int, min_range_bytes: int = MIN_RANGE_BYTES
+) -> Optional[Tuple[str, List[Optional[int]], List[Tuple[int, int]]]]:
+    """
+    (delimiter, column positions, byte ranges) covering the data rows of a CSV in up to `parts`
+    ranges. Every range starts on a record boundary (quote-parity aware) and, when one is found
+    within CALL_ALIGN_BYTES, where the call_id changes. None when the file is too small to split.
+    """
+    size = os.path.getsize(input_csv)
+    parts = min(parts, size // max(min_range_bytes, 1))
+    if parts < 2:
+        return None
+    with open(input_csv, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        cursor = _RecordCursor(mm)
+        data_start = cursor.record_start(1)
+        delimiter, positions = sniff_csv_layout(io.StringIO(mm[:data_start].decode("utf-8-sig"), newline=""))
+        i_call = positions[0]
+        bounds = [data_start]
+        for k in range(1, parts):
+            target = data_start + (size - data_start) * k // parts
+            if target <= cursor.pos:
+                continue
+            start = cursor.record_start(target)
+            if i_call is not None and start < size:
+                # Prefer to cut between calls so most calls stay inside one range
+                first_call = cursor.call_id_at(start, delimiter, i_call)
+                pos = start
+                while pos < size and pos - start <= CALL_ALIGN_BYTES:
+                    if cursor.call_id_at(pos, delimiter, i_call) != first_call:
+                        start = pos
+                        break
+                    pos = cursor.record_start(pos + 1)
+            if bounds[-1] < start < size:
+                bounds.append(start)
+        bounds.append(size)
+    ranges = [(lo, hi) for lo, hi in zip(bounds, bounds[1:]) if hi > lo]
+    return (delimiter, positions, ranges) if len(ranges) > 1 else None
+
+
+def _parse_csv_range(job: Tuple[str, int, int, str, List[Optional[int]], bool]) -> Dict[str, Any]:
+    """Worker: group one byte range. `closed` is False if the range ended inside a quoted field."""
+    input_csv, start, end, delimiter, positions, last = job
+    with instrumentation.stage("parse_range", csv=os.path.basename(input_csv), start=start, end=end) as st:
+        state = {"closed": last}
+        registry = NodeRegistry()
+        call_events, call_meta = group_rows(
+            decode_csv_rows(_until_range_end(_range_reader(input_csv, start, end, delimiter, last), state), positions), registry
+        )
+        st.bytes_read = end - start
+        # Calls go back as flat arrays (call i spans rids[offsets[i]:offsets[i + 1]]): cheap to pickle
+        rids = array("q")
+        offsets = array("q", [0])
+        for events in call_events.values():
+            rids.extend(events)
+            offsets.append(len(rids))
+    return {
+        "closed": state["closed"],
+        "nodes": registry.nodes_by_id,
+        "children": dict(registry.children_map),
+        "inconsistent": registry.inconsistent_parent_ids,
+        "rows": registry.rows,
+        "call_ids": list(call_events),
+        "offsets": offsets,
+        "rids": rids,
+        "meta": call_meta,
+    }
+
+
+def _range_reader(input_csv: str, start: int, end: int, delimiter: str, last: bool) -> Iterator[List[str]]:
+    with open(input_csv, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        text = mm[start:end].decode("utf-8")
+    lines: Iterable[str] = io.StringIO(text, newline="")
+    if not last:
+        # A record after the range's last newline; swallowed if that newline was inside quotes
+        lines = itertools.chain(lines, [_RANGE_END + "\n"])
+    return csv.reader(lines, delimiter=delimiter)
+
+
+def _until_range_end(reader: Iterator[List[str]], state: Dict[str, bool]) -> Iterator[List[str]]:
+    for row in reader:
+        if len(row) == 1 and row[0] == _RANGE_END:
+            state["closed"] = True
+            return
+        yield row
+
+
+def ingest_parallel(
+    input_csv: str, registry: NodeRegistry, workers: int, min_range_bytes: int = MIN_RANGE_BYTES
+) -> PathStore:
+    """
+    ingest_in_memory over byte ranges parsed in worker processes, merged in file order: same
+    node table (first-seen attributes), inconsistency list, call order and paths. Falls back to
+    the sequential read when the file is too small to split or a split landed inside quotes.
+    """
+    split = split_csv_ranges(input_csv, workers, min_range_bytes) if workers > 1 else None
+    if split is None:
+        return ingest_in_memory(input_csv, registry)
+    delimiter, positions, ranges = split
+    jobs = [(input_csv, lo, hi, delimiter, positions, i == len(ranges) - 1) for i, (lo, hi) in enumerate(ranges)]
+    with instrumentation.stage("parse_ranges", ranges=len(ranges)):
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=ctx) as pool:
+            parts = list(pool.map(_parse_csv_range, jobs))
+    if not all(part["closed"] for part in parts):
+        print(f"Warning: {os.path.basename(input_csv)} could not be split on record boundaries; parsing sequentially")
+        return ingest_in_memory(input_csv, registry)
+
+    with instrumentation.stage("merge_ranges"):
+        call_events: Dict[str, array] = {}
+        call_meta: Dict[str, Dict[str, Any]] = {}
+        for job, part in zip(jobs, parts):
+            conflict = False
+            for rid, node in part["nodes"].items():
+                if rid not in registry.nodes_by_id:
+                    registry.nodes_by_id[rid] = node
+                    registry.parent_of[rid] = node["parent_id"]
+                elif registry.parent_of[rid] != node["parent_id"]:
+                    conflict = True
+            for pid, kids in part["children"].items():
+                registry.children_map[pid].update(kids)
+            registry.rows += part["rows"]
+            if conflict:
+                # A rule_id first seen earlier under another parent: recount this range's rows
+                _, lo, hi, *_ = job
+                rows = decode_csv_rows(_range_reader(input_csv, lo, hi, delimiter, True), positions)
+                registry.inconsistent_parent_ids.extend(
+                    (rid, registry.parent_of[rid], pid)
+                    for _, _, rid, pid, _, _ in rows
+                    if rid is not None and registry.parent_of[rid] != pid
+                )
+            else:
+                registry.inconsistent_parent_ids.extend(part["inconsistent"])
+            rids, offsets = part["rids"], part["offsets"]
+            for i, cid in enumerate(part["call_ids"]):
+                seen = call_events.get(cid)
+                if seen is None:
+                    call_events[cid] = rids[offsets[i]:offsets[i + 1]]
+                else:
+                    seen.extend(rids[offsets[i]:offsets[i + 1]])
+            for cid, meta in part["meta"].items():
+                call_meta.setdefault(cid, meta)
+    return build_store(registry, call_events, call_meta)
+
+
+class _NotGrouped(Exception):
+    """Raised by the grouped streaming pass when call_ids are not contiguous and ascending."""
+
+
+def _path_entry(cid: str, meta: Dict[str, Any], rids: List[int], registry: NodeRegistry) -> Dict[str, Any]:
+    return {
+        "call_id": cid,
+        "call_date": meta.get("call_date"),
+        "weekday": meta.get("weekday"),
+        "path": [registry.step(rid) for rid in rids],
+    }
+
+
+def _stream_grouped(input_csv: str, registry: NodeRegistry) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Emit each call as soon as its rows end. Only valid when every call's rows are contiguous
+    and call keys strictly ascend (so the output order equals the sorted order); otherwise
+    raises _NotGrouped and the caller falls back to the external sort.
+    """
+    cur_cid: Optional[str] = None
+    cur_meta: Dict[str, Any] = {}
+    cur_rids: List[int] = []
+    last_key: Optional[Tuple[int, Any]] = None
+    n = 0
+    for n, (call_id, call_date_raw, rule_id, parent_id, text, url) in enumerate(iter_csv_rows(input_csv), 1):
+        if call_id != cur_cid:
+            key = call_sort_key(call_id)
+            if last_key is not None and not key > last_key:
+                raise _NotGrouped(call_id)
+            if cur_rids:
+                yield cur_cid, _path_entry(cur_cid, cur_meta, cur_rids, registry)
+            cur_cid, last_key = call_id, key
+            cur_meta = call_meta_for(call_date_raw) if call_id else {}
+            cur_rids = []
+        if rule_id is None:
+            continue
+        registry.add(rule_id, parent_id, text, url)
+        cur_rids.append(rule_id)
+    registry.rows += n
+    if cur_rids:
+        yield cur_cid, _path_entry(cur_cid, cur_meta, cur_rids, registry)
+
+
+def _spill_run(records: List[Tuple[Any, ...]], spill_dir: str) -> str:
+    records.sort()
+    fd, path = tempfile.mkstemp(suffix=".run", dir=spill_dir)
+    with os.fdopen(fd, "wb") as f:
+        for i in range(0, len(records), 4096):
+            pickle.dump(records[i:i + 4096], f, protocol=pickle.HIGHEST_PROTOCOL)
+    records.clear()
+    return path
+
+
+def _read_run(path: str) -> Iterator[Tuple[Any, ...]]:
+    with open(path, "rb") as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
+
+
+def _stream_external(input_csv: str, registry: NodeRegistry, spill_dir: str, spill_rows: int) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    External merge-sort grouping for files whose calls are interleaved. Rows are spilled
+    as sorted runs of (call key, call_id, seq, rule_id, call_date) and merged back in call order.
+    """
+    buf: List[Tuple[Any, ...]] = []
+    runs: List[str] = []
+    seq = 0
+    for call_id, call_date_raw, rule_id, parent_id, text, url in iter_csv_rows(input_csv):
+        seq += 1
+        if rule_id is not None:
+            registry.add(rule_id, parent_id, text, url)
+        buf.append((call_sort_key(call_id), call_id, seq, rule_id, call_date_raw))
+        if len(buf) >= spill_rows:
+            runs.append(_spill_run(buf, spill_dir))
+    registry.rows += seq
+    if runs:
+        if buf:
+            runs.append(_spill_run(buf, spill_dir))
+        merged: Iterator[Tuple[Any, ...]] = heapq.merge(*[_read_run(r) for r in runs])
+    else:
+        buf.sort()
+        merged = iter(buf)
+
+    # Calls whose ids share a sort key (e.g. "7" and "07") keep first-step file order, like sorted()
+    pending: List[Tuple[int, str, Dict[str, Any], List[int]]] = []
+    pending_key: Any = None
+    cur_cid: Optional[str] = None
+    cur_meta: Dict[str, Any] = {}
+    cur_rids: List[int] = []
+    first_step_seq = 0
+
+    def flush() -> Iterator[Tuple[str, Dict[str, Any]]]:
+        pending.sort(key=lambda t: t[0])
+        for _, cid, meta, rids in pending:
+            yield cid, _path_entry(cid, meta, rids, registry)
+        pending.clear()
+
+    for key, call_id, row_seq, rule_id, call_date_raw in merged:
+        if call_id != cur_cid or key != pending_key:
+            if cur_rids:
+                pending.append((first_step_seq, cur_cid, cur_meta, cur_rids))
+            if key != pending_key:
+                yield from flush()
+                pending_key = key
+            # Rows are in seq order within a call, so this is the call's first row in the file
+            cur_cid = call_id
+            cur_meta = call_meta_for(call_date_raw) if call_id else {}
+            cur_rids = []
+        if rule_id is None:
+            continue
+        if not cur_rids:
+            first_step_seq = row_seq
+        cur_rids.append(rule_id)
+    if cur_rids:
+        pending.append((first_step_seq, cur_cid, cur_meta, cur_rids))
+    yield from flush()
+
+
+def _accumulate(
+    items: Iterator[Tuple[str, Dict[str, Any]]], acc: MetricsAccumulator, parts: DatePartitions
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    for cid, entry in items:
+        acc.add(entry)
+        parts.add(call_day(entry["call_date"]), entry)
+        yield cid, entry
+
+
+def ingest_streaming(
+    input_csv: str, paths_out_path: str, spill_rows: int = DEFAULT_SPILL_ROWS
+) -> Tuple[NodeRegistry, int, MetricsAccumulator, DatePartitions]:
+    """
+    Bounded-memory ingest: writes the per-call paths JSON while reading. Returns the node
+    registry, number of calls written, the run's metrics and its per-day metrics.
+    Output is identical to the in-memory path.
+    """
+    out_dir = os.path.dirname(os.path.abspath(paths_out_path))
+    # Keep the extension so the writer picks the same format/compression
+    tmp_path = os.path.join(out_dir, ".tmp." + os.path.basename(paths_out_path))
+    registry = NodeRegistry()
+    acc = MetricsAccumulator()
+    parts = DatePartitions()
+    try:
+        calls_count = write_run_paths(_accumulate(_stream_grouped(input_csv, registry), acc, parts), tmp_path)
+    except _NotGrouped:
+        registry = NodeRegistry()
+        acc = MetricsAccumulator()
+        parts = DatePartitions()
+        with tempfile.TemporaryDirectory(prefix=".spill-", dir=out_dir) as spill_dir:
+            items = _stream_external(input_csv, registry, spill_dir, spill_rows)
+            calls_count = write_run_paths(_accumulate(items, acc, parts), tmp_path)
+    os.replace(tmp_path, paths_out_path)
+    return registry, calls_count, acc, parts
+
+
+def write_tree(tree: List[Dict[str, Any]], fo: IO[str]) -> None:
+    json.dump(tree, fo, ensure_ascii=False, indent=2)
+
+
+def process_single_csv(
+    input_csv: str,
+    json_dir: str,
+    tree_out: Optional[str] = None,
+    paths_out: Optional[str] = None,
+    stream: bool = False,
+    spill_rows: int = DEFAULT_SPILL_ROWS,
+    fmt: str = "json",
+    compression: str = "none",
+    keep_metrics: bool = False,
+    parse_workers: int = 1,
+    tail: bool = False,
+) -> Dict[str, Any]:
     """
-    roots = [n for n in nodes_by_id.values() if n["parent_id"] == 0]
+    Process one CSV into its per-run outputs and return a summary. With keep_metrics the
+    summary also carries the run's MetricsAccumulator ("metrics") for in-process callers.
+    parse_workers > 1 parses byte ranges of the file in parallel (in-memory mode only).
+    tail ingests only rows appended since the file's checkpoint (see csv_tail).
+    """
+    if tail:
+        from csv_tail import tail_csv  # csv_tail imports this module
+
+        return tail_csv(input_csv, json_dir, tree_out, paths_out, fmt=fmt, compression=compression, keep_metrics=keep_metrics)
+    tree_out_path, paths_out_path = run_output_paths(input_csv, json_dir, tree_out, paths_out, fmt, compression)
+
+    with instrumentation.stage("generate.csv", csv=os.path.basename(input_csv), stream=stream, format=fmt) as st:
+        st.read_file(input_csv)
+        with instrumentation.stage("ingest"):
+            if stream:
+                registry, calls_count, acc, parts = ingest_streaming(input_csv, paths_out_path, spill_rows=spill_rows)
+            else:
+                registry = NodeRegistry()
+                if parse_workers > 1:
+                    call_paths = ingest_parallel(input_csv, registry, parse_workers)
+                else:
+                    call_paths = ingest_in_memory(input_csv, registry)
+                with instrumentation.stage("write_paths"):
+                    calls_count = write_run_paths(call_paths.iter_run_items(), paths_out_path)
+                with instrumentation.stage("metrics"):
+                    acc = MetricsAccumulator().add_store(call_paths)
+                    parts = DatePartitions().add_store(call_paths, call_day)
+
+        with instrumentation.stage("write_partials"):
+            # Mergeable partial metrics for this source (see analyze_calls --partials)
+            with open(metrics_out_path(paths_out_path), "w", encoding="utf-8") as fo:
+                json.dump(acc.to_state(), fo, ensure_ascii=False)
+            # Same metrics split by call day, for date-range analytics (analyze_calls --start/--end/--series)
+            parts.write(os.path.dirname(paths_out_path), source_of(os.path.basename(paths_out_path)))
+
+        # Build the hierarchical tree
+        with instrumentation.stage("build_tree"):
+            tree = build_tree(registry.nodes_by_id, registry.children_map)
+        with instrumentation.stage("write_tree"):
+            with open(tree_out_path, "w", encoding="utf-8") as fo:
+                write_tree(tree, fo)
+        # A full run supersedes any tail checkpoint (its offsets no longer describe these outputs)
+        if os.path.exists(checkpoint_path(paths_out_path)):
+            os.remove(checkpoint_path(paths_out_path))
+        # Paths files from a run in another format would otherwise be aggregated alongside this one
+        remove_other_paths_files(paths_out_path)
+
+        st.calls = calls_count
+        st.rows = registry.rows
+        st.wrote_file(paths_out_path)
+        st.wrote_file(tree_out_path)
+        st.info["date_parse_cache"] = call_day.cache_info()._asdict()
+
+    summary = {
+        "input_csv": input_csv,
+        "tree_out": tree_out_path,
+        "paths_out": paths_out_path,
+        "roots": len(tree),
+        "nodes": len(registry.nodes_by_id),
+        "calls": calls_count,
+        "inconsistent_parent_ids": len(registry.inconsistent_parent_ids),
+    }
+    if keep_metrics:
+        summary["metrics"] = acc
+    return summary
+
 
-    def expand(node: Dict[str, Any]) -> Dict[str, Any]:
-        node_id = node["rule_id"]
-        children: List[Dict[str, Any]] = []
-        # Sort children by text (Hebrew-safe) then by rule_id for determinism
-        for child_id in sorted(children_map.get(node_id, []), key=lambda rid: (nodes_by_id[rid]["text"], rid)):
-            child_node = nodes_by_id[child_id]
-            children.append(expand(child_node))
-        return {
-            "rule_id": node["rule_id"],
-            "text": node["text"],
-            "url": node["url"],
-            "children": children,
-        }
+def report_run(summary: Dict[str, Any]) -> None:
+    # Final report to stdout
+    print(f"Wrote {summary['tree_out']} (roots: {summary['roots']}), nodes: {summary['nodes']}")
+    print(f"Wrote {summary['paths_out']} (calls: {summary['calls']})")
+    if "tail" in summary:
+        t = summary["tail"]
+        how = "read from the start" if t["rebuilt"] else "appended"
+        print(f"Tail: {t['bytes']} new bytes, {t['calls_written']} call(s) written ({how})")
+        if t["pending_bytes"]:
+            print(f"Tail: {t['pending_bytes']} byte(s) of an unterminated last row included provisionally (re-read next refresh)")
+    if summary["inconsistent_parent_ids"]:
+        print(f"Warning: {summary['inconsistent_parent_ids']} rule_id(s) with inconsistent parent_id encountered (kept first seen).")
 
-    roots_sorted = sorted(roots, key=lambda n: (n["text"], n["rule_id"]))
-    return [expand(r) for r in roots_sorted]
+
+def _process_csv_worker(job: Tuple[str, str, bool, int, str, str, bool, int, bool]) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    input_csv, json_dir, stream, spill_rows, fmt, compression, keep_metrics, parse_workers, tail = job
+    try:
+        return process_single_csv(
+            input_csv,
+            json_dir,
+            stream=stream,
+            spill_rows=spill_rows,
+            fmt=fmt,
+            compression=compression,
+            keep_metrics=keep_metrics,
+            parse_workers=parse_workers,
+            tail=tail,
+        ), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def process_many_csvs(
+    csv_paths: List[str],
+    json_dir: str,
+    workers: Optional[int] = None,
+    stream: bool = False,
+    spill_rows: int = DEFAULT_SPILL_ROWS,
+    fmt: str = "json",
+    compression: str = "none",
+    keep_metrics: bool = False,
+    parse_workers: int = 1,
+    tail: bool = False,
+) -> List[Dict[str, Any]]:
+    """
+    Process CSVs in parallel, one file per worker process. Each worker writes its own per-run
+    outputs; reports are printed (and returned) in input order regardless of completion order.
+    A failing file is reported and skipped. keep_metrics only applies when files are processed
+    in this process (one worker); pool workers hand their metrics over through the partial files.
+    parse_workers (byte-range parsing within a file) only applies then too, so pools never nest.
+    """
+    workers = min(workers or os.cpu_count() or 1, len(csv_paths)) or 1
+    keep_metrics = keep_metrics and workers <= 1
+    parse_workers = parse_workers if workers <= 1 else 1
+    jobs = [(p, json_dir, stream, spill_rows, fmt, compression, keep_metrics, parse_workers, tail) for p in csv_paths]
+    if workers <= 1:
+        results = [_process_csv_worker(job) for job in jobs]
+    else:
+        # Largest files first so the longest job starts immediately; results are re-ordered below
+        order = sorted(range(len(jobs)), key=lambda i: -os.path.getsize(jobs[i][0]))
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+            futures = {i: pool.submit(_process_csv_worker, jobs[i]) for i in order}
+            results = [futures[i].result() for i in range(len(jobs))]
+
+    summaries: List[Dict[str, Any]] = []
+    for (input_csv, *_), (summary, error) in zip(jobs, results):
+        if summary is None:
+            print(f"Warning: failed to process {input_csv}: {error}")
+            continue
+        report_run(summary)
+        summaries.append(summary)
+    return summaries
 
 
 def main() -> None:
@@ -69,160 +836,119 @@ def main() -> None:
         default=None,
         help="Output JSON for per-call paths. Default: <csv_name>.call_paths.json (in ./json)",
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Bounded-memory ingest: write each call as soon as it ends (grouped input) or group via an on-disk external sort",
+    )
+    parser.add_argument(
+        "--spill-rows",
+        type=int,
+        default=DEFAULT_SPILL_ROWS,
+        help=f"Rows per sorted run spilled to disk when --stream input is not grouped by call (default: {DEFAULT_SPILL_ROWS})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Worker processes for --all (default: one per CPU core; 1 = sequential)",
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=1,
+        help="Processes parsing byte ranges of one CSV in parallel (in-memory mode; with --all only when files run sequentially)",
+    )
+    parser.add_argument(
+        "--tail",
+        action="store_true",
+        help=(
+            "Ingest only rows appended since the last --tail run (byte-offset checkpoint per CSV) and update outputs in place; "
+            "each refresh still rewrites the tree, the metrics partial and the touched day partitions (sized by distinct nodes/paths, not rows)"
+        ),
+    )
+    parser.add_argument(
+        "--format",
+        choices=("json", "ndjson"),
+        default="json",
+        help="Per-run call path format: indent=2 JSON (default) or compact NDJSON with a per-file node table",
+    )
+    parser.add_argument(
+        "--compress",
+        choices=tuple(COMPRESSIONS),
+        default="none",
+        help="Compression for --format ndjson outputs (gzip -> .gz, lzma -> .xz)",
+    )
+    parser.add_argument(
+        "--no-aggregate",
+        action="store_true",
+        help="Skip the aggregate_runs step after processing",
+    )
     args = parser.parse_args()
+    if args.parse_workers < 1:
+        parser.error("--parse-workers must be at least 1")
+    if args.tail and (args.stream or args.parse_workers > 1):
+        parser.error("--tail reads only appended rows; it cannot be combined with --stream or --parse-workers")
 
     # Paths setup
     script_dir = os.path.dirname(os.path.abspath(__file__))
     json_dir = os.path.join(script_dir, "json")
     os.makedirs(json_dir, exist_ok=True)
 
-    def process_single_csv(input_csv: str, tree_out: Optional[str] = None, paths_out: Optional[str] = None) -> None:
-        csv_basename = os.path.basename(input_csv)
-        csv_stem = os.path.splitext(csv_basename)[0]
-        safe_stem = re.sub(r"[^A-Za-z0-9_.-]+", "_", csv_stem).strip("_")
-        tree_out_path = tree_out or os.path.join(json_dir, f"{safe_stem}.button_tree.json")
-        paths_out_path = paths_out or os.path.join(json_dir, f"{safe_stem}.call_paths.json")
-
-    # Core structures
-        nodes_by_id: Dict[int, Dict[str, Any]] = {}       # rule_id -> node
-        parent_of: Dict[int, int] = {}                    # rule_id -> parent_id (first-seen)
-        children_map: Dict[int, Set[int]] = defaultdict(set)  # parent_id -> set(child_id)
-        call_events: Dict[str, List[Tuple[int, int]]] = defaultdict(list)  # call_id -> [(seq, rule_id)]
-        call_meta: Dict[str, Dict[str, Any]] = {}  # call_id -> {call_date, weekday}
-
-    # Optional data quality flags
-        inconsistent_parent_ids: List[Tuple[int, int, int]] = []  # (rule_id, first_parent, seen_parent)
-
-        def parse_date_maybe(s: Optional[str]) -> Optional[dt.date]:
-            if not s:
-                return None
-            s = s.strip()
-            # Try common formats (MM/DD/YYYY, DD/MM/YYYY, ISO, etc.)
-            for fmt in ("%m/%d/%Y", "%m/%d/%y", "%d/%m/%Y", "%d/%m/%y", "%Y-%m-%d", "%d-%m-%Y", "%m-%d-%Y"):
-                try:
-                    return dt.datetime.strptime(s, fmt).date()
-                except Exception:
-                    continue
-            return None
-
-    # Read CSV (utf-8-sig handles BOM if present)
-        with open(input_csv, "r", encoding="utf-8-sig", newline="") as f:
-            reader = csv.DictReader(f)
-            seq = 0
-            for row in reader:
-                seq += 1
-                call_id = (row.get("call_id") or "").strip()
-                call_date_raw = (row.get("call_date") or "").strip()
-                if call_id and call_id not in call_meta:
-                    parsed = parse_date_maybe(call_date_raw)
-                    weekday = parsed.isoweekday() if parsed else None  # 1=Mon .. 7=Sun
-                    call_meta[call_id] = {"call_date": call_date_raw or None, "weekday": weekday}
-                # Parse IDs
-                try:
-                    rule_id = int((row.get("rule_id") or "").strip())
-                except Exception:
-                    # Skip malformed
-                    continue
-                try:
-                    parent_id = int((row.get("rule_parent_id") or "").strip())
-                except Exception:
-                    parent_id = 0
-
-                text = coerce_null(row.get("rule_text"))
-                url = coerce_null(row.get("popUpURL"))
-
-                # Register node (prefer first-seen attributes if repeated)
-                if rule_id not in nodes_by_id:
-                    nodes_by_id[rule_id] = {
-                        "rule_id": rule_id,
-                        "parent_id": parent_id,
-                        "text": text or "",
-                        "url": url,
-                    }
-                    parent_of[rule_id] = parent_id
-                else:
-                    if parent_of[rule_id] != parent_id:
-                        inconsistent_parent_ids.append((rule_id, parent_of[rule_id], parent_id))
-                    # Keep first seen parent/text/url for stability
-
-                # Build structure link
-                children_map[parent_id].add(rule_id)
-
-                # Preserve file order per call
-                call_events[call_id].append((seq, rule_id))
-
-        # Build the hierarchical tree
-        tree = build_tree(nodes_by_id, children_map)
-
-        # Build per-call readable paths
-        call_paths: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
-        # Sort call_ids numerically when possible for readability
-        def call_sort_key(x: str) -> Tuple[int, str]:
-            try:
-                return (0, int(x))
-            except Exception:
-                return (1, x)
-
-        for cid in sorted(call_events, key=call_sort_key):
-            ordered = sorted(call_events[cid], key=lambda t: t[0])  # by sequence
-            path: List[Dict[str, Any]] = []
-            for _, rid in ordered:
-                n = nodes_by_id.get(rid)
-                if n is None:
-                    continue
-                path.append({"rule_id": rid, "text": n["text"], "url": n["url"]})
-            meta = call_meta.get(cid, {})
-            call_paths[cid] = {
-                "call_id": cid,
-                "call_date": meta.get("call_date"),
-                "weekday": meta.get("weekday"),
-                "path": path,
-            }
-
-        # Write outputs
-        with open(tree_out_path, "w", encoding="utf-8") as fo:
-            json.dump(tree, fo, ensure_ascii=False, indent=2)
-        with open(paths_out_path, "w", encoding="utf-8") as fo:
-            json.dump(call_paths, fo, ensure_ascii=False, indent=2)
-
-        # Final report to stdout
-        roots_count = len(tree)
-        nodes_count = len(nodes_by_id)
-        calls_count = len(call_paths)
-        print(f"Wrote {tree_out_path} (roots: {roots_count}), nodes: {nodes_count}")
-        print(f"Wrote {paths_out_path} (calls: {calls_count})")
-        if inconsistent_parent_ids:
-            print(f"Warning: {len(inconsistent_parent_ids)} rule_id(s) with inconsistent parent_id encountered (kept first seen).")
-
     # Dispatch: single file or scan data dir
     if args.all:
         data_dir = args.data_dir or os.path.join(script_dir, "data")
         if not os.path.isdir(data_dir):
             raise SystemExit(f"Data directory not found: {data_dir}")
-        # Process all CSV files
-        for name in sorted(os.listdir(data_dir)):
-            if not name.lower().endswith(".csv"):
-                continue
-            process_single_csv(os.path.join(data_dir, name), tree_out=None, paths_out=None)
+        # Process all CSV files across a worker pool
+        csv_paths = [os.path.join(data_dir, name) for name in sorted(os.listdir(data_dir)) if name.lower().endswith(".csv")]
+        with instrumentation.stage("generate.all", files=len(csv_paths), workers=args.workers) as st:
+            summaries = process_many_csvs(
+                csv_paths,
+                json_dir,
+                workers=args.workers,
+                stream=args.stream,
+                spill_rows=args.spill_rows,
+                fmt=args.format,
+                compression=args.compress,
+                parse_workers=args.parse_workers,
+                tail=args.tail,
+            )
+            for p in csv_paths:
+                st.read_file(p)
+            st.calls = sum(s["calls"] for s in summaries)
+        if args.no_aggregate:
+            return
         # Aggregate once at the end
         try:
             import aggregate_runs
-            aggregate_runs.aggregate_runs(source_dir=json_dir, output_dir=script_dir)
+            aggregate_runs.aggregate_runs(source_dir=json_dir, output_dir=script_dir, fmt=args.format, compression=args.compress)
         except Exception as e:
             print(f"Aggregation warning: {e}")
     else:
         if not args.input_csv:
             raise SystemExit("Please provide an input CSV path or use --all to scan the data directory.")
-        process_single_csv(args.input_csv, tree_out=args.tree_out, paths_out=args.paths_out)
+        report_run(process_single_csv(
+            args.input_csv,
+            json_dir,
+            tree_out=args.tree_out,
+            paths_out=args.paths_out,
+            stream=args.stream,
+            spill_rows=args.spill_rows,
+            fmt=args.format,
+            compression=args.compress,
+            parse_workers=args.parse_workers,
+            tail=args.tail,
+        ))
+        if args.no_aggregate:
+            return
         # Aggregate after single run
         try:
             import aggregate_runs
-            aggregate_runs.aggregate_runs(source_dir=json_dir, output_dir=script_dir)
+            aggregate_runs.aggregate_runs(source_dir=json_dir, output_dir=script_dir, fmt=args.format, compression=args.compress)
         except Exception as e:
             print(f"Aggregation warning: {e}")
 
 
 if __name__ == "__main__":
     main()
-
-
@@ -0,0 +1,267 @@
+"""
+Lightweight per-stage instrumentation shared by the pipeline scripts.
+
+Enabled by setting CALLS_REPORT_DIR (run.py does this for every run). Each process then
+appends one JSON line per top-level stage to <dir>/<script>.<pid>.jsonl; nested stages and
+@timed metric functions are recorded as children. Every record has wall/CPU time, memory,
+bytes read/written (from /proc/self/io where available, plus any explicit counts), and
+rows/steps/calls with their per-second rates. Memory is the process's peak RSS so far
+(peak_rss_kb) and how much the stage raised it (peak_rss_delta_kb); a stage that stays
+under an earlier peak shows a delta of 0.
+
+CALLS_PROFILE adds deeper capture for top-level stages:
+  cprofile     <script>.<pid>.<stage>.prof per stage + the top functions in the record
+  tracemalloc  Python allocation peak and top allocation sites per stage
+  all          both
+When CALLS_REPORT_DIR is unset, stage() and @timed only cost a function call.
+"""
+import cProfile
+import datetime as dt
+import functools
+import io
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+REPORT_DIR_ENV = "CALLS_REPORT_DIR"
+PROFILE_ENV = "CALLS_PROFILE"
+PROFILE_MODES = ("cprofile", "tracemalloc", "all")
+
+
+def report_dir() -> Optional[str]:
+    return os.environ.get(REPORT_DIR_ENV) or None
+
+
+def enabled() -> bool:
+    return report_dir() is not None
+
+
+def profile_mode() -> str:
+    mode = os.environ.get(PROFILE_ENV, "")
+    return mode if mode in PROFILE_MODES else ""
+
+
+def peak_rss_kb() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == "darwin" else peak  # bytes on macOS, KiB elsewhere
+
+
+def _io_counters() -> Optional[Dict[str, int]]:
+    # rchar/wchar count all read()/write() bytes, including page-cache hits
+    try:
+        with open("/proc/self/io", "r") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return {"read": int(fields["rchar"]), "write": int(fields["wchar"])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class StageRecord:
+    """Counters for one stage; code inside the stage may set rows/steps/calls/bytes and info."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.rows: Optional[int] = None     # CSV data rows
+        self.steps: Optional[int] = None    # call path steps
+        self.calls: Optional[int] = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.info: Dict[str, Any] = {}
+        self.children: List[Dict[str, Any]] = []
+
+    def read_file(self, path: str) -> None:
+        try:
+            self.bytes_read += os.path.getsize(path)
+        except OSError:
+            pass
+
+    def wrote_file(self, path: str) -> None:
+        try:
+            self.bytes_written += os.path.getsize(path)
+        except OSError:
+            pass
+
+
+class _Recorder:
+    def __init__(self) -> None:
+        self.local = threading.local()
+
+    def stack(self) -> List[StageRecord]:
+        # A forked worker inherits the parent's open stages; its own stages start a new stack
+        st = getattr(self.local, "stack", None)
+        if st is None or getattr(self.local, "pid", None) != os.getpid():
+            st = self.local.stack = []
+            self.local.pid = os.getpid()
+        return st
+
+
+_recorder = _Recorder()
+_NULL = StageRecord("")
+
+
+def _safe_name(name: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", name)[:80]
+
+
+def _emit(record: Dict[str, Any]) -> None:
+    out_dir = report_dir()
+    if not out_dir:
+        return
+    os.makedirs(out_dir, exist_ok=True)
+    script = os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0] or "python"
+    path = os.path.join(out_dir, f"{_safe_name(script)}.{os.getpid()}.jsonl")
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def _profile_summary(prof: cProfile.Profile, limit: int = 15) -> List[Dict[str, Any]]:
+    stats = pstats.Stats(prof, stream=io.StringIO())
+    rows = []
+    for (filename, line, func), (cc, nc, tt, ct, _) in stats.stats.items():  # type: ignore[attr-defined]
+        rows.append({"function": f"{os.path.basename(filename)}:{line}({func})", "calls": nc, "tottime": tt, "cumtime": ct})
+    rows.sort(key=lambda r: r["cumtime"], reverse=True)
+    return rows[:limit]
+
+
+@contextmanager
+def stage(name: str, **info: Any) -> Iterator[StageRecord]:
+    """Time a block; nested stages become children of the enclosing one."""
+    if not enabled():
+        yield _NULL
+        return
+    stack = _recorder.stack()
+    top_level = not stack
+    rec = StageRecord(name)
+    rec.info.update(info)
+    mode = profile_mode() if top_level else ""
+    prof = None
+    if mode in ("cprofile", "all"):
+        prof = cProfile.Profile()
+    tracing = mode in ("tracemalloc", "all")
+    if tracing:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    io_before = _io_counters()
+    rss_before = peak_rss_kb()
+    started = dt.datetime.now().isoformat(timespec="seconds")
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    stack.append(rec)
+    if prof is not None:
+        prof.enable()
+    error: Optional[str] = None
+    try:
+        yield rec
+    except BaseException as e:
+        error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        if prof is not None:
+            prof.disable()
+        stack.pop()
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        io_after = _io_counters()
+        rss_after = peak_rss_kb()
+        if io_before and io_after:
+            rec.bytes_read = max(rec.bytes_read, io_after["read"] - io_before["read"])
+            rec.bytes_written = max(rec.bytes_written, io_after["write"] - io_before["write"])
+        out: Dict[str, Any] = {
+            "stage": name,
+            "started": started,
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "peak_rss_kb": rss_after,
+            "peak_rss_delta_kb": rss_after - rss_before if rss_after is not None and rss_before is not None else None,
+            "bytes_read": rec.bytes_read,
+            "bytes_written": rec.bytes_written,
+        }
+        if rec.rows is not None:
+            out["rows"] = rec.rows
+            out["rows_per_s"] = rec.rows / wall if wall > 0 else None
+        if rec.steps is not None:
+            out["steps"] = rec.steps
+            out["steps_per_s"] = rec.steps / wall if wall > 0 else None
+        if rec.calls is not None:
+            out["calls"] = rec.calls
+            out["calls_per_s"] = rec.calls / wall if wall > 0 else None
+        if rec.info:
+            out["info"] = rec.info
+        if error:
+            out["error"] = error
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            out["tracemalloc"] = {
+                "current_bytes": current,
+                "peak_bytes": peak,
+                "top": [
+                    {"where": str(s.traceback[0]), "bytes": s.size, "blocks": s.count}
+                    for s in snapshot.statistics("lineno")[:10]
+                ],
+            }
+        if prof is not None:
+            out_dir = report_dir() or "."
+            os.makedirs(out_dir, exist_ok=True)
+            prof_path = os.path.join(out_dir, f"{_safe_name(name)}.{os.getpid()}.prof")
+            prof.dump_stats(prof_path)
+            out["cprofile"] = {"file": os.path.basename(prof_path), "top": _profile_summary(prof)}
+        if rec.children:
+            out["children"] = rec.children
+        if top_level:
+            out["script"] = os.path.basename(sys.argv[0] or "")
+            out["pid"] = os.getpid()
+            _emit(out)
+        else:
+            stack[-1].children.append(out)
+
+
+def current() -> StageRecord:
+    """The innermost open stage in this thread (a throwaway record when none is open)."""
+    stack = _recorder.stack() if enabled() else None
+    return stack[-1] if stack else StageRecord("")
+
+
+def timed(name: str) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """Decorator: record each call of the function as a stage (a no-op unless enabled)."""
+
+    def wrap(fn: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(fn)
+        def inner(*args: Any, **kwargs: Any) -> Any:
+            if not enabled():
+                return fn(*args, **kwargs)
+            with stage(name):
+                return fn(*args, **kwargs)
+
+        return inner
+
+    return wrap
+
+
+def load_records(directory: str) -> List[Dict[str, Any]]:
+    """All top-level stage records written under `directory`, in start order."""
+    records: List[Dict[str, Any]] = []
+    if not os.path.isdir(directory):
+        return records
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".jsonl"):
+            continue
+        with open(os.path.join(directory, name), "r", encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda r: r.get("started", ""))
+    return records
@@ -0,0 +1,112 @@
+import json
+from typing import Any, IO, Iterable, Iterator, Tuple
+
+_DECODER = json.JSONDecoder()
+_WS = " \t\n\r"
+
+
+def _dump_value(value: Any, indent: int, level: int) -> str:
+    # json.dump nests with a growing indent; re-indent a standalone dump to the given level
+    text = json.dumps(value, ensure_ascii=False, indent=indent)
+    if level and indent:
+        text = text.replace("\n", "\n" + " " * (indent * level))
+    return text
+
+
+def format_json_entry(key: str, value: Any, indent: int = 2) -> str:
+    """One `"key": value` member as it appears inside a top-level object written by json.dump."""
+    return " " * indent + json.dumps(key, ensure_ascii=False) + ": " + _dump_value(value, indent, 1)
+
+
+def write_json_object(items: Iterable[Tuple[str, Any]], f: IO[str], indent: int = 2) -> int:
+    """
+    Write (key, value) pairs as one JSON object without materializing it.
+    Output is byte-identical to json.dump(dict(items), f, ensure_ascii=False, indent=indent).
+    Returns the number of entries written.
+    """
+    count = 0
+    for key, value in items:
+        f.write("{\n" if count == 0 else ",\n")
+        f.write(format_json_entry(key, value, indent))
+        count += 1
+    f.write("\n}" if count else "{}")
+    return count
+
+
+class _Reader:
+    """Growable text buffer over a file for incremental decoding."""
+
+    def __init__(self, f: IO[str], chunk_size: int) -> None:
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        if self.pos > len(self.buf) // 2:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        self.buf += chunk
+        return True
+
+    def peek(self) -> str:
+        # Next non-whitespace character ("" at EOF)
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WS:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, ch: str) -> None:
+        got = self.peek()
+        if got != ch:
+            raise ValueError(f"Expected {ch!r} in JSON stream, got {got!r}")
+        self.pos += 1
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            # A bare number/literal ending at the buffer edge may continue in the next chunk
+            if end == len(self.buf) and not self.eof and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_object(f: IO[str], chunk_size: int = 1 << 16) -> Iterator[Tuple[str, Any]]:
+    """
+    Yield (key, value) pairs of a top-level JSON object one at a time, so a large
+    call_paths file is never fully materialized. Only the current member is held in memory.
+    """
+    r = _Reader(f, chunk_size)
+    r.expect("{")
+    if r.peek() == "}":
+        r.pos += 1
+        return
+    while True:
+        key = r.value()
+        if not isinstance(key, str):
+            raise ValueError("JSON object keys must be strings")
+        r.expect(":")
+        yield key, r.value()
+        sep = r.peek()
+        r.pos += 1
+        if sep == "}":
+            return
+        if sep != ",":
+            raise ValueError(f"Expected ',' or '}}' in JSON stream, got {sep!r}")
@@ -0,0 +1,329 @@
+"""
+Sparse absorbing Markov chain over observed rule_id transitions (markov_model.json and
+completion.json in analytics/).
+
+Every node seen in a call is a transient state. From node i a call either steps to j
+(edges[i, j] / out_i) or ends there (terminations[i] / out_i), where out_i counts both. Ending
+at i is the absorbing state end(i). An end(i) is a *leaf* completion when i is a leaf of the
+aggregated tree; ending anywhere else (a node with children, or a node missing from the tree)
+is a *dead end*. Transitions are held as CSR arrays (array module; NumPy is optional).
+
+For every node at once the model solves the absorbing-chain quantities
+  expected_steps  E = (1 - end) + Q E            transitions still to come
+  absorption      B = R + Q B                    P(call ends at end(k) | now at i)
+It does not simulate. Strongly connected components are solved in reverse topological order
+(Tarjan), so acyclic parts are exact one-pass substitutions. Small cycles use dense Gaussian
+elimination. Larger ones are solved directly with NumPy (solve(vectorized=True), up to
+DIRECT_LIMIT states) or by Gauss-Seidel over per-component arrays to ABS_TOL; Gauss-Seidel
+stops after MAX_WORK value updates and the states it left short of ABS_TOL are reported as
+unconverged_states / max_residual. Absorption rows are sparse dicts; entries below PRUNE are
+dropped.
+"""
+from array import array
+from typing import Any, Container, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; large cycles fall back to Gauss-Seidel
+    np = None
+
+DENSE_LIMIT = 64      # SCCs up to this size are solved by Gaussian elimination
+DIRECT_LIMIT = 4096   # larger SCCs up to this size are solved with numpy.linalg.solve when vectorized
+ABS_TOL = 1e-12       # Gauss-Seidel stops once no value moves by more than this
+MAX_SWEEPS = 100000
+MAX_WORK = 50_000_000  # Gauss-Seidel budget per component, in value updates (links x columns per sweep)
+PRUNE = 1e-12         # absorption probabilities below this are dropped from the sparse rows
+DEFAULT_TOP_ENDS = 5
+
+
+class MarkovModel:
+    """CSR transition model over rule_id states; call solve() for the absorbing-chain results."""
+
+    def __init__(self, edges: Mapping[Tuple[int, int], int], terminations: Mapping[int, int]) -> None:
+        self.states: List[int] = []          # dense index -> rule_id (first-seen order)
+        self.index: Dict[int, int] = {}
+        rows: Dict[int, List[Tuple[int, int]]] = {}
+        for (a, b), c in edges.items():
+            ia, ib = self._state(a), self._state(b)
+            rows.setdefault(ia, []).append((ib, c))
+        for rid in terminations:
+            self._state(rid)
+        n = len(self.states)
+        self.visits = array("q", [0]) * n     # occurrences that step on or end (out_i)
+        self.ends = array("q", [0]) * n       # calls ending at the node
+        for rid, c in terminations.items():
+            self.ends[self.index[rid]] = c
+        self.indptr = array("q", [0])
+        self.indices = array("q")
+        self.data = array("d")                # Q: P(i -> j)
+        for i in range(n):
+            row = rows.get(i, [])
+            out = sum(c for _, c in row) + self.ends[i]
+            self.visits[i] = out
+            for j, c in row:
+                self.indices.append(j)
+                self.data.append(c / out)
+            self.indptr.append(len(self.indices))
+        # P(end at i | at i); a node that is never left nor ended is treated as absorbing
+        self.end_prob = array("d", (self.ends[i] / self.visits[i] if self.visits[i] else 1.0 for i in range(n)))
+        self.expected_steps: Optional[array] = None
+        self.absorption: List[Dict[int, float]] = []
+        self.sccs = 0
+        self.cyclic_states = 0
+        self.unconverged_states = 0           # states of components Gauss-Seidel stopped early on
+        self.max_residual = 0.0               # largest last-sweep change among them
+
+    def _state(self, rid: int) -> int:
+        i = self.index.get(rid)
+        if i is None:
+            i = self.index[rid] = len(self.states)
+            self.states.append(rid)
+        return i
+
+    def __len__(self) -> int:
+        return len(self.states)
+
+    def row(self, i: int) -> Iterable[Tuple[int, float]]:
+        lo, hi = self.indptr[i], self.indptr[i + 1]
+        return zip(self.indices[lo:hi], self.data[lo:hi])
+
+    # --- solving ---
+    def components(self) -> List[List[int]]:
+        """Strongly connected components, successors before predecessors (iterative Tarjan)."""
+        n = len(self.states)
+        order = array("q", [-1]) * n
+        low = array("q", [0]) * n
+        on_stack = bytearray(n)
+        stack: List[int] = []
+        out: List[List[int]] = []
+        counter = 0
+        indptr, indices = self.indptr, self.indices
+        for root in range(n):
+            if order[root] != -1:
+                continue
+            work = [(root, indptr[root])]
+            order[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = 1
+            while work:
+                v, k = work[-1]
+                if k < indptr[v + 1]:
+                    work[-1] = (v, k + 1)
+                    w = indices[k]
+                    if order[w] == -1:
+                        order[w] = low[w] = counter
+                        counter += 1
+                        stack.append(w)
+                        on_stack[w] = 1
+                        work.append((w, indptr[w]))
+                    elif on_stack[w] and order[w] < low[v]:
+                        low[v] = order[w]
+                    continue
+                work.pop()
+                if work and low[v] < low[work[-1][0]]:
+                    low[work[-1][0]] = low[v]
+                if low[v] == order[v]:
+                    comp = []
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = 0
+                        comp.append(w)
+                        if w == v:
+                            break
+                    out.append(comp)
+        return out
+
+    def solve(self, vectorized: bool = False) -> "MarkovModel":
+        """Solve every component; vectorized=True (requires NumPy) solves large cycles directly."""
+        n = len(self.states)
+        steps = array("d", [0.0]) * n
+        absorb: List[Dict[int, float]] = [{} for _ in range(n)]
+        comps = self.components()
+        self.sccs = len(comps)
+        self.cyclic_states = 0
+        self.unconverged_states = 0
+        self.max_residual = 0.0
+        for comp in comps:
+            if len(comp) == 1 and not any(j == comp[0] for j, _ in self.row(comp[0])):
+                i = comp[0]
+                steps[i], absorb[i] = self._substitute(i, steps, absorb, None)
+                continue
+            self.cyclic_states += len(comp)
+            if len(comp) <= DENSE_LIMIT:
+                self._solve_dense(comp, steps, absorb)
+            else:
+                self._solve_large(comp, steps, absorb, vectorized and np is not None and len(comp) <= DIRECT_LIMIT)
+        self.expected_steps = steps
+        self.absorption = absorb
+        return self
+
+    def _substitute(
+        self, i: int, steps: array, absorb: List[Dict[int, float]], inside: Optional[Container[int]]
+    ) -> Tuple[float, Dict[int, float]]:
+        """One Bellman update of state i from already-known values (skipping `inside` states)."""
+        e = 1.0 - self.end_prob[i]
+        b: Dict[int, float] = {i: self.end_prob[i]} if self.end_prob[i] > 0 else {}
+        for j, p in self.row(i):
+            if inside is not None and j in inside:
+                continue
+            e += p * steps[j]
+            for k, q in absorb[j].items():
+                b[k] = b.get(k, 0.0) + p * q
+        return e, _pruned(b)
+
+    def _solve_dense(self, comp: List[int], steps: array, absorb: List[Dict[int, float]]) -> None:
+        # (I - Q_cc) X = RHS, where RHS already folds in every successor outside the component
+        local = {s: x for x, s in enumerate(comp)}
+        inside = set(comp)
+        m = len(comp)
+        rhs_e: List[float] = []
+        rhs_b: List[Dict[int, float]] = []
+        for s in comp:
+            e, b = self._substitute(s, steps, absorb, inside)
+            rhs_e.append(e)
+            rhs_b.append(b)
+        keys = list(dict.fromkeys(k for b in rhs_b for k in b))
+        col = {k: x for x, k in enumerate(keys)}
+        width = m + 1 + len(keys)
+        mat = []
+        for x, s in enumerate(comp):
+            r = [0.0] * width
+            r[x] = 1.0
+            for j, p in self.row(s):
+                y = local.get(j)
+                if y is not None:
+                    r[y] -= p
+            r[m] = rhs_e[x]
+            for k, q in rhs_b[x].items():
+                r[m + 1 + col[k]] = q
+            mat.append(r)
+        for x in range(m):
+            piv = max(range(x, m), key=lambda y: abs(mat[y][x]))
+            mat[x], mat[piv] = mat[piv], mat[x]
+            pr = mat[x]
+            inv = 1.0 / pr[x]
+            for c in range(x, width):
+                pr[c] *= inv
+            for y in range(m):
+                if y != x and mat[y][x] != 0.0:
+                    f = mat[y][x]
+                    ry = mat[y]
+                    for c in range(x, width):
+                        ry[c] -= f * pr[c]
+        for x, s in enumerate(comp):
+            r = mat[x]
+            steps[s] = r[m]
+            absorb[s] = _pruned({k: r[m + 1 + col[k]] for k in keys})
+
+    def _solve_large(self, comp: List[int], steps: array, absorb: List[Dict[int, float]], direct: bool) -> None:
+        # Same system as _solve_dense, held as per-component lists: links[x] are the (y, p) steps
+        # inside the component and rhs[x] = [E, B_0 .. B_K-1] folds in everything outside it
+        local = {s: x for x, s in enumerate(comp)}
+        m = len(comp)
+        base = [self._substitute(s, steps, absorb, local) for s in comp]
+        keys = list(dict.fromkeys(k for _, b in base for k in b))
+        col = {k: c for c, k in enumerate(keys, 1)}
+        rhs: List[List[float]] = []
+        for e, b in base:
+            r = [0.0] * (len(keys) + 1)
+            r[0] = e
+            for k, q in b.items():
+                r[col[k]] = q
+            rhs.append(r)
+        links = [[(local[j], p) for j, p in self.row(s) if j in local] for s in comp]
+        if direct:
+            mat = np.eye(m)
+            for x, row in enumerate(links):
+                for y, p in row:
+                    mat[x, y] -= p
+            vals = np.linalg.solve(mat, np.array(rhs)).tolist()
+        else:
+            vals = self._gauss_seidel(links, rhs)
+        for x, s in enumerate(comp):
+            r = vals[x]
+            steps[s] = r[0]
+            absorb[s] = _pruned({k: r[c] for k, c in col.items()})
+
+    def _gauss_seidel(self, links: List[List[Tuple[int, float]]], rhs: List[List[float]]) -> List[List[float]]:
+        vals = [r[:] for r in rhs]
+        per_sweep = sum(len(row) for row in links) * len(rhs[0])
+        delta = 0.0
+        for _ in range(max(1, min(MAX_SWEEPS, MAX_WORK // per_sweep))):
+            delta = 0.0
+            for x, row in enumerate(links):
+                r = rhs[x]
+                for y, p in row:
+                    r = [u + p * v for u, v in zip(r, vals[y])]
+                delta = max(delta, abs(r[0] - vals[x][0]))
+                vals[x] = r
+            if delta <= ABS_TOL:
+                return vals
+        self.unconverged_states += len(links)
+        self.max_residual = max(self.max_residual, delta)
+        return vals
+
+    # --- outputs ---
+    def completion(
+        self, leaves: Set[int], nodes: Optional[Mapping[int, Mapping[str, Any]]] = None, top: int = DEFAULT_TOP_ENDS
+    ) -> Dict[int, Dict[str, Any]]:
+        """Per rule_id: expected remaining steps, P(leaf completion), P(dead end), most likely ends."""
+        if self.expected_steps is None:
+            self.solve()
+        nodes = nodes or {}
+        out: Dict[int, Dict[str, Any]] = {}
+        for i, rid in enumerate(self.states):
+            row = self.absorption[i]
+            p_leaf = sum(q for k, q in row.items() if self.states[k] in leaves)
+            ranked = sorted(row.items(), key=lambda kq: (-kq[1], self.states[kq[0]]))[:top]
+            out[rid] = {
+                "visits": self.visits[i],
+                "expected_steps": self.expected_steps[i],
+                "p_leaf": p_leaf,
+                "p_dead_end": max(0.0, sum(row.values()) - p_leaf),
+                "top_ends": [
+                    {
+                        "rule_id": self.states[k],
+                        "probability": q,
+                        "leaf": self.states[k] in leaves,
+                        "text": nodes.get(self.states[k], {}).get("text", ""),
+                    }
+                    for k, q in ranked
+                ],
+            }
+        return out
+
+    def to_sparse(self, leaves: Set[int]) -> Dict[str, Any]:
+        """Compact CSR export: states, transition matrix, absorption matrix and per-state vectors."""
+        if self.expected_steps is None:
+            self.solve()
+        ab_ptr, ab_idx, ab_val = [0], [], []
+        for row in self.absorption:
+            for k in sorted(row):
+                ab_idx.append(k)
+                ab_val.append(row[k])
+            ab_ptr.append(len(ab_idx))
+        return {
+            "format": "csr",
+            "states": self.states,
+            "leaf": [1 if rid in leaves else 0 for rid in self.states],
+            "visits": list(self.visits),
+            "end_prob": list(self.end_prob),
+            "expected_steps": list(self.expected_steps),
+            "transitions": {"indptr": list(self.indptr), "indices": list(self.indices), "data": list(self.data)},
+            "absorption": {"indptr": ab_ptr, "indices": ab_idx, "data": ab_val},
+            "sccs": self.sccs,
+            "cyclic_states": self.cyclic_states,
+            "unconverged_states": self.unconverged_states,
+            "max_residual": self.max_residual,
+        }
+
+
+def _pruned(b: Dict[int, float]) -> Dict[int, float]:
+    return {k: q for k, q in b.items() if q > PRUNE}
+
+
+def tree_leaves(children: Mapping[int, Iterable[int]]) -> Set[int]:
+    """rule_ids in the tree that have no children (the virtual root 0 is not a node)."""
+    kids = {c for ch in children.values() for c in ch}
+    return {rid for rid in kids if not children.get(rid)}
@@ -0,0 +1,411 @@
+"""
+Mergeable per-source metric partials: the fused MetricsAccumulator, its JSON state
+(<source>.metrics.json) and the per-day partitions under json/by_date/.
+
+Kept apart from analyze_calls so ingestion (generate_button_tree, csv_tail and their worker
+processes) can write partials without importing the analytics stack.
+"""
+import json
+import math
+import os
+import shutil
+from collections import defaultdict, Counter
+from typing import Dict, List, Any, Iterable, Tuple, Optional
+
+import instrumentation
+from json_stream import iter_json_object
+from ndjson_paths import iter_ndjson_calls
+from path_store import PathStore, iter_call_path_items
+from path_trie import PathTrie
+from sketches import HeavyHitters
+
+PARTIAL_STATE_VERSION = 1
+PARTIALS_SUFFIX = ".metrics.json"
+PARTITIONS_DIR = "by_date"
+PARTITION_INDEX = "index.json"
+UNDATED = "undated"
+
+
+def load_json(path: str) -> Any:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def path_rule_ids(path: List[Dict[str, Any]]) -> List[int]:
+    return [int(step["rule_id"]) for step in path if "rule_id" in step]
+
+
+def summarize_length_hist(hist: Counter) -> Dict[str, Any]:
+    # hist: path length -> number of calls with that length
+    n = sum(hist.values())
+    if n == 0:
+        return {}
+    keys = sorted(hist)
+    def pct(p: float) -> int:
+        idx = min(n - 1, max(0, int(math.ceil(p * n) - 1)))
+        seen = 0
+        for length in keys:
+            seen += hist[length]
+            if seen > idx:
+                return length
+        return keys[-1]
+    return {
+        "count": n,
+        "avg": sum(length * c for length, c in hist.items()) / n,
+        "median": pct(0.5),
+        "p90": pct(0.9),
+        "p95": pct(0.95),
+        "min": keys[0],
+        "max": keys[-1],
+    }
+
+
+def depth_funnel_from_lengths(hist: Counter) -> Dict[int, int]:
+    # Calls reaching depth d = calls whose path length is >= d
+    out: Dict[int, int] = {}
+    remaining = sum(c for length, c in hist.items() if length > 0)
+    for d in range(1, max(hist, default=0) + 1):
+        if remaining <= 0:
+            break
+        out[d] = remaining
+        remaining -= hist.get(d, 0)
+    return out
+
+
+def node_funnel_from_counts(reach: Counter, transitions: Dict[int, Counter]) -> Dict[int, Dict[str, int]]:
+    return node_funnel_from_totals(reach, {rid: sum(ctr.values()) for rid, ctr in transitions.items()})
+
+
+@instrumentation.timed("metric.node_funnel_from_totals")
+def node_funnel_from_totals(reach: Counter, totals: Dict[int, int]) -> Dict[int, Dict[str, int]]:
+    # totals: rule_id -> number of outgoing transitions
+    result: Dict[int, Dict[str, int]] = {}
+    for rid, r in reach.items():
+        trans_sum = totals.get(rid, 0)
+        result[rid] = {
+            "reach": r,
+            "transitions": trans_sum,
+            "drop_off": r - trans_sum,
+        }
+    return result
+
+
+def dead_ends_from_counts(reach_occ: Counter, last_occ: Counter, children: Dict[int, List[int]]) -> List[Dict[str, Any]]:
+    out: List[Dict[str, Any]] = []
+    for rid, r in reach_occ.items():
+        last = last_occ.get(rid, 0)
+        out.append({
+            "rule_id": rid,
+            "reach_occurrences": r,
+            "terminations": last,
+            "termination_rate": last / r if r else 0.0,
+            "has_children": len(children.get(rid, [])) > 0
+        })
+    out.sort(key=lambda x: (-x["termination_rate"], -x["reach_occurrences"]))
+    return out
+
+
+def tree_edge_set(children: Dict[int, List[int]]) -> set:
+    tree_edges: set = set()
+    for pid, ch in children.items():
+        for c in ch:
+            tree_edges.add((pid, c))
+    return tree_edges
+
+
+class MetricsAccumulator:
+    """
+    Fused single-pass engine: feed every call once through add(), then read each
+    metric from the accumulated counters. Results match analyze_calls' standalone functions
+    (including tie order, since counters are filled in the same call order).
+    With vectorized=True (requires NumPy) reach/edge counting is batched through
+    edge_arrays.StepBuffer; the add_* feeders, merge() and to_state() flush it.
+    With approx (HeavyHitters keyword arguments), full paths and URLs are counted in
+    fixed-memory sketches instead, and their top-k counts carry error bounds.
+    """
+
+    def __init__(self, vectorized: bool = False, approx: Optional[Dict[str, int]] = None) -> None:
+        self.length_hist: Counter = Counter()          # len(path) -> calls
+        self.weekdays: Dict[Optional[int], int] = defaultdict(int)
+        self.intents: Counter = Counter()
+        self.leaves: Counter = Counter()
+        self.reach: Counter = Counter()                # rule_id -> occurrences
+        self.edges: Counter = Counter()                # (from, to) -> occurrences, first-seen order
+        self.approx = approx
+        if approx is None:
+            self.urls: Any = Counter()
+            self.paths: Any = PathTrie()               # counted prefix trie of full rule_id paths
+        else:
+            self.urls = HeavyHitters(**approx)
+            self.paths = HeavyHitters(**approx)        # rule_id tuple -> approximate calls
+        self._steps = None
+        if vectorized:
+            import edge_arrays  # loads NumPy; ingest workers never need it
+            self._steps = edge_arrays.StepBuffer()
+        self.sequences: Any = None  # optional sequence_mining.SequenceMiner fed from the same scan
+
+    def add(self, entry: Dict[str, Any]) -> None:
+        path = entry["path"]
+        self.add_call(len(path), entry.get("weekday"), path_rule_ids(path), (step.get("url") for step in path))
+
+    def add_call(self, length: int, weekday: Optional[int], rids: List[int], urls: Iterable[Optional[str]]) -> None:
+        self.length_hist[length] += 1
+        self.weekdays[weekday] += 1
+        if self.approx is None:
+            for url in urls:
+                if url:
+                    self.urls[url] += 1
+        else:
+            for url in urls:
+                if url:
+                    self.urls.add(url)
+        if self.sequences is not None:
+            self.sequences.add(rids)
+        if not rids:
+            return
+        self.intents[rids[1] if len(rids) > 1 and rids[0] == 1 else rids[0]] += 1
+        self.leaves[rids[-1]] += 1
+        self.paths.add(rids if self.approx is None else tuple(rids))
+        if self._steps is not None:
+            if self._steps.add(rids):
+                self.flush()
+            return
+        reach = self.reach
+        edges = self.edges
+        prev = None
+        for rid in rids:
+            reach[rid] += 1
+            if prev is not None:
+                edges[(prev, rid)] += 1
+            prev = rid
+
+    def flush(self) -> "MetricsAccumulator":
+        if self._steps is not None:
+            self._steps.flush(self.reach, self.edges)
+        return self
+
+    def add_all(self, paths: Iterable[Dict[str, Any]]) -> "MetricsAccumulator":
+        for p in paths:
+            self.add(p)
+        return self.flush()
+
+    def add_ndjson(self, path: str) -> "MetricsAccumulator":
+        # Lazy record-by-record scan of a call_paths NDJSON file
+        for rec, steps in iter_ndjson_calls(path):
+            self.add_call(len(steps), rec.weekday, [s[0] for s in steps], [s[2] for s in steps])
+        return self.flush()
+
+    def add_json_stream(self, path: str) -> "MetricsAccumulator":
+        # Entry-by-entry scan of a call_paths JSON object; the file is never loaded whole
+        with open(path, "r", encoding="utf-8") as f:
+            for rec, steps in iter_call_path_items(iter_json_object(f)):
+                self.add_call(len(steps), rec.weekday, [s[0] for s in steps], [s[2] for s in steps])
+        return self.flush()
+
+    def add_store(self, store: PathStore) -> "MetricsAccumulator":
+        node_rids = store.nodes.rule_ids
+        node_urls = store.nodes.urls
+        for rec, step_ids in store.iter_calls():
+            self.add_call(
+                len(step_ids),
+                rec.weekday,
+                [node_rids[s] for s in step_ids],
+                [node_urls[s] for s in step_ids],
+            )
+        return self.flush()
+
+    # --- partial states (mergeable per-source snapshots) ---
+    def merge(self, other: "MetricsAccumulator") -> "MetricsAccumulator":
+        # Counter.update keeps first-seen key order, so merging partials in source order
+        # reproduces the tie order of one scan over the concatenated calls
+        self.flush()
+        other.flush()
+        self.length_hist.update(other.length_hist)
+        for wd, c in other.weekdays.items():
+            self.weekdays[wd] += c
+        self.intents.update(other.intents)
+        self.leaves.update(other.leaves)
+        self.reach.update(other.reach)
+        self.edges.update(other.edges)
+        if self.approx is None:
+            self.urls.update(other.urls)
+            self.paths.merge(other.paths)
+        else:
+            _merge_into_sketch(self.urls, other.urls)
+            _merge_into_sketch(self.paths, other.paths)
+        return self
+
+    def to_state(self) -> Dict[str, Any]:
+        if self.approx is not None:
+            raise ValueError("Approximate accumulators have no partial state; partials are always exact")
+        self.flush()
+        return {
+            "version": PARTIAL_STATE_VERSION,
+            "length_hist": list(self.length_hist.items()),
+            "weekdays": list(self.weekdays.items()),
+            "intents": list(self.intents.items()),
+            "leaves": list(self.leaves.items()),
+            "reach": list(self.reach.items()),
+            "edges": [[a, b, c] for (a, b), c in self.edges.items()],
+            "urls": list(self.urls.items()),
+            "paths": [[list(p), c] for p, c in self.paths.items()],
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> "MetricsAccumulator":
+        if state.get("version") != PARTIAL_STATE_VERSION:
+            raise ValueError(f"Unsupported partial metrics version: {state.get('version')}")
+        acc = cls()
+        acc.length_hist = Counter({k: c for k, c in state["length_hist"]})
+        for wd, c in state["weekdays"]:
+            acc.weekdays[wd] = c
+        acc.intents = Counter({k: c for k, c in state["intents"]})
+        acc.leaves = Counter({k: c for k, c in state["leaves"]})
+        acc.reach = Counter({k: c for k, c in state["reach"]})
+        acc.edges = Counter({(a, b): c for a, b, c in state["edges"]})
+        acc.urls = Counter({k: c for k, c in state["urls"]})
+        for p, c in state["paths"]:
+            acc.paths.add(p, c)
+        return acc
+
+    # --- finalizers ---
+    @instrumentation.timed("metric.lengths_summary")
+    def lengths_summary(self) -> Dict[str, Any]:
+        return summarize_length_hist(self.length_hist)
+
+    @instrumentation.timed("metric.top_intents")
+    def top_intents(self) -> List[Tuple[int, int]]:
+        return self.intents.most_common()
+
+    @instrumentation.timed("metric.branch_distribution")
+    def branch_distribution(self) -> Dict[int, Counter]:
+        dist: Dict[int, Counter] = defaultdict(Counter)
+        for (a, b), c in self.edges.items():
+            dist[a][b] += c
+        return dist
+
+    @instrumentation.timed("metric.weekday_trends")
+    def weekday_trends(self) -> Dict[Optional[int], int]:
+        return dict(sorted(self.weekdays.items(), key=lambda x: (x[0] is None, x[0])))
+
+    @instrumentation.timed("metric.depth_funnel")
+    def depth_funnel(self) -> Dict[int, int]:
+        return depth_funnel_from_lengths(self.length_hist)
+
+    def node_funnel(self) -> Dict[int, Dict[str, int]]:
+        return node_funnel_from_counts(self.reach, self.branch_distribution())
+
+    @instrumentation.timed("metric.dead_ends")
+    def dead_ends(self, children: Dict[int, List[int]]) -> List[Dict[str, Any]]:
+        return dead_ends_from_counts(self.reach, self.leaves, children)
+
+    @instrumentation.timed("metric.anomalies")
+    def anomalies(self, children: Dict[int, List[int]]) -> Counter:
+        tree_edges = tree_edge_set(children)
+        return Counter({e: c for e, c in self.edges.items() if e not in tree_edges})
+
+    @instrumentation.timed("metric.top_paths")
+    def top_paths(self, top_n: int = 50) -> List[Tuple[Tuple[int, ...], int]]:
+        if self.approx is not None:
+            return self.paths.most_common(top_n)
+        return self.paths.top_paths(top_n)
+
+
+def _merge_into_sketch(sketch: HeavyHitters, other: Any) -> None:
+    # Sketches merge directly; exact Counters / tries (e.g. loaded partials) are replayed as weighted adds
+    if isinstance(other, HeavyHitters):
+        sketch.merge(other)
+    else:
+        sketch.update((tuple(k) if isinstance(k, list) else k, c) for k, c in other.items())
+
+
+def subtract_state(state: Dict[str, Any], other: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Partial state minus the state of calls it already contains (e.g. the last calls added).
+    Keys whose count drops to zero are removed and the rest keep their order, so when `other`
+    holds the most recently added calls the result is the state from before they were added.
+    """
+    if state.get("version") != PARTIAL_STATE_VERSION or other.get("version") != PARTIAL_STATE_VERSION:
+        raise ValueError("Unsupported partial metrics version")
+    out: Dict[str, Any] = {"version": PARTIAL_STATE_VERSION}
+    for field, items in state.items():
+        if field == "version":
+            continue
+        # Every field is a list of [key..., count] rows
+        minus = {json.dumps(list(row[:-1])): row[-1] for row in other.get(field, [])}
+        out[field] = [
+            list(row[:-1]) + [row[-1] - minus.get(json.dumps(list(row[:-1])), 0)]
+            for row in items
+            if row[-1] - minus.get(json.dumps(list(row[:-1])), 0) > 0
+        ]
+    return out
+
+
+class DatePartitions:
+    """
+    Per-day accumulators for one source, written as json/by_date/<source>/<YYYY-MM-DD>.metrics.json
+    plus an index.json (day -> calls). Calls without a parseable date go to the "undated" partition.
+    """
+
+    def __init__(self) -> None:
+        self.days: Dict[str, MetricsAccumulator] = {}
+
+    def get(self, day: Optional[str]) -> MetricsAccumulator:
+        day = day or UNDATED
+        acc = self.days.get(day)
+        if acc is None:
+            acc = self.days[day] = MetricsAccumulator()
+        return acc
+
+    def add(self, day: Optional[str], entry: Dict[str, Any]) -> None:
+        self.get(day).add(entry)
+
+    def add_store(self, store: PathStore, day_of: Any) -> "DatePartitions":
+        node_rids = store.nodes.rule_ids
+        node_urls = store.nodes.urls
+        for rec, step_ids in store.iter_calls():
+            self.get(day_of(rec.call_date)).add_call(
+                len(step_ids),
+                rec.weekday,
+                [node_rids[s] for s in step_ids],
+                [node_urls[s] for s in step_ids],
+            )
+        return self
+
+    def load(self, json_dir: str, source: str, day: Optional[str]) -> MetricsAccumulator:
+        """A day's accumulator, read from its written partition when there is one (for update())."""
+        day = day or UNDATED
+        if day not in self.days:
+            path = os.path.join(json_dir, PARTITIONS_DIR, source, day + PARTIALS_SUFFIX)
+            self.days[day] = MetricsAccumulator.from_state(load_json(path)) if os.path.exists(path) else MetricsAccumulator()
+        return self.days[day]
+
+    def write(self, json_dir: str, source: str) -> str:
+        out_dir = os.path.join(json_dir, PARTITIONS_DIR, source)
+        # Replace the whole source directory so days that disappeared from the CSV do not linger
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+        return self.update(json_dir, source)
+
+    def update(self, json_dir: str, source: str) -> str:
+        """Rewrite only the days held here; other days already written for the source are kept."""
+        out_dir = os.path.join(json_dir, PARTITIONS_DIR, source)
+        index_path = os.path.join(out_dir, PARTITION_INDEX)
+        index: Dict[str, int] = load_json(index_path)["days"] if os.path.exists(index_path) else {}
+        os.makedirs(out_dir, exist_ok=True)
+        for day in sorted(self.days):
+            acc = self.days[day]
+            day_path = os.path.join(out_dir, day + PARTIALS_SUFFIX)
+            if not acc.length_hist:
+                # Emptied (calls taken back out with subtract_state): drop the day
+                if os.path.exists(day_path):
+                    os.remove(day_path)
+                index.pop(day, None)
+                continue
+            with open(day_path, "w", encoding="utf-8") as f:
+                json.dump(acc.to_state(), f, ensure_ascii=False)
+            index[day] = sum(acc.length_hist.values())
+        # Written last: a complete index marks the partitions as up to date
+        with open(index_path, "w", encoding="utf-8") as f:
+            json.dump({"version": PARTIAL_STATE_VERSION, "days": dict(sorted(index.items()))}, f, ensure_ascii=False)
+        return out_dir
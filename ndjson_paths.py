@@ -0,0 +1,222 @@
+"""
+Line-delimited call-path format (an alternative to the indent=2 call_paths JSON).
+
+Every line is a compact JSON array:
+  ["h", "call_paths.ndjson", 1]                         file header (first line)
+  ["s", source]                                         block start; resets the node table
+  ["n", idx, rule_id, text, url]                        node, emitted before its first use in a block
+  ["c", key_id, call_id, call_date, weekday, [idx...]]  one call; steps refer to block node indices
+
+Node text/url is written once per block instead of once per step, and readers decode one
+record at a time. Files ending in .gz / .xz are gzip / xz compressed; blocks may be separate
+compressed members, so aggregates can be built by concatenating per-source blocks.
+"""
+import gzip
+import json
+import lzma
+import os
+import zlib
+from typing import Any, Dict, IO, Iterable, Iterator, List, Optional, Tuple
+
+from path_store import CallRecord, PathStore, Step
+
+FORMAT_NAME = "call_paths.ndjson"
+FORMAT_VERSION = 1
+
+# compression name -> file extension
+COMPRESSIONS = {"none": "", "gzip": ".gz", "lzma": ".xz"}
+
+# Recognized per-run call path file suffixes, longest first
+PATHS_SUFFIXES = (
+    ".call_paths.ndjson.gz",
+    ".call_paths.ndjson.xz",
+    ".call_paths.ndjson",
+    ".call_paths.json",
+)
+
+def paths_suffix(name: str) -> Optional[str]:
+    for suffix in PATHS_SUFFIXES:
+        if name.endswith(suffix):
+            return suffix
+    return None
+
+
+def source_of(name: str) -> str:
+    suffix = paths_suffix(name)
+    return name[: -len(suffix)] if suffix else name
+
+
+def run_paths_files(json_dir: str) -> Dict[str, str]:
+    """
+    Per-run call paths files in json_dir, name -> path in name order, keeping one file per
+    source: the newest, so a file left over from a run in another format is never read twice.
+    """
+    newest: Dict[str, Tuple[int, str]] = {}
+    if os.path.isdir(json_dir):
+        for name in os.listdir(json_dir):
+            if not paths_suffix(name):
+                continue
+            mtime = os.stat(os.path.join(json_dir, name)).st_mtime_ns
+            source = source_of(name)
+            if source not in newest or (mtime, name) > newest[source]:
+                newest[source] = (mtime, name)
+    return {name: os.path.join(json_dir, name) for name in sorted(name for _, name in newest.values())}
+
+
+def remove_other_paths_files(paths_out: str) -> None:
+    """Delete the same source's per-run paths files in any other format or compression."""
+    out_dir = os.path.dirname(paths_out)
+    keep = os.path.basename(paths_out)
+    source = source_of(keep)
+    for suffix in PATHS_SUFFIXES:
+        name = source + suffix
+        if name != keep and os.path.exists(os.path.join(out_dir, name)):
+            os.remove(os.path.join(out_dir, name))
+
+
+def is_ndjson(path: str) -> bool:
+    return ".ndjson" in os.path.basename(path)
+
+
+def compression_of(path: str) -> str:
+    if path.endswith(".gz"):
+        return "gzip"
+    if path.endswith(".xz"):
+        return "lzma"
+    return "none"
+
+
+def open_text(path: str, mode: str) -> IO[str]:
+    compression = compression_of(path)
+    if compression == "gzip":
+        return gzip.open(path, mode + "t", encoding="utf-8", newline="\n")
+    if compression == "lzma":
+        return lzma.open(path, mode + "t", encoding="utf-8", newline="\n")
+    return open(path, mode, encoding="utf-8", newline="\n")
+
+
+def _line(record: List[Any]) -> str:
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+class NdjsonEncoder:
+    """Turns call records into NDJSON lines, interning nodes per block."""
+
+    def __init__(self, nodes: Iterable[Step] = ()) -> None:
+        # Optionally resume a block whose node table already holds `nodes` (in index order)
+        self._index: Dict[Step, int] = {step: i for i, step in enumerate(nodes)}
+
+    def nodes(self) -> List[Step]:
+        """The current block's node table, in index order."""
+        return list(self._index)
+
+    @staticmethod
+    def header() -> str:
+        return _line(["h", FORMAT_NAME, FORMAT_VERSION])
+
+    def block(self, source: str) -> str:
+        self._index = {}
+        return _line(["s", source])
+
+    def call(self, rec: CallRecord, steps: Iterable[Step]) -> str:
+        out: List[str] = []
+        ids: List[int] = []
+        index = self._index
+        for step in steps:
+            idx = index.get(step)
+            if idx is None:
+                idx = index[step] = len(index)
+                out.append(_line(["n", idx, step[0], step[1], step[2]]))
+            ids.append(idx)
+        out.append(_line(["c", rec.key_id, rec.call_id, rec.call_date, rec.weekday, ids]))
+        return "".join(out)
+
+
+def iter_block_lines(calls: Iterable[Tuple[CallRecord, List[Step]]], source: str = "") -> Iterator[str]:
+    """One self-contained block (no header) for the given calls."""
+    enc = NdjsonEncoder()
+    yield enc.block(source)
+    for rec, steps in calls:
+        yield enc.call(rec, steps)
+
+
+def compress_lines(lines: Iterable[str], compression: str, chunk_size: int = 1 << 16) -> Iterator[bytes]:
+    """Encode lines as one complete compressed member (gzip member / xz stream) or raw UTF-8."""
+    if compression == "gzip":
+        comp: Any = zlib.compressobj(6, zlib.DEFLATED, 31)
+    elif compression == "lzma":
+        comp = lzma.LZMACompressor(format=lzma.FORMAT_XZ)
+    else:
+        comp = None
+    pending: List[bytes] = []
+    size = 0
+    for line in lines:
+        data = line.encode("utf-8")
+        pending.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            raw = b"".join(pending)
+            pending, size = [], 0
+            out = comp.compress(raw) if comp else raw
+            if out:
+                yield out
+    raw = b"".join(pending)
+    if comp is None:
+        if raw:
+            yield raw
+        return
+    out = comp.compress(raw) + comp.flush()
+    if out:
+        yield out
+
+
+def write_ndjson_paths(path: str, calls: Iterable[Tuple[CallRecord, List[Step]]], source: str = "") -> int:
+    """Write a single-block NDJSON call path file (compression from the extension). Returns calls written."""
+    enc = NdjsonEncoder()
+    count = 0
+    with open_text(path, "w") as f:
+        f.write(enc.header())
+        f.write(enc.block(source))
+        for rec, steps in calls:
+            f.write(enc.call(rec, steps))
+            count += 1
+    return count
+
+
+def iter_ndjson_calls(path: str) -> Iterator[Tuple[CallRecord, List[Step]]]:
+    """Lazily decode (record, steps) pairs; record.source is the enclosing block's source."""
+    nodes: List[Step] = []
+    source = ""
+    with open_text(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            kind = rec[0]
+            if kind == "c":
+                _, key_id, call_id, call_date, weekday, ids = rec
+                yield CallRecord(source, key_id, call_id, call_date, weekday), [nodes[i] for i in ids]
+            elif kind == "n":
+                _, idx, rule_id, text, url = rec
+                if idx == len(nodes):
+                    nodes.append((rule_id, text, url))
+                else:
+                    nodes[idx] = (rule_id, text, url)
+            elif kind == "s":
+                source = rec[1]
+                nodes = []
+            elif kind == "h":
+                if rec[1] != FORMAT_NAME or rec[2] != FORMAT_VERSION:
+                    raise ValueError(f"Unsupported call path format in {path}: {rec[1:]}")
+
+
+def add_ndjson_calls(store: PathStore, path: str, source: str = "") -> int:
+    """Load an NDJSON call path file into store; `source` (if given) overrides the block source."""
+    intern = store.nodes.intern
+    added = 0
+    for rec, steps in iter_ndjson_calls(path):
+        if source:
+            rec.source = source
+        store.add_call(rec, [intern(rid, text, url) for rid, text, url in steps])
+        added += 1
+    return added
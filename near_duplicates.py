@@ -0,0 +1,208 @@
+"""
+Near-duplicate rule_text detection for analyze_calls (near_duplicates.json).
+
+Texts are normalized for Hebrew (niqqud/cantillation dropped, final letters folded,
+punctuation and whitespace collapsed), cut into character shingles and summarized by a
+MinHash signature. LSH banding buckets signatures so only texts sharing a band are compared;
+each candidate pair is then verified by the exact Jaccard similarity of its shingle sets and
+verified pairs are clustered with union-find. Work is near-linear in the number of nodes.
+
+Nodes whose normalized texts are identical share one signature (a "variant"); pairs and
+similarities are reported between variants. The NumPy path computes the same signatures.
+"""
+import hashlib
+import random
+import unicodedata
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Mapping, Set, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; signatures fall back to pure Python
+    np = None
+
+SHINGLE_SIZE = 3
+BANDS = 16
+ROWS = 4                 # 16 bands x 4 rows: pairs above ~0.5 Jaccard become candidates
+THRESHOLD = 0.7          # minimum verified Jaccard similarity for a near-duplicate pair
+MAX_BUCKET = 64          # larger LSH buckets are linked as a star instead of all pairs
+PRIME = (1 << 31) - 1    # hashes and permutations live mod this prime (fits int64 products)
+SEED = 20200
+
+# Final letters fold to their regular forms (ך->כ, ם->מ, ן->נ, ף->פ, ץ->צ)
+_FINALS = {"ך": "כ", "ם": "מ", "ן": "נ", "ף": "פ", "ץ": "צ"}
+# Quotes inside abbreviations (ד"ר, מע׳) join rather than split words
+_JOINERS = {"'", '"', "`", "׳", "״", "‘", "’", "“", "”"}
+_char_cache: Dict[str, str] = {}
+
+
+def _fold_char(ch: str) -> str:
+    out = _char_cache.get(ch)
+    if out is None:
+        cat = unicodedata.category(ch)
+        if ch in _JOINERS or cat == "Mn":  # niqqud and cantillation marks are Mn
+            out = ""
+        elif cat[0] in "PSZC":  # punctuation (incl. maqaf), symbols, spaces, controls
+            out = " "
+        else:
+            out = _FINALS.get(ch, ch).casefold()
+        _char_cache[ch] = out
+    return out
+
+
+def normalize_text(text: str) -> str:
+    """Hebrew-aware normalization: no marks, no final forms, single spaces, casefolded."""
+    folded = "".join(_fold_char(ch) for ch in unicodedata.normalize("NFKD", text or ""))
+    return " ".join(folded.split())
+
+
+def shingles(norm: str, size: int = SHINGLE_SIZE) -> Set[str]:
+    """Character `size`-grams of the space-padded text (the whole text if shorter)."""
+    padded = f" {norm} "
+    if len(padded) <= size:
+        return {padded}
+    return {padded[i : i + size] for i in range(len(padded) - size + 1)}
+
+
+def _shingle_hash(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little") % PRIME
+
+
+def _permutations(count: int, seed: int = SEED) -> List[Tuple[int, int]]:
+    rng = random.Random(seed)
+    return [(rng.randrange(1, PRIME), rng.randrange(0, PRIME)) for _ in range(count)]
+
+
+def _signatures(hash_sets: List[List[int]], perms: List[Tuple[int, int]], vectorized: bool) -> List[Tuple[int, ...]]:
+    """MinHash signature per shingle-hash list: min over (a*x + b) mod PRIME per permutation."""
+    if vectorized and np is not None and hash_sets:
+        flat = np.fromiter((h for hs in hash_sets for h in hs), dtype=np.int64)
+        starts = np.cumsum([0] + [len(hs) for hs in hash_sets[:-1]], dtype=np.int64)
+        cols = [np.minimum.reduceat((a * flat + b) % PRIME, starts) for a, b in perms]
+        return [tuple(row) for row in np.stack(cols, axis=1).tolist()]
+    # Texts share most shingles: permute each distinct hash once, then take column-wise minima
+    permuted: Dict[int, Tuple[int, ...]] = {}
+    for hs in hash_sets:
+        for x in hs:
+            if x not in permuted:
+                permuted[x] = tuple([(a * x + b) % PRIME for a, b in perms])
+    return [tuple(map(min, *[permuted[x] for x in hs])) if len(hs) > 1 else permuted[hs[0]] for hs in hash_sets]
+
+
+class _UnionFind:
+    def __init__(self, n: int) -> None:
+        self.parent = list(range(n))
+
+    def find(self, i: int) -> int:
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i: int, j: int) -> None:
+        ri, rj = self.find(i), self.find(j)
+        if ri != rj:
+            self.parent[max(ri, rj)] = min(ri, rj)
+
+
+def _candidate_pairs(signatures: List[Tuple[int, ...]], bands: int, rows: int) -> Iterable[Tuple[int, int]]:
+    for band in range(bands):
+        lo = band * rows
+        buckets: Dict[Tuple[int, ...], List[int]] = defaultdict(list)
+        for i, sig in enumerate(signatures):
+            buckets[sig[lo : lo + rows]].append(i)
+        for members in buckets.values():
+            if len(members) < 2:
+                continue
+            if len(members) <= MAX_BUCKET:
+                for x in range(len(members)):
+                    for y in range(x + 1, len(members)):
+                        yield members[x], members[y]
+            else:
+                head = members[0]
+                for other in members[1:]:
+                    yield head, other
+
+
+def find_near_duplicates(
+    texts: Mapping[int, str],
+    threshold: float = THRESHOLD,
+    bands: int = BANDS,
+    rows: int = ROWS,
+    vectorized: bool = False,
+) -> List[Dict[str, Any]]:
+    """
+    Groups of rule_ids with near-duplicate texts, largest first. Each group lists its variants
+    (distinct normalized texts with their rule_ids), the verified variant pairs with their
+    Jaccard similarity (keyed by each variant's smallest rule_id), and the minimum of those.
+    """
+    variant_of: Dict[str, int] = {}
+    variants: List[Dict[str, Any]] = []
+    for rid in sorted(texts):  # variants and their rule_ids in id order; pairs use each variant's smallest id
+        text = texts[rid]
+        norm = normalize_text(text)
+        if not norm:
+            continue
+        idx = variant_of.get(norm)
+        if idx is None:
+            idx = variant_of[norm] = len(variants)
+            variants.append({"normalized": norm, "text": text, "rule_ids": []})
+        variants[idx]["rule_ids"].append(rid)
+
+    hash_of: Dict[str, int] = {}
+    hash_sets: List[List[int]] = []
+    for v in variants:
+        hs = set()
+        for sh in shingles(v["normalized"]):
+            h = hash_of.get(sh)
+            if h is None:
+                h = hash_of[sh] = _shingle_hash(sh)
+            hs.add(h)
+        hash_sets.append(sorted(hs))
+    signatures = _signatures(hash_sets, _permutations(bands * rows), vectorized)
+    shingle_sets = [set(hs) for hs in hash_sets]
+
+    uf = _UnionFind(len(variants))
+    similar: Dict[Tuple[int, int], float] = {}
+    checked: Set[Tuple[int, int]] = set()
+    for i, j in _candidate_pairs(signatures, bands, rows):
+        if (i, j) in checked:
+            continue
+        checked.add((i, j))
+        a, b = shingle_sets[i], shingle_sets[j]
+        sim = len(a & b) / len(a | b)
+        if sim >= threshold:
+            similar[(i, j)] = sim
+            uf.union(i, j)
+
+    members: Dict[int, List[int]] = defaultdict(list)
+    for i in range(len(variants)):
+        members[uf.find(i)].append(i)
+    pairs_of: Dict[int, List[Tuple[int, int, float]]] = defaultdict(list)
+    for (i, j), sim in sorted(similar.items()):
+        pairs_of[uf.find(i)].append((i, j, sim))
+
+    groups: List[Dict[str, Any]] = []
+    for root, idxs in members.items():
+        pairs = pairs_of.get(root, [])
+        if len(idxs) == 1 and len(variants[root]["rule_ids"]) == 1:
+            continue  # a single node with no near duplicate
+        rule_ids = sorted(rid for i in idxs for rid in variants[i]["rule_ids"])
+        groups.append(
+            {
+                "rule_ids": rule_ids,
+                "min_similarity": round(min((s for _, _, s in pairs), default=1.0), 4),
+                "variants": [
+                    {"rule_ids": variants[i]["rule_ids"], "text": variants[i]["text"], "normalized": variants[i]["normalized"]}
+                    for i in idxs
+                ],
+                "pairs": [
+                    {"a": variants[i]["rule_ids"][0], "b": variants[j]["rule_ids"][0], "similarity": round(s, 4)}
+                    for i, j, s in pairs
+                ],
+            }
+        )
+    groups.sort(key=lambda g: (-len(g["rule_ids"]), g["rule_ids"][0]))
+    return groups
+
@@ -0,0 +1,135 @@
+import sys
+from array import array
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+Step = Tuple[int, str, Optional[str]]  # (rule_id, text, url)
+
+
+class NodeTable:
+    """
+    Interned step table. Every distinct (rule_id, text, url) triple is stored once;
+    call paths refer to steps by their index in this table.
+    """
+
+    __slots__ = ("rule_ids", "texts", "urls", "_index")
+
+    def __init__(self) -> None:
+        self.rule_ids = array("q")
+        self.texts: List[str] = []
+        self.urls: List[Optional[str]] = []
+        self._index: Dict[Tuple[int, str, Optional[str]], int] = {}
+
+    def __len__(self) -> int:
+        return len(self.rule_ids)
+
+    def intern(self, rule_id: int, text: str, url: Optional[str]) -> int:
+        key = (rule_id, text, url)
+        idx = self._index.get(key)
+        if idx is None:
+            idx = len(self.rule_ids)
+            self._index[key] = idx
+            self.rule_ids.append(rule_id)
+            self.texts.append(sys.intern(text) if isinstance(text, str) else text)
+            self.urls.append(sys.intern(url) if isinstance(url, str) else url)
+        return idx
+
+    def step(self, idx: int) -> Dict[str, Any]:
+        return {"rule_id": self.rule_ids[idx], "text": self.texts[idx], "url": self.urls[idx]}
+
+
+class CallRecord:
+    """Per-call metadata; `source` is empty for single-run stores."""
+
+    __slots__ = ("source", "key_id", "call_id", "call_date", "weekday")
+
+    def __init__(self, source: str, key_id: str, call_id: Any, call_date: Optional[str], weekday: Optional[int]) -> None:
+        self.source = source
+        self.key_id = key_id
+        self.call_id = call_id
+        self.call_date = sys.intern(call_date) if isinstance(call_date, str) else call_date
+        self.weekday = weekday
+
+    @property
+    def key(self) -> str:
+        return f"{self.source}::{self.key_id}" if self.source else self.key_id
+
+
+class PathStore:
+    """
+    Compact call-path container: step indices for all calls live in one flat array,
+    with CSR-style offsets so call i spans steps[offsets[i]:offsets[i + 1]].
+    """
+
+    def __init__(self) -> None:
+        self.nodes = NodeTable()
+        self.steps = array("i")
+        self.offsets = array("q", [0])
+        self.calls: List[CallRecord] = []
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+    def add_call(self, record: CallRecord, step_ids: Iterable[int]) -> None:
+        self.steps.extend(step_ids)
+        self.offsets.append(len(self.steps))
+        self.calls.append(record)
+
+    def step_ids(self, i: int) -> array:
+        return self.steps[self.offsets[i]:self.offsets[i + 1]]
+
+    def rule_ids(self, i: int) -> List[int]:
+        rids = self.nodes.rule_ids
+        return [rids[s] for s in self.step_ids(i)]
+
+    def path(self, i: int) -> List[Dict[str, Any]]:
+        step = self.nodes.step
+        return [step(s) for s in self.step_ids(i)]
+
+    def iter_calls(self) -> Iterator[Tuple[CallRecord, array]]:
+        steps = self.steps
+        offsets = self.offsets
+        for i, rec in enumerate(self.calls):
+            yield rec, steps[offsets[i]:offsets[i + 1]]
+
+    def run_entry(self, i: int) -> Dict[str, Any]:
+        """Entry in the per-run <csv>.call_paths.json shape."""
+        rec = self.calls[i]
+        return {"call_id": rec.call_id, "call_date": rec.call_date, "weekday": rec.weekday, "path": self.path(i)}
+
+    def iter_run_items(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        for i, rec in enumerate(self.calls):
+            yield rec.key, self.run_entry(i)
+
+
+def path_steps(path: Any) -> List[Step]:
+    """Normalize a list-of-dicts JSON path to (rule_id, text, url) steps. Steps without rule_id are dropped."""
+    if not isinstance(path, list):
+        return []
+    return [
+        (int(step["rule_id"]), step.get("text") or "", step.get("url"))
+        for step in path
+        if isinstance(step, dict) and "rule_id" in step
+    ]
+
+
+def iter_call_path_items(items: Iterable[Tuple[str, Any]], source: str = "") -> Iterator[Tuple[CallRecord, List[Step]]]:
+    """
+    Decode (key, entry) pairs of a call_paths JSON object (per-run or aggregated, legacy
+    list entries included) into records and steps. Per-run files get `source` stamped on each record.
+    """
+    for key, entry in items:
+        key_source = source
+        key_id = key
+        if not source and "::" in key:
+            key_source, key_id = key.split("::", 1)
+        if isinstance(entry, list):
+            yield CallRecord(key_source, key_id, key_id, None, None), path_steps(entry)
+        elif isinstance(entry, dict):
+            rec = CallRecord(
+                entry.get("source", key_source) or key_source,
+                key_id,
+                entry.get("call_id", key_id),
+                entry.get("call_date"),
+                entry.get("weekday"),
+            )
+            yield rec, path_steps(entry.get("path"))
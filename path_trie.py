@@ -0,0 +1,145 @@
+import heapq
+from array import array
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+class PathTrie:
+    """
+    Counted prefix trie over rule_id sequences. Calls sharing a prefix share its nodes, so a
+    path costs one node per step not already seen after the same prefix.
+
+    Node 0 is the root. For every node: `counts` = calls whose path starts with that prefix,
+    `ends` = calls whose path is exactly that prefix. Children are kept in first-seen order and
+    complete paths in the order they first ended, so ranked queries break ties the way
+    Counter.most_common does on the equivalent tuple Counter.
+    """
+
+    __slots__ = ("rule_ids", "parents", "counts", "ends", "first_child", "last_child", "next_sibling", "_index", "_terminals")
+
+    def __init__(self) -> None:
+        self.rule_ids = array("q", [0])
+        self.parents = array("i", [-1])
+        self.counts = array("q", [0])
+        self.ends = array("q", [0])
+        self.first_child = array("i", [-1])
+        self.last_child = array("i", [-1])
+        self.next_sibling = array("i", [-1])
+        self._index: Dict[Tuple[int, int], int] = {}  # (parent node, rule_id) -> node
+        self._terminals = array("i")                  # nodes ending at least one path, first-ended order
+
+    def __len__(self) -> int:
+        """Number of distinct complete paths."""
+        return len(self._terminals)
+
+    @property
+    def node_count(self) -> int:
+        return len(self.rule_ids) - 1
+
+    @property
+    def total(self) -> int:
+        return self.counts[0]
+
+    def _child(self, node: int, rid: int) -> int:
+        key = (node, rid)
+        child = self._index.get(key)
+        if child is None:
+            child = self._index[key] = len(self.rule_ids)
+            self.rule_ids.append(rid)
+            self.parents.append(node)
+            self.counts.append(0)
+            self.ends.append(0)
+            self.first_child.append(-1)
+            self.last_child.append(-1)
+            self.next_sibling.append(-1)
+            last = self.last_child[node]
+            if last < 0:
+                self.first_child[node] = child
+            else:
+                self.next_sibling[last] = child
+            self.last_child[node] = child
+        return child
+
+    def add(self, rids: Sequence[int], count: int = 1) -> None:
+        """Count `count` calls following `rids`. Empty paths are ignored."""
+        if not rids:
+            return
+        counts = self.counts
+        counts[0] += count
+        node = 0
+        for rid in rids:
+            node = self._child(node, rid)
+            counts[node] += count
+        if not self.ends[node]:
+            self._terminals.append(node)
+        self.ends[node] += count
+
+    def merge(self, other: "PathTrie") -> "PathTrie":
+        # Same result (and tie order) as Counter.update on the equivalent tuple Counters
+        for path, c in other.items():
+            self.add(path, c)
+        return self
+
+    def find(self, prefix: Sequence[int]) -> Optional[int]:
+        node = 0
+        for rid in prefix:
+            node = self._index.get((node, rid), -1)
+            if node < 0:
+                return None
+        return node
+
+    def path_of(self, node: int) -> Tuple[int, ...]:
+        out: List[int] = []
+        while node > 0:
+            out.append(self.rule_ids[node])
+            node = self.parents[node]
+        return tuple(reversed(out))
+
+    def children_of(self, node: int) -> Iterator[int]:
+        child = self.first_child[node]
+        while child >= 0:
+            yield child
+            child = self.next_sibling[child]
+
+    def items(self) -> Iterator[Tuple[Tuple[int, ...], int]]:
+        """(path, calls) for every complete path, in first-ended order."""
+        ends = self.ends
+        for node in self._terminals:
+            yield self.path_of(node), ends[node]
+
+    # --- queries ---
+    def top_paths(self, top_n: Optional[int] = 50) -> List[Tuple[Tuple[int, ...], int]]:
+        ends = self.ends
+        terminals = self._terminals
+        if top_n is None:
+            ranked = sorted(terminals, key=ends.__getitem__, reverse=True)
+        else:
+            ranked = heapq.nlargest(top_n, terminals, key=ends.__getitem__)
+        return [(self.path_of(node), ends[node]) for node in ranked]
+
+    def continuations(self, prefix: Sequence[int], top_n: Optional[int] = 10) -> List[Tuple[int, int]]:
+        """Most frequent next rule_ids after `prefix` as (rule_id, calls); [] for an unseen prefix."""
+        node = self.find(prefix)
+        if node is None:
+            return []
+        counts = self.counts
+        kids = list(self.children_of(node))
+        if top_n is None:
+            ranked = sorted(kids, key=counts.__getitem__, reverse=True)
+        else:
+            ranked = heapq.nlargest(top_n, kids, key=counts.__getitem__)
+        return [(self.rule_ids[c], counts[c]) for c in ranked]
+
+    def prefix_stats(self, prefix: Sequence[int]) -> Optional[Dict[str, object]]:
+        """How many calls reached `prefix`, stopped there, or went on."""
+        node = self.find(prefix)
+        if node is None:
+            return None
+        reached = self.counts[node]
+        ended = self.ends[node]
+        return {
+            "prefix": list(prefix),
+            "calls": reached,
+            "ended": ended,
+            "continued": reached - ended,
+            "drop_off_rate": ended / reached if reached else 0.0,
+        }
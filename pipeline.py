@@ -0,0 +1,332 @@
+"""
+In-process pipeline DAG used by run.py: CSV -> per-run JSON -> aggregate -> analytics.
+
+Every stage is keyed by a content hash of its inputs (input file digests, options, and the
+source of the modules that produce its outputs). pipeline_cache.json records each stage's key
+and the size/mtime of the outputs it wrote; a stage whose key matches and whose outputs are
+untouched is skipped. File digests are cached by size+mtime, so a rerun on unchanged data
+costs one stat() per file. Each CSV is its own stage, so a one-file change re-processes only
+that file, then re-aggregates (incrementally) and recomputes analytics.
+
+Within one run, the metrics of freshly processed CSVs and a rebuilt forest are handed to the
+analytics stage in memory; unchanged sources come from their per-run partial files.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+import analytics_shards
+import edge_arrays
+import instrumentation
+from aggregate_runs import MANIFEST_NAME, aggregate_runs
+from analyze_calls import ANALYTICS_FILES, find_call_paths_all, flatten_tree, load_partials, write_analytics
+from generate_button_tree import metrics_out_path, process_many_csvs
+from metric_partials import PARTIALS_SUFFIX, PARTITIONS_DIR, MetricsAccumulator, load_json
+from ndjson_paths import COMPRESSIONS, is_ndjson, run_paths_files, source_of
+from sequence_mining import remove_sequence_analytics
+
+CACHE_NAME = "pipeline_cache.json"
+CACHE_VERSION = 1
+
+# Modules whose source is part of each stage's key (a code change re-runs the stage)
+_SHARED_CODE = ("json_stream.py", "ndjson_paths.py", "path_store.py", "forest.py")
+_METRICS_CODE = ("metric_partials.py", "path_trie.py", "sketches.py", "edge_arrays.py")
+GENERATE_CODE = ("generate_button_tree.py",) + _SHARED_CODE + _METRICS_CODE
+AGGREGATE_CODE = ("aggregate_runs.py",) + _SHARED_CODE
+ANALYZE_CODE = _SHARED_CODE + _METRICS_CODE + (
+    "analyze_calls.py",
+    "tree_index.py",
+    "near_duplicates.py",
+    "analytics_shards.py",
+    "sequence_mining.py",
+    "markov_model.py",
+)
+
+_HASH_CHUNK = 1 << 20
+
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class StageCache:
+    """Stage keys, output stamps and stat-cached file digests, persisted as pipeline_cache.json."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        state: Dict[str, Any] = {}
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if state.get("version") != CACHE_VERSION:
+            state = {}
+        self.old_files: Dict[str, List[Any]] = state.get("files", {})
+        self.old_stages: Dict[str, Dict[str, Any]] = state.get("stages", {})
+        # Only entries touched in this run are saved, so removed CSVs drop out of the cache
+        self.files: Dict[str, List[Any]] = {}
+        self.stages: Dict[str, Dict[str, Any]] = {}
+
+    def _rel(self, path: str) -> str:
+        return os.path.relpath(os.path.abspath(path), self.root)
+
+    def digest(self, path: str) -> str:
+        """Content hash of a file; size+mtime matching the cached entry short-circuits hashing."""
+        rel = self._rel(path)
+        st = os.stat(path)
+        prev = self.files.get(rel) or self.old_files.get(rel)
+        if prev and prev[0] == st.st_size and prev[1] == st.st_mtime_ns:
+            digest = prev[2]
+        else:
+            digest = _file_sha256(path)
+        self.files[rel] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def code_digest(self, modules: Iterable[str]) -> str:
+        return self.key(*[(name, self.digest(os.path.join(self.root, name))) for name in modules])
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _stamp(self, path: str) -> Optional[List[int]]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    def fresh(self, name: str, key: str) -> bool:
+        """True if the stage last ran with this key and all its outputs are unchanged since."""
+        prev = self.old_stages.get(name)
+        if not prev or prev.get("key") != key:
+            return False
+        if any(self._stamp(os.path.join(self.root, rel)) != stamp for rel, stamp in prev["outputs"].items()):
+            return False
+        self.stages[name] = prev
+        return True
+
+    def record(self, name: str, key: str, outputs: Iterable[str]) -> None:
+        stamps = {self._rel(p): self._stamp(p) for p in outputs}
+        self.stages[name] = {"key": key, "outputs": {rel: st for rel, st in stamps.items() if st is not None}}
+
+    def save(self) -> None:
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": CACHE_VERSION, "files": self.files, "stages": self.stages}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+
+class Pipeline:
+    """The generate -> aggregate -> analyze DAG over one project directory."""
+
+    def __init__(
+        self,
+        root: str,
+        data_dir: Optional[str] = None,
+        workers: Optional[int] = None,
+        fmt: str = "json",
+        compression: str = "none",
+        vectorized: bool = False,
+        force: bool = False,
+        shard_size: Optional[int] = None,
+        markov: bool = False,
+    ) -> None:
+        self.root = os.path.abspath(root)
+        self.data_dir = data_dir or os.path.join(self.root, "data")
+        self.json_dir = os.path.join(self.root, "json")
+        self.analytics_dir = os.path.join(self.root, "analytics")
+        self.workers = workers
+        self.fmt = fmt
+        self.compression = compression
+        self.vectorized = vectorized
+        self.force = force
+        self.shard_size = shard_size
+        self.markov = markov
+        self.cache = StageCache(os.path.join(self.root, CACHE_NAME))
+        self.steps: List[Dict[str, Any]] = []
+        # In-memory handoffs between stages of this run
+        self.metrics: Dict[str, MetricsAccumulator] = {}  # source -> metrics of CSVs processed now
+        self.tree: Optional[List[Dict[str, Any]]] = None  # merged forest, if rebuilt now
+        self.aggregate_key = ""
+
+    def _step(self, name: str, wall: float, ran: int, total: int) -> None:
+        self.steps.append({"step": name, "wall_s": wall, "ran": ran, "cached": total - ran, "ok": True})
+        state = "up to date" if ran == 0 else f"ran {ran}/{total}"
+        print(f"  {name:<10} {state:<14} {wall:8.2f}s")
+
+    def run(self) -> List[Dict[str, Any]]:
+        os.makedirs(self.json_dir, exist_ok=True)
+        try:
+            self.generate()
+            self.aggregate()
+            self.analyze()
+        finally:
+            self.cache.save()
+        return self.steps
+
+    def csv_paths(self) -> List[str]:
+        return [os.path.join(self.data_dir, n) for n in sorted(os.listdir(self.data_dir)) if n.lower().endswith(".csv")]
+
+    def _run_outputs(self, summary: Dict[str, Any]) -> List[str]:
+        paths_out = summary["paths_out"]
+        partition_dir = os.path.join(self.json_dir, PARTITIONS_DIR, source_of(os.path.basename(paths_out)))
+        return [summary["tree_out"], paths_out, metrics_out_path(paths_out)] + sorted(
+            glob.glob(os.path.join(partition_dir, "*"))
+        )
+
+    def generate(self) -> None:
+        """One stage per CSV, keyed by the CSV's content hash and the output format."""
+        started = time.perf_counter()
+        with instrumentation.stage("pipeline.generate") as st:
+            code = self.cache.code_digest(GENERATE_CODE)
+            csvs = self.csv_paths()
+            stale = []
+            for path in csvs:
+                name = "generate:" + os.path.basename(path)
+                key = self.cache.key(name, code, self.cache.digest(path), self.fmt, self.compression)
+                if self.force or not self.cache.fresh(name, key):
+                    stale.append((path, name, key))
+            if stale:
+                summaries = process_many_csvs(
+                    [path for path, _, _ in stale],
+                    self.json_dir,
+                    workers=self.workers,
+                    fmt=self.fmt,
+                    compression=self.compression,
+                    keep_metrics=True,
+                )
+                by_csv = {s["input_csv"]: s for s in summaries}
+                st.calls = sum(s["calls"] for s in summaries)
+                for path, name, key in stale:
+                    summary = by_csv.get(path)
+                    if summary is None:
+                        continue  # failed (already reported); not recorded, so retried next run
+                    if "metrics" in summary:
+                        self.metrics[source_of(os.path.basename(summary["paths_out"]))] = summary.pop("metrics")
+                    self.cache.record(name, key, self._run_outputs(summary))
+                    st.read_file(path)
+            st.info.update({"files": len(csvs), "processed": len(stale)})
+        self._step("generate", time.perf_counter() - started, len(stale), len(csvs))
+
+    def _per_run_inputs(self) -> List[str]:
+        # The same per-run files aggregate_runs reads
+        trees = glob.glob(os.path.join(self.json_dir, "*.button_tree.json"))
+        paths = list(run_paths_files(self.json_dir).values())  # one per source, as aggregated
+        return sorted(trees + paths)
+
+    def aggregate(self) -> None:
+        started = time.perf_counter()
+        with instrumentation.stage("pipeline.aggregate") as st:
+            inputs = [(os.path.basename(p), self.cache.digest(p)) for p in self._per_run_inputs()]
+            self.aggregate_key = key = self.cache.key(
+                "aggregate", self.cache.code_digest(AGGREGATE_CODE), inputs, self.fmt, self.compression
+            )
+            ran = self.force or not self.cache.fresh("aggregate", key)
+            if ran:
+                summary = aggregate_runs(
+                    self.json_dir, self.root, incremental=not self.force, fmt=self.fmt, compression=self.compression
+                )
+                self.tree = summary["tree"]
+                st.calls = summary["calls"]
+                self.cache.record(
+                    "aggregate", key, [summary["tree_out"], summary["paths_out"], os.path.join(self.root, MANIFEST_NAME)]
+                )
+            st.info["cached"] = not ran
+        self._step("aggregate", time.perf_counter() - started, int(ran), 1)
+
+    def analyze(self) -> None:
+        """Analytics from the per-source partials; keyed by the aggregate key plus the partials' digests."""
+        started = time.perf_counter()
+        with instrumentation.stage("pipeline.analyze") as st:
+            partials = sorted(glob.glob(os.path.join(self.json_dir, "*" + PARTIALS_SUFFIX)))
+            key = self.cache.key(
+                "analyze",
+                self.cache.code_digest(ANALYZE_CODE),
+                self.aggregate_key,
+                [(os.path.basename(p), self.cache.digest(p)) for p in partials],
+                self.shard_size,
+                self.markov,
+            )
+            ran = self.force or not self.cache.fresh("analyze", key)
+            if ran:
+                tree = self.tree if self.tree is not None else load_json(os.path.join(self.root, "button_tree.all.json"))
+                nodes, _, children = flatten_tree(tree)
+                acc = load_partials(self.json_dir, self.vectorized, preloaded=self.metrics)
+                if acc is None:
+                    print("Partial metrics missing or stale; scanning aggregated call paths")
+                    paths_file = find_call_paths_all(self.root)
+                    acc = MetricsAccumulator(self.vectorized)
+                    acc = acc.add_ndjson(paths_file) if is_ndjson(paths_file) else acc.add_json_stream(paths_file)
+                write_analytics(
+                    acc, nodes, children, self.analytics_dir, self.vectorized, shard_size=self.shard_size, markov=self.markov
+                )
+                written = [os.path.join(self.analytics_dir, name) for name in ANALYTICS_FILES.values()]
+                written.append(os.path.join(self.analytics_dir, analytics_shards.SHARDS_DIR, analytics_shards.INDEX_FILE))
+                self.cache.record("analyze", key, [p for p in written if os.path.exists(p)])
+            # The pipeline never mines sequences; drop ngrams/loops/rework left by analyze_calls.py --sequences,
+            # even when the analyze stage itself is cached
+            remove_sequence_analytics(self.analytics_dir)
+            st.info["cached"] = not ran
+        self._step("analyze", time.perf_counter() - started, int(ran), 1)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run CSV -> per-run JSON -> aggregate -> analytics, skipping up-to-date stages")
+    parser.add_argument("--data-dir", default=None, help="Directory containing CSV files. Default: ./data next to this script")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes for changed CSVs (default: one per CPU core)")
+    parser.add_argument("--format", choices=("json", "ndjson"), default="json", help="Per-run/aggregated call path format")
+    parser.add_argument("--compress", choices=tuple(COMPRESSIONS), default="none", help="Compression for --format ndjson outputs")
+    parser.add_argument(
+        "--backend",
+        choices=["auto", "python", "numpy"],
+        default="auto",
+        help="Edge/entropy computation backend. auto uses NumPy when it is installed (default: auto)",
+    )
+    parser.add_argument("--force", action="store_true", help=f"Ignore {CACHE_NAME} and re-run every stage")
+    parser.add_argument(
+        "--shards",
+        type=int,
+        nargs="?",
+        const=analytics_shards.DEFAULT_SHARD_SIZE,
+        default=None,
+        metavar="N",
+        help="Also write sharded per-node analytics with a byte-offset index (see analyze_calls.py --shards)",
+    )
+    parser.add_argument(
+        "--markov",
+        action="store_true",
+        help="Also write completion.json and markov_model.json (see analyze_calls.py --markov)",
+    )
+    args = parser.parse_args()
+    if args.backend == "numpy" and not edge_arrays.available():
+        parser.error("--backend numpy requires NumPy (pip install numpy)")
+
+    pipeline = Pipeline(
+        os.path.dirname(os.path.abspath(__file__)),
+        data_dir=args.data_dir,
+        workers=args.workers,
+        fmt=args.format,
+        compression=args.compress,
+        vectorized=args.backend == "numpy" or (args.backend == "auto" and edge_arrays.available()),
+        force=args.force,
+        shard_size=args.shards,
+        markov=args.markov,
+    )
+    if not os.path.isdir(pipeline.data_dir):
+        raise SystemExit(f"Data directory not found: {pipeline.data_dir}")
+    pipeline.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,448 @@
+"""
+Local analytics query server.
+
+Loads the aggregated tree and call paths once into indexed in-memory structures and answers
+ad-hoc metric queries over HTTP/JSON, with an LRU cache of rendered responses:
+
+  GET /health                      calls, nodes, cache statistics
+  GET /days                        days with calls (for date pickers)
+  GET /metrics                     available metric names
+  GET /metrics/<name>              any analytics output (same shapes as analytics/*.json)
+  GET /node/<rule_id>              one node: funnel, termination, entropy, next/previous steps
+  GET /prefix?path=1,4,9           continuations and drop-off after a rule_id prefix
+
+Every query accepts the filters start=YYYY-MM-DD, end=YYYY-MM-DD, intent=<rule_id>,
+node=<rule_id> (calls passing through the node) and top=N (overrides the published top-N limits).
+The data files are re-read automatically when they change on disk.
+"""
+import argparse
+import bisect
+import datetime as dt
+import functools
+import json
+import os
+import threading
+from array import array
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import edge_arrays
+from analyze_calls import (
+    ANALYTICS_FILES,
+    MARKOV_METRICS,
+    MetricsAccumulator,
+    compute_analytics,
+    coverage_ratio,
+    entropy_complexity,
+    find_call_paths_all,
+    flatten_tree,
+    load_json,
+    near_duplicates,
+)
+from generate_button_tree import call_day
+from json_stream import iter_json_object
+from ndjson_paths import add_ndjson_calls, is_ndjson
+from path_store import PathStore, iter_call_path_items
+from tree_index import TreeIndex
+
+DEFAULT_PORT = 8765
+DEFAULT_CACHE_SIZE = 256
+# Only the web dashboard (npm run dev) may read responses cross-origin unless --allow-origin says otherwise
+DASHBOARD_ORIGIN = "http://localhost:3000"
+
+# (start, end, intent, node): which calls a query covers
+Filters = Tuple[Optional[str], Optional[str], Optional[int], Optional[int]]
+
+
+class QueryError(ValueError):
+    """Bad request parameters (HTTP 400)."""
+
+
+class NotFound(LookupError):
+    """Unknown route, metric, node or prefix (HTTP 404)."""
+
+
+def _intent_of(rids: List[int]) -> Optional[int]:
+    if not rids:
+        return None
+    return rids[1] if len(rids) > 1 and rids[0] == 1 else rids[0]
+
+
+class CallIndex:
+    """
+    All calls in a PathStore plus inverted indexes (day, intent, node -> ascending call
+    numbers), so a filtered query touches only the matching calls, in original call order.
+    """
+
+    def __init__(self, tree_path: str, paths_file: str) -> None:
+        self.tree_path = tree_path
+        self.paths_file = paths_file
+        self.nodes, self.parent_of, self.children = flatten_tree(load_json(tree_path))
+        self.tree = TreeIndex(self.children)
+        self.store = PathStore()
+        if is_ndjson(paths_file):
+            add_ndjson_calls(self.store, paths_file)
+        else:
+            intern = self.store.nodes.intern
+            with open(paths_file, "r", encoding="utf-8") as f:
+                for rec, steps in iter_call_path_items(iter_json_object(f)):
+                    self.store.add_call(rec, [intern(rid, text, url) for rid, text, url in steps])
+
+        by_day: Dict[str, array] = defaultdict(lambda: array("i"))
+        by_intent: Dict[int, array] = defaultdict(lambda: array("i"))
+        by_node: Dict[int, array] = defaultdict(lambda: array("i"))
+        for i, rec in enumerate(self.store.calls):
+            day = call_day(rec.call_date)
+            if day:
+                by_day[day].append(i)
+            rids = self.store.rule_ids(i)
+            intent = _intent_of(rids)
+            if intent is not None:
+                by_intent[intent].append(i)
+            for rid in set(rids):
+                by_node[rid].append(i)
+        self.days = sorted(by_day)
+        self.by_day = [by_day[d] for d in self.days]
+        self.by_intent = dict(by_intent)
+        self.by_node = dict(by_node)
+        self.stamp = self.file_stamp(tree_path, paths_file)
+
+    @staticmethod
+    def file_stamp(*paths: str) -> Tuple[Tuple[int, int], ...]:
+        out = []
+        for p in paths:
+            st = os.stat(p)
+            out.append((st.st_size, st.st_mtime_ns))
+        return tuple(out)
+
+    def select(self, filters: Filters) -> Optional[List[int]]:
+        """Ascending call numbers matching the filters; None means every call."""
+        start, end, intent, node = filters
+        candidates: List[Any] = []
+        if start or end:
+            lo = bisect.bisect_left(self.days, start) if start else 0
+            hi = bisect.bisect_right(self.days, end) if end else len(self.days)
+            dated = [i for bucket in self.by_day[lo:hi] for i in bucket]
+            dated.sort()
+            candidates.append(dated)
+        if intent is not None:
+            candidates.append(self.by_intent.get(intent, array("i")))
+        if node is not None:
+            candidates.append(self.by_node.get(node, array("i")))
+        if not candidates:
+            return None
+        candidates.sort(key=len)
+        picked = list(candidates[0])
+        for other in candidates[1:]:
+            keep = set(other)
+            picked = [i for i in picked if i in keep]
+        return picked
+
+    def accumulate(self, calls: Optional[List[int]], vectorized: bool = False) -> MetricsAccumulator:
+        acc = MetricsAccumulator(vectorized)
+        store = self.store
+        node_rids = store.nodes.rule_ids
+        node_urls = store.nodes.urls
+        for i in range(len(store)) if calls is None else calls:
+            step_ids = store.step_ids(i)
+            acc.add_call(
+                len(step_ids),
+                store.calls[i].weekday,
+                [node_rids[s] for s in step_ids],
+                [node_urls[s] for s in step_ids],
+            )
+        return acc.flush()
+
+
+class QueryEngine:
+    """Answers queries against a CallIndex; results are cached per (route, parameters)."""
+
+    def __init__(
+        self,
+        tree_path: str,
+        paths_file: str,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+        vectorized: bool = False,
+        markov: bool = False,
+    ) -> None:
+        self.tree_path = tree_path
+        self.paths_file = paths_file
+        self.vectorized = vectorized
+        self.markov = markov
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        self.index = CallIndex(self.tree_path, self.paths_file)
+        # Accumulators are large, so only a few filter sets are kept; rendered responses are small
+        self._accumulator = functools.lru_cache(maxsize=8)(self._build_accumulator)
+        self._analytics = functools.lru_cache(maxsize=32)(self._build_analytics)
+        # Depends only on node texts: computed once per loaded forest, shared by every filter set
+        self._near_duplicates = functools.lru_cache(maxsize=1)(self._build_near_duplicates)
+        self._cached_render = functools.lru_cache(maxsize=self.cache_size)(self._render)
+
+    def maybe_reload(self) -> bool:
+        """Re-index when the tree or paths file changed on disk (drops all cached results)."""
+        try:
+            stamp = CallIndex.file_stamp(self.tree_path, self.paths_file)
+        except OSError:
+            return False
+        if stamp == self.index.stamp:
+            return False
+        with self._lock:
+            if stamp != self.index.stamp:
+                self._load()
+        return True
+
+    def cache_info(self) -> Dict[str, Any]:
+        info = self._cached_render.cache_info()
+        return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "max_size": info.maxsize}
+
+    def _build_accumulator(self, filters: Filters) -> MetricsAccumulator:
+        return self.index.accumulate(self.index.select(filters), self.vectorized)
+
+    def _build_near_duplicates(self) -> List[Dict[str, Any]]:
+        return near_duplicates(self.index.nodes, self.vectorized)
+
+    def _build_analytics(self, filters: Filters, top: Optional[int]) -> Dict[str, Any]:
+        return compute_analytics(
+            self._accumulator(filters),
+            self.index.nodes,
+            self.index.children,
+            self.vectorized,
+            top,
+            self.index.tree,
+            near_dups=self._near_duplicates(),
+            markov=self.markov,
+        )
+
+    def query(self, route: str, arg: Optional[str], filters: Filters, top: Optional[int]) -> bytes:
+        """JSON response body for one request; everything but /health is served from the LRU cache."""
+        if route == "health":
+            return self._render(route, arg, filters, top)
+        return self._cached_render(route, arg, filters, top)
+
+    def _render(self, route: str, arg: Optional[str], filters: Filters, top: Optional[int]) -> bytes:
+        return json.dumps(self._answer(route, arg, filters, top), ensure_ascii=False).encode("utf-8")
+
+    def _answer(self, route: str, arg: Optional[str], filters: Filters, top: Optional[int]) -> Any:
+        index = self.index
+        if route == "health":
+            return {"calls": len(index.store), "nodes": len(index.nodes), "days": len(index.days), "cache": self.cache_info()}
+        if route == "days":
+            return [{"day": d, "calls": len(b)} for d, b in zip(index.days, index.by_day)]
+        if route == "metrics" and arg is None:
+            return sorted(
+                m for m in ANALYTICS_FILES if m != "approx_error_bounds" and (self.markov or m not in MARKOV_METRICS)
+            )
+        if route == "metrics":
+            outputs = self._analytics(filters, top)
+            if arg not in outputs:
+                raise NotFound(f"Unknown metric: {arg}")
+            return outputs[arg]
+        if route == "node":
+            return self._node(_parse_int("rule_id", arg), filters, top or 10)
+        if route == "prefix":
+            return self._prefix(arg or "", filters, top or 10)
+        raise NotFound(f"Unknown route: /{route}")
+
+    def _text(self, rid: int) -> str:
+        return self.index.nodes.get(rid, {}).get("text", "")
+
+    def _node(self, rid: int, filters: Filters, top: int) -> Dict[str, Any]:
+        index = self.index
+        if rid not in index.nodes and rid not in index.by_node:
+            raise NotFound(f"Unknown rule_id: {rid}")
+        acc = self._accumulator(filters)
+        nxt: Counter = Counter()
+        prev: Counter = Counter()
+        for (a, b), c in acc.edges.items():
+            if a == rid:
+                nxt[b] += c
+            if b == rid:
+                prev[a] += c
+        reach = acc.reach.get(rid, 0)
+        transitions = sum(nxt.values())
+        ends = acc.leaves.get(rid, 0)
+        tree_children = set(index.children.get(rid, []))
+        node = index.nodes.get(rid, {})
+        return {
+            "rule_id": rid,
+            "text": node.get("text", ""),
+            "url": node.get("url"),
+            "parent": index.parent_of.get(rid),
+            "children": index.children.get(rid, []),
+            "depth": index.tree.depth_of(rid) if rid in index.tree else None,
+            "subtree_size": index.tree.subtree_size(rid) if rid in index.tree else None,
+            "reach": reach,
+            "transitions": transitions,
+            "drop_off": reach - transitions,
+            "terminations": ends,
+            "termination_rate": ends / reach if reach else 0.0,
+            "entropy": entropy_complexity({rid: nxt}).get(rid) if nxt else None,
+            "coverage": coverage_ratio({rid: nxt}).get(rid) if nxt else None,
+            "next": [
+                {
+                    "child": cid,
+                    "count": c,
+                    "text": self._text(cid),
+                    "tree_edge": cid in tree_children,
+                    "kind": None if cid in tree_children else index.tree.classify(rid, cid),
+                }
+                for cid, c in nxt.most_common(top)
+            ],
+            "previous": [{"parent": pid, "count": c, "text": self._text(pid)} for pid, c in prev.most_common(top)],
+        }
+
+    def _prefix(self, path: str, filters: Filters, top: int) -> Dict[str, Any]:
+        try:
+            prefix = [int(p) for p in path.split(",") if p.strip()]
+        except ValueError:
+            raise QueryError(f"path must be comma-separated rule_ids, got {path!r}")
+        trie = self._accumulator(filters).paths
+        stats = trie.prefix_stats(prefix)
+        if stats is None:
+            raise NotFound(f"No calls follow the prefix {prefix}")
+        stats["continuations"] = [
+            {"rule_id": rid, "count": c, "text": self._text(rid)} for rid, c in trie.continuations(prefix, top)
+        ]
+        return stats
+
+
+def _parse_int(name: str, value: Optional[str]) -> int:
+    try:
+        return int(value)  # type: ignore[arg-type]
+    except (TypeError, ValueError):
+        raise QueryError(f"{name} must be an integer, got {value!r}")
+
+
+def parse_filters(params: Dict[str, List[str]]) -> Tuple[Filters, Optional[int]]:
+    def one(name: str) -> Optional[str]:
+        values = params.get(name)
+        return values[-1] if values else None
+
+    start, end = one("start"), one("end")
+    for name, value in (("start", start), ("end", end)):
+        if value is not None:
+            try:
+                dt.date.fromisoformat(value)
+            except ValueError:
+                raise QueryError(f"{name} must be a YYYY-MM-DD date, got {value!r}")
+    intent = _parse_int("intent", one("intent")) if one("intent") is not None else None
+    node = _parse_int("node", one("node")) if one("node") is not None else None
+    top = _parse_int("top", one("top")) if one("top") is not None else None
+    if top is not None and top <= 0:
+        raise QueryError("top must be positive")
+    return (start, end, intent, node), top
+
+
+def make_handler(engine: QueryEngine, allow_origin: Optional[str]) -> type:
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status: int, body: bytes) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            if allow_origin:
+                self.send_header("Access-Control-Allow-Origin", allow_origin)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _error(self, status: int, message: str) -> None:
+            self._send(status, json.dumps({"error": message}, ensure_ascii=False).encode("utf-8"))
+
+        def do_GET(self) -> None:
+            url = urlparse(self.path)
+            parts = [p for p in url.path.split("/") if p]
+            if not parts:
+                parts = ["health"]
+            if len(parts) > 2:
+                self._error(404, f"Unknown route: {url.path}")
+                return
+            route = parts[0]
+            arg = parts[1] if len(parts) > 1 else None
+            try:
+                params = parse_qs(url.query)
+                filters, top = parse_filters(params)
+                if route == "prefix":
+                    arg = (params.get("path") or [""])[-1]
+                engine.maybe_reload()
+                body = engine.query(route, arg, filters, top)
+            except QueryError as e:
+                self._error(400, str(e))
+                return
+            except NotFound as e:
+                self._error(404, str(e))
+                return
+            except Exception as e:
+                self._error(500, f"{type(e).__name__}: {e}")
+                return
+            self._send(200, body)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            # Quieter than the default stderr access log
+            pass
+
+    return Handler
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve ad-hoc call analytics queries over a local HTTP/JSON API")
+    parser.add_argument("--host", default="127.0.0.1", help="Bind address (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port (default: {DEFAULT_PORT})")
+    parser.add_argument("--tree", default=None, help="Aggregated tree (default: button_tree.all.json next to this script)")
+    parser.add_argument(
+        "--paths",
+        default=None,
+        help="Aggregated call paths (call_paths.all.json or .ndjson[.gz|.xz]). Default: the newest one next to this script",
+    )
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE, help=f"Cached responses (default: {DEFAULT_CACHE_SIZE})")
+    parser.add_argument(
+        "--backend",
+        choices=["auto", "python", "numpy"],
+        default="auto",
+        help="Edge/entropy computation backend. auto uses NumPy when it is installed (default: auto)",
+    )
+    parser.add_argument(
+        "--markov",
+        action="store_true",
+        help="Also serve the absorbing Markov chain outputs (/metrics/completion, /metrics/markov_model)",
+    )
+    parser.add_argument(
+        "--allow-origin",
+        default=DASHBOARD_ORIGIN,
+        help=(
+            f"Access-Control-Allow-Origin header: the origin whose pages may read responses (default: {DASHBOARD_ORIGIN}, "
+            "the web dashboard); empty to omit. '*' lets any site open in the browser read the analytics"
+        ),
+    )
+    args = parser.parse_args()
+    if args.backend == "numpy" and not edge_arrays.available():
+        parser.error("--backend numpy requires NumPy (pip install numpy)")
+    if args.cache_size <= 0:
+        parser.error("--cache-size must be positive")
+    vectorized = args.backend == "numpy" or (args.backend == "auto" and edge_arrays.available())
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    tree_path = args.tree or os.path.join(here, "button_tree.all.json")
+    paths_file = args.paths or find_call_paths_all(here)
+    for p in (tree_path, paths_file):
+        if not os.path.exists(p):
+            raise SystemExit(f"Not found: {p} (run the pipeline first)")
+
+    engine = QueryEngine(tree_path, paths_file, cache_size=args.cache_size, vectorized=vectorized, markov=args.markov)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(engine, args.allow_origin or None))
+    print(f"Loaded {len(engine.index.store)} calls, {len(engine.index.nodes)} nodes from {paths_file}")
+    print(f"Serving analytics queries on http://{args.host}:{args.port}/ (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,12 @@
 """
 Single-entry point for the call center analytics pipeline.
 Processes CSVs from data/ folder, generates analytics, and launches web app.
+Pipeline stages run in process and are skipped when their inputs are unchanged (see pipeline.py).
 """
 
+import argparse
+import datetime as dt
+import json
 import os
 import sys
 import subprocess
@@ -12,11 +16,16 @@ import webbrowser
 import time
 from pathlib import Path
 
+import edge_arrays
+import instrumentation
+from pipeline import CACHE_NAME, Pipeline
+
 # Configuration
 DATA_DIR = "data"
 JSON_DIR = "json"
 ANALYTICS_DIR = "analytics"
 WEB_DIR = "web"
+REPORTS_DIR = "reports"
 PORT = 3000
 BROWSER_DELAY = 5  # seconds to wait before opening browser
 
@@ -49,19 +58,31 @@ def find_csv_files():
         return []
     return csv_files
 
-def run_command(cmd: list, description: str) -> bool:
-    """Run a command and return True if successful."""
-    print(f"Running: {description}...")
-    try:
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-        if result.stdout:
-            print(result.stdout)
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error: {description} failed")
-        print(f"Command: {' '.join(cmd)}")
-        print(f"Error output: {e.stderr}")
-        return False
+def write_run_report(report_dir: str, steps: list) -> str:
+    """Merge the step timings with the per-stage records the scripts wrote into report_dir."""
+    stages = instrumentation.load_records(report_dir)
+    report = {
+        "created": dt.datetime.now().isoformat(timespec="seconds"),
+        "profile": instrumentation.profile_mode() or None,
+        "steps": steps,
+        "stages": stages,
+    }
+    path = os.path.join(report_dir, "run_report.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    # +peak MB: how much the stage raised its process's peak RSS; proc peak MB: that peak so far
+    print(f"{'stage':<28}{'wall s':>10}{'cpu s':>10}{'+peak MB':>10}{'proc peak MB':>14}{'calls/s':>12}")
+    for rec in stages:
+        rss = rec.get("peak_rss_kb")
+        delta = rec.get("peak_rss_delta_kb")
+        rate = rec.get("calls_per_s")
+        print(
+            f"{rec['stage']:<28}{rec['wall_s']:>10.2f}{rec['cpu_s']:>10.2f}"
+            f"{(delta / 1024 if delta else 0):>10.1f}{(rss / 1024 if rss else 0):>14.1f}"
+            f"{(f'{rate:,.0f}' if rate else '-'):>12}"
+        )
+    return path
 
 def check_port_available(port: int) -> bool:
     """Check if a port is available."""
@@ -74,6 +95,31 @@ def check_port_available(port: int) -> bool:
             return False
 
 def main():
+    parser = argparse.ArgumentParser(description="Run the call center analytics pipeline and start the web app")
+    parser.add_argument(
+        "--profile",
+        choices=list(instrumentation.PROFILE_MODES),
+        default=None,
+        help="Also capture cProfile stats and/or tracemalloc allocation peaks for every top-level stage",
+    )
+    parser.add_argument(
+        "--report-dir",
+        default=None,
+        help=f"Where to write stage records and run_report.json (default: {REPORTS_DIR}/run-<timestamp>)",
+    )
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes for changed CSVs (default: one per CPU core)")
+    parser.add_argument("--force", action="store_true", help=f"Ignore {CACHE_NAME} and re-run every pipeline stage")
+    args = parser.parse_args()
+
+    # Stages are recorded when CALLS_REPORT_DIR is set; CSV worker processes inherit it
+    report_dir = os.path.abspath(args.report_dir or os.path.join(REPORTS_DIR, dt.datetime.now().strftime("run-%Y%m%d-%H%M%S")))
+    os.makedirs(report_dir, exist_ok=True)
+    os.environ[instrumentation.REPORT_DIR_ENV] = report_dir
+    if args.profile:
+        os.environ[instrumentation.PROFILE_ENV] = args.profile
+    else:
+        os.environ.pop(instrumentation.PROFILE_ENV, None)
+
     print("\n" + "="*60)
     print("  Call Center Analytics Pipeline")
     print("="*60 + "\n")
@@ -93,32 +139,27 @@ def main():
     for csv_file in csv_files:
         print(f"  - {csv_file.name}")
 
-    # Step 3: Process each CSV
-    print_step("Step 3: Processing CSV files")
-    for i, csv_file in enumerate(csv_files, 1):
-        print(f"\nProcessing {i}/{len(csv_files)}: {csv_file.name}")
-        cmd = [sys.executable, "generate_button_tree.py", str(csv_file)]
-        if not run_command(cmd, f"Processing {csv_file.name}"):
-            print(f"Warning: Failed to process {csv_file.name}")
-            continue
-    print("\n✓ All CSV files processed")
-
-    # Step 4: Aggregate runs
-    print_step("Step 4: Aggregating data")
-    if not run_command([sys.executable, "aggregate_runs.py"], "Aggregating runs"):
-        print("Error: Aggregation failed")
+    # Step 3: CSV -> per-run JSON -> aggregate -> analytics, in process; up-to-date stages are skipped
+    print_step("Step 3: Running pipeline")
+    pipeline = Pipeline(
+        os.path.dirname(os.path.abspath(__file__)),
+        data_dir=os.path.abspath(DATA_DIR),
+        workers=args.workers,
+        vectorized=edge_arrays.available(),
+        force=args.force,
+    )
+    try:
+        steps = pipeline.run()
+    except Exception as e:
+        print(f"Error: pipeline failed: {type(e).__name__}: {e}")
         sys.exit(1)
-    print("✓ Data aggregated")
+    print("\n✓ Analytics up to date")
 
-    # Step 5: Generate analytics
-    print_step("Step 5: Generating analytics")
-    if not run_command([sys.executable, "analyze_calls.py"], "Generating analytics"):
-        print("Error: Analytics generation failed")
-        sys.exit(1)
-    print("✓ Analytics generated")
+    print_step("Run report")
+    print(f"✓ Report written to: {write_run_report(report_dir, steps)}")
 
-    # Step 6: Check port
-    print_step("Step 6: Starting web server")
+    # Step 4: Check port
+    print_step("Step 4: Starting web server")
     if not check_port_available(PORT):
         print(f"Warning: Port {PORT} is already in use.")
         response = input(f"Kill process on port {PORT}? (y/n): ").strip().lower()
@@ -135,7 +176,7 @@ def main():
             print(f"Please free port {PORT} and run again")
             sys.exit(1)
 
-    # Step 7: Start Next.js server
+    # Step 5: Start Next.js server
     print(f"\nStarting Next.js server on port {PORT}...")
     print(f"Server will be available at: http://localhost:{PORT}")
     print(f"Browser will open automatically in {BROWSER_DELAY} seconds...")
@@ -0,0 +1,222 @@
+"""
+Sequence mining over rule_id call paths: frequent contiguous n-grams, within-call loops and
+per-node rework, in one pass with bounded memory.
+
+  n-grams  Each call's n-grams for every configured n are counted with zip/Counter (C speed)
+           into a bounded buffer that is folded into one Space-Saving sketch per n. Memory is
+           capped by the sketch capacity; a reported count over-estimates the true one by at
+           most its max_error (0 while the sketch has never been full).
+  loops    Returning to a rule_id already visited in the same call closes a cycle: the steps
+           from its previous visit up to the return (anchored at the revisited node, so a -> b
+           -> a is [a, b]). Cycles are counted in a Space-Saving sketch, lengths in a histogram.
+  rework   Per node: calls that reached it, calls that revisited it, and total revisits.
+
+Used by `analyze_calls.py --sequences` (fed from the same scan as the other metrics) or on its
+own: python sequence_mining.py [--paths FILE] [--n 2,3,4] [--top 100]
+"""
+import argparse
+import json
+import os
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from json_stream import iter_json_object
+from ndjson_paths import is_ndjson, iter_ndjson_calls
+from path_store import iter_call_path_items
+from sketches import SpaceSaving
+
+DEFAULT_NS = (2, 3, 4)
+DEFAULT_CAPACITY = 1 << 14     # keys monitored per n-gram size (and for cycles)
+DEFAULT_BUFFER = 1 << 17       # distinct buffered keys before folding into the sketches
+DEFAULT_TOP = 100
+
+# Metric name -> file written next to the other analytics
+SEQUENCE_FILES = {
+    "ngrams": "ngrams.json",
+    "loops": "loops.json",
+    "rework": "rework.json",
+}
+
+
+class SequenceMiner:
+    """Single-pass n-gram / loop / rework counters; feed each call's rule_ids to add()."""
+
+    def __init__(self, ns: Sequence[int] = DEFAULT_NS, capacity: int = DEFAULT_CAPACITY, buffer: int = DEFAULT_BUFFER) -> None:
+        if not ns or min(ns) < 1:
+            raise ValueError("n-gram sizes must be positive")
+        self.ns = tuple(sorted(set(ns)))
+        self.buffer = buffer
+        self.ngrams = {n: SpaceSaving(capacity) for n in self.ns}
+        self.cycles = SpaceSaving(capacity)
+        self._pending = {n: Counter() for n in self.ns}
+        self._pending_cycles: Counter = Counter()
+        self.calls = 0
+        self.calls_with_revisit = 0
+        self.cycle_lengths: Counter = Counter()
+        self.reached: Counter = Counter()        # rule_id -> calls that reached it
+        self.rework_calls: Counter = Counter()   # rule_id -> calls that revisited it
+        self.revisits: Counter = Counter()       # rule_id -> returns to it, over all calls
+
+    def add(self, rids: List[int]) -> None:
+        self.calls += 1
+        if not rids:
+            return
+        for n in self.ns:
+            if len(rids) >= n:
+                # zip over shifted slices builds the n-gram tuples without a Python-level loop
+                self._pending[n].update(zip(*(rids[k:] for k in range(n))))
+        distinct = set(rids)
+        self.reached.update(distinct)
+        if len(distinct) < len(rids):
+            self._add_loops(rids)
+        if sum(len(c) for c in self._pending.values()) + len(self._pending_cycles) >= self.buffer:
+            self.flush()
+
+    def _add_loops(self, rids: List[int]) -> None:
+        self.calls_with_revisit += 1
+        last: Dict[int, int] = {}
+        reworked = set()
+        for i, rid in enumerate(rids):
+            j = last.get(rid)
+            if j is not None:
+                self._pending_cycles[tuple(rids[j:i])] += 1
+                self.cycle_lengths[i - j] += 1
+                self.revisits[rid] += 1
+                reworked.add(rid)
+            last[rid] = i
+        self.rework_calls.update(reworked)
+
+    def flush(self) -> "SequenceMiner":
+        """Fold buffered counts into the sketches (weighted adds, in first-seen order)."""
+        for n, pending in self._pending.items():
+            sketch = self.ngrams[n]
+            for key, c in pending.items():
+                sketch.add(key, c)
+            pending.clear()
+        for key, c in self._pending_cycles.items():
+            self.cycles.add(key, c)
+        self._pending_cycles.clear()
+        return self
+
+    def add_ndjson(self, path: str) -> "SequenceMiner":
+        for _, steps in iter_ndjson_calls(path):
+            self.add([s[0] for s in steps])
+        return self.flush()
+
+    def add_json_stream(self, path: str) -> "SequenceMiner":
+        with open(path, "r", encoding="utf-8") as f:
+            for _, steps in iter_call_path_items(iter_json_object(f)):
+                self.add([s[0] for s in steps])
+        return self.flush()
+
+    # --- finalizers ---
+    def top_ngrams(self, top: int = DEFAULT_TOP) -> Dict[str, Any]:
+        self.flush()
+        out: Dict[str, Any] = {}
+        for n, sketch in self.ngrams.items():
+            out[str(n)] = {
+                "distinct_monitored": len(sketch),
+                "max_error": sketch.min_count(),
+                "top": [
+                    {"ngram": list(key), "count": c, "max_error": sketch.errors[key]}
+                    for key, c in sketch.most_common(top)
+                ],
+            }
+        return out
+
+    def loops(self, top: int = DEFAULT_TOP) -> Dict[str, Any]:
+        self.flush()
+        return {
+            "calls": self.calls,
+            "calls_with_revisit": self.calls_with_revisit,
+            "revisit_rate": self.calls_with_revisit / self.calls if self.calls else 0.0,
+            "revisits": sum(self.cycle_lengths.values()),
+            "self_loops": self.cycle_lengths.get(1, 0),
+            "cycle_length_hist": dict(sorted(self.cycle_lengths.items())),
+            "max_error": self.cycles.min_count(),
+            "top_cycles": [
+                {"cycle": list(key), "count": c, "max_error": self.cycles.errors[key]}
+                for key, c in self.cycles.most_common(top)
+            ],
+        }
+
+    def rework(self, nodes: Optional[Dict[int, Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+        """Nodes revisited within at least one call, most reworked calls first."""
+        nodes = nodes or {}
+        rows = [
+            {
+                "rule_id": rid,
+                "text": nodes.get(rid, {}).get("text", ""),
+                "calls": self.reached[rid],
+                "rework_calls": c,
+                "rework_rate": c / self.reached[rid],
+                "revisits": self.revisits[rid],
+            }
+            for rid, c in self.rework_calls.items()
+        ]
+        rows.sort(key=lambda r: (-r["rework_calls"], -r["rework_rate"], r["rule_id"]))
+        return rows
+
+    def outputs(self, nodes: Optional[Dict[int, Dict[str, Any]]] = None, top: int = DEFAULT_TOP) -> Dict[str, Any]:
+        """Every SEQUENCE_FILES output keyed by metric name."""
+        return {"ngrams": self.top_ngrams(top), "loops": self.loops(top), "rework": self.rework(nodes)}
+
+
+def mine_call_paths(paths_file: str, ns: Sequence[int] = DEFAULT_NS, capacity: int = DEFAULT_CAPACITY) -> SequenceMiner:
+    """One streaming pass over an aggregated call paths file (JSON or NDJSON)."""
+    miner = SequenceMiner(ns, capacity)
+    return miner.add_ndjson(paths_file) if is_ndjson(paths_file) else miner.add_json_stream(paths_file)
+
+
+def write_sequence_analytics(outputs: Dict[str, Any], analytics_dir: str) -> List[str]:
+    os.makedirs(analytics_dir, exist_ok=True)
+    written = []
+    for metric, filename in SEQUENCE_FILES.items():
+        path = os.path.join(analytics_dir, filename)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(outputs[metric], f, ensure_ascii=False, indent=2)
+        written.append(path)
+    return written
+
+
+def remove_sequence_analytics(analytics_dir: str) -> None:
+    for filename in SEQUENCE_FILES.values():
+        path = os.path.join(analytics_dir, filename)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def parse_ns(value: str) -> Tuple[int, ...]:
+    try:
+        ns = tuple(int(v) for v in value.split(",") if v.strip())
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected comma-separated integers, got {value!r}")
+    if not ns or min(ns) < 1:
+        raise argparse.ArgumentTypeError("n-gram sizes must be positive")
+    return ns
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Mine frequent sub-paths, loops and rework from the aggregated call paths")
+    parser.add_argument("--paths", default=None, help="Aggregated call paths (default: the newest call_paths.all.* next to this script)")
+    parser.add_argument("--n", type=parse_ns, default=DEFAULT_NS, help="Comma-separated n-gram sizes (default: 2,3,4)")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP, help=f"N-grams and cycles reported per size (default: {DEFAULT_TOP})")
+    parser.add_argument("--capacity", type=int, default=DEFAULT_CAPACITY, help=f"Keys monitored per sketch (default: {DEFAULT_CAPACITY})")
+    parser.add_argument("--out", default=None, help="Output directory (default: analytics/ next to this script)")
+    args = parser.parse_args()
+    if args.capacity <= 0 or args.top <= 0:
+        parser.error("--capacity and --top must be positive")
+
+    from analyze_calls import find_call_paths_all, flatten_tree, load_json  # analyze_calls imports this module
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    miner = mine_call_paths(args.paths or find_call_paths_all(here), args.n, args.capacity)
+    tree_path = os.path.join(here, "button_tree.all.json")
+    nodes = flatten_tree(load_json(tree_path))[0] if os.path.exists(tree_path) else {}
+    out_dir = args.out or os.path.join(here, "analytics")
+    write_sequence_analytics(miner.outputs(nodes, args.top), out_dir)
+    print(f"Mined {miner.calls} calls ({miner.calls_with_revisit} with loops); wrote {', '.join(SEQUENCE_FILES.values())} to: {out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+Fixed-memory frequency sketches for the long-tail counters in analyze_calls
+(full paths and URLs), used by `analyze_calls.py --approx`.
+
+SpaceSaving monitors at most `capacity` keys. Every reported count over-estimates the true
+count by no more than that key's recorded error, and every error is at most total/capacity.
+CountMin adds a hashed point estimate (over-estimate <= e/width * total with probability
+1 - exp(-depth)); HeavyHitters reports the smaller of the two estimates.
+Both sketches merge, so per-source sketches can be reduced like the exact partials.
+"""
+import hashlib
+import heapq
+import itertools
+import math
+from array import array
+from typing import Any, Dict, Hashable, Iterable, List, Optional, Tuple
+
+DEFAULT_CAPACITY = 4096
+DEFAULT_CM_WIDTH = 2048
+DEFAULT_CM_DEPTH = 4
+
+
+class SpaceSaving:
+    """Space-Saving top-k counter (Metwally et al.) with weighted updates and merge."""
+
+    __slots__ = ("capacity", "counts", "errors", "total", "_heap", "_seq")
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY) -> None:
+        if capacity <= 0:
+            raise ValueError("SpaceSaving capacity must be positive")
+        self.capacity = capacity
+        self.counts: Dict[Hashable, int] = {}
+        self.errors: Dict[Hashable, int] = {}
+        self.total = 0
+        # One (count, seq, key) entry per monitored key; counts in it may lag behind self.counts
+        self._heap: List[Tuple[int, int, Hashable]] = []
+        self._seq = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def add(self, key: Hashable, count: int = 1) -> None:
+        self.total += count
+        counts = self.counts
+        current = counts.get(key)
+        if current is not None:
+            counts[key] = current + count
+            return
+        if len(counts) < self.capacity:
+            counts[key] = count
+            self.errors[key] = 0
+            heapq.heappush(self._heap, (count, next(self._seq), key))
+            return
+        # Evict the minimum: refresh stale heap entries until the top is current
+        heap = self._heap
+        while True:
+            low, _, victim = heap[0]
+            current = counts[victim]
+            if current == low:
+                break
+            heapq.heapreplace(heap, (current, next(self._seq), victim))
+        heapq.heapreplace(heap, (low + count, next(self._seq), key))
+        del counts[victim]
+        del self.errors[victim]
+        counts[key] = low + count
+        self.errors[key] = low
+
+    def min_count(self) -> int:
+        """Count any unmonitored key may have (0 until the sketch is full)."""
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.values())
+
+    def merge(self, other: "SpaceSaving") -> "SpaceSaving":
+        # Unmonitored keys may have up to the other sketch's minimum (Cafaro et al. merge)
+        m1 = self.min_count()
+        m2 = other.min_count()
+        merged: Dict[Hashable, Tuple[int, int]] = {}
+        for key in itertools.chain(self.counts, other.counts):
+            if key in merged:
+                continue
+            merged[key] = (
+                self.counts.get(key, m1) + other.counts.get(key, m2),
+                self.errors.get(key, m1) + other.errors.get(key, m2),
+            )
+        keep = heapq.nlargest(self.capacity, merged.items(), key=lambda kv: kv[1][0])
+        self.counts = {key: c for key, (c, _) in keep}
+        self.errors = {key: e for key, (_, e) in keep}
+        self.total += other.total
+        self._heap = [(c, next(self._seq), key) for key, c in self.counts.items()]
+        heapq.heapify(self._heap)
+        return self
+
+    def most_common(self, n: Optional[int] = None) -> List[Tuple[Hashable, int]]:
+        if n is None:
+            return sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)
+        return heapq.nlargest(n, self.counts.items(), key=lambda kv: kv[1])
+
+
+def _key_bytes(key: Hashable) -> bytes:
+    # repr is stable across processes (unlike hash() of str), so sketches from workers merge
+    return key.encode("utf-8") if isinstance(key, str) else repr(key).encode("utf-8")
+
+
+class CountMin:
+    """Count-Min sketch (Cormode & Muthukrishnan) with double hashing over a 128-bit digest."""
+
+    __slots__ = ("width", "depth", "rows", "total")
+
+    def __init__(self, width: int = DEFAULT_CM_WIDTH, depth: int = DEFAULT_CM_DEPTH) -> None:
+        if width <= 0 or depth <= 0:
+            raise ValueError("CountMin width and depth must be positive")
+        self.width = width
+        self.depth = depth
+        self.rows = [array("q", bytes(8 * width)) for _ in range(depth)]
+        self.total = 0
+
+    def _cells(self, key: Hashable) -> Iterable[int]:
+        digest = hashlib.blake2b(_key_bytes(key), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        width = self.width
+        return [(h1 + i * h2) % width for i in range(self.depth)]
+
+    def add(self, key: Hashable, count: int = 1) -> None:
+        self.total += count
+        for row, cell in zip(self.rows, self._cells(key)):
+            row[cell] += count
+
+    def estimate(self, key: Hashable) -> int:
+        return min(row[cell] for row, cell in zip(self.rows, self._cells(key)))
+
+    def merge(self, other: "CountMin") -> "CountMin":
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError("Cannot merge CountMin sketches of different shapes")
+        for row, other_row in zip(self.rows, other.rows):
+            for i, v in enumerate(other_row):
+                if v:
+                    row[i] += v
+        self.total += other.total
+        return self
+
+    @property
+    def epsilon(self) -> float:
+        return math.e / self.width
+
+    @property
+    def delta(self) -> float:
+        return math.exp(-self.depth)
+
+
+class HeavyHitters:
+    """
+    Top-k counts for an unbounded key space in fixed memory. Offers the Counter calls
+    analyze_calls needs (add/update/most_common/items) plus per-key error bounds.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, cm_width: int = DEFAULT_CM_WIDTH, cm_depth: int = DEFAULT_CM_DEPTH) -> None:
+        self.ss = SpaceSaving(capacity)
+        self.cm = CountMin(cm_width, cm_depth)
+
+    def __len__(self) -> int:
+        return len(self.ss)
+
+    @property
+    def total(self) -> int:
+        return self.ss.total
+
+    def add(self, key: Hashable, count: int = 1) -> None:
+        self.ss.add(key, count)
+        self.cm.add(key, count)
+
+    def update(self, items: Iterable[Tuple[Hashable, int]]) -> None:
+        for key, count in items:
+            self.add(key, count)
+
+    def merge(self, other: "HeavyHitters") -> "HeavyHitters":
+        self.ss.merge(other.ss)
+        self.cm.merge(other.cm)
+        return self
+
+    def estimate(self, key: Hashable) -> int:
+        cm = self.cm.estimate(key)
+        ss = self.ss.counts.get(key)
+        return cm if ss is None else min(ss, cm)
+
+    def bounds(self, key: Hashable) -> Tuple[int, int]:
+        """(lower, upper) bounds on the true count of a monitored key; (0, estimate) otherwise."""
+        upper = self.estimate(key)
+        if key not in self.ss.counts:
+            return 0, upper
+        return max(self.ss.counts[key] - self.ss.errors[key], 0), upper
+
+    def items(self) -> Iterable[Tuple[Hashable, int]]:
+        return ((key, self.estimate(key)) for key in self.ss.counts)
+
+    def most_common(self, n: Optional[int] = None) -> List[Tuple[Hashable, int]]:
+        ranked = sorted(self.items(), key=lambda kv: kv[1], reverse=True)
+        return ranked if n is None else ranked[:n]
+
+    def error_report(self, top: List[Tuple[Hashable, int]]) -> Dict[str, Any]:
+        """Sketch parameters, global error bounds, and bounds for each published key."""
+        total = self.total
+        return {
+            "total": total,
+            "space_saving_capacity": self.ss.capacity,
+            "monitored": len(self.ss),
+            "max_overestimate": self.ss.min_count(),
+            "max_overestimate_bound": total / self.ss.capacity,
+            "count_min_width": self.cm.width,
+            "count_min_depth": self.cm.depth,
+            "count_min_epsilon": self.cm.epsilon,
+            "count_min_delta": self.cm.delta,
+            "count_min_overestimate_bound": self.cm.epsilon * total,
+            "items": [
+                {"key": list(key) if isinstance(key, tuple) else key, "count": count, "min_count": self.bounds(key)[0]}
+                for key, count in top
+            ],
+        }
@@ -0,0 +1,174 @@
+"""
+Structural index over the aggregated forest (the `children` map from analyze_calls.flatten_tree).
+
+Built once per tree in linear time (plus an O(n log n) sparse table for LCA):
+  - preorder (Euler-tour) intervals: b is in a's subtree  <=>  tin[a] <= tin[b] <= tout[a]
+  - depth per node (roots are depth 0)
+  - LCA in O(1) by range-minimum over the Euler tour
+  - subtree rollups of any per-node count in one reverse-preorder pass
+
+The forest hangs off a virtual root 0 (the parent id flatten_tree gives top-level nodes).
+A node listed under several parents is placed under the first one the DFS reaches.
+"""
+from array import array
+from typing import Dict, Iterable, List, Mapping, Tuple
+
+VIRTUAL_ROOT = 0
+
+# Kinds of off-tree transitions (from -> to)
+SKIP_AHEAD = "skip_ahead"        # to a deeper node in from's subtree (skipping steps)
+BACK_JUMP = "back_jump"          # to an ancestor of from (going back up the protocol)
+CROSS_BRANCH = "cross_branch"    # to a node in another branch (neither ancestor nor descendant)
+REPEAT = "repeat"                # from == to
+UNKNOWN_NODE = "unknown_node"    # an endpoint is not in the tree
+ANOMALY_KINDS = (SKIP_AHEAD, BACK_JUMP, CROSS_BRANCH, REPEAT, UNKNOWN_NODE)
+
+
+class TreeIndex:
+    """Euler-tour intervals, depths and an LCA table for a rule_id forest."""
+
+    def __init__(self, children: Mapping[int, Iterable[int]]) -> None:
+        self.rule_ids: List[int] = []        # dense index -> rule_id (preorder; 0 is the virtual root)
+        self.pos: Dict[int, int] = {}        # rule_id -> dense index
+        self.parent = array("l")             # dense parent index (-1 for the virtual root)
+        self.depth = array("l")              # virtual root is -1, real roots 0
+        self.tout = array("l")               # last preorder index in each subtree
+        euler = array("l")                   # dense ids along the Euler tour
+        self._first = array("l")             # first Euler position of each dense id
+
+        # Iterative DFS: (dense id, iterator over its children)
+        self._visit(VIRTUAL_ROOT, -1, -1, euler)
+        stack: List[Tuple[int, Iterable[int]]] = [(0, iter(children.get(VIRTUAL_ROOT, ())))]
+        while stack:
+            node, kids = stack[-1]
+            for rid in kids:
+                if rid in self.pos:
+                    continue
+                child = self._visit(rid, node, self.depth[node] + 1, euler)
+                stack.append((child, iter(children.get(rid, ()))))
+                break
+            else:
+                stack.pop()
+                self.tout[node] = len(self.rule_ids) - 1
+                if stack:
+                    euler.append(stack[-1][0])
+        self._build_sparse(euler)
+
+    def _visit(self, rid: int, parent: int, depth: int, euler: array) -> int:
+        idx = len(self.rule_ids)
+        self.rule_ids.append(rid)
+        self.pos[rid] = idx
+        self.parent.append(parent)
+        self.depth.append(depth)
+        self.tout.append(idx)
+        self._first.append(len(euler))
+        euler.append(idx)
+        return idx
+
+    def _build_sparse(self, euler: array) -> None:
+        # Preorder ids increase with DFS order, so the minimum dense id on an Euler range is
+        # the shallowest node on it (the LCA); levels[k][i] = min(euler[i : i + 2**k])
+        self._levels: List[array] = [euler]
+        span = 1
+        while 2 * span <= len(euler):
+            prev = self._levels[-1]
+            self._levels.append(array("l", map(min, prev[: len(prev) - span], prev[span:])))
+            span *= 2
+
+    def __len__(self) -> int:
+        return len(self.rule_ids) - 1
+
+    def __contains__(self, rid: int) -> bool:
+        return rid != VIRTUAL_ROOT and rid in self.pos
+
+    def depth_of(self, rid: int) -> int:
+        return self.depth[self.pos[rid]]
+
+    def interval(self, rid: int) -> Tuple[int, int]:
+        i = self.pos[rid]
+        return i, self.tout[i]
+
+    def subtree_size(self, rid: int) -> int:
+        i = self.pos[rid]
+        return self.tout[i] - i + 1
+
+    def is_ancestor(self, a: int, b: int) -> bool:
+        """True if a is b or an ancestor of b."""
+        i, j = self.pos[a], self.pos[b]
+        return i <= j <= self.tout[i]
+
+    def lca(self, a: int, b: int) -> int:
+        """Lowest common ancestor; 0 (the virtual root) for nodes in different trees."""
+        lo, hi = sorted((self._first[self.pos[a]], self._first[self.pos[b]]))
+        k = (hi - lo + 1).bit_length() - 1
+        level = self._levels[k]
+        return self.rule_ids[min(level[lo], level[hi - (1 << k) + 1])]
+
+    def distance(self, a: int, b: int) -> int:
+        """Number of tree edges between a and b (through the virtual root across trees)."""
+        return self.depth_of(a) + self.depth_of(b) - 2 * self.depth[self.pos[self.lca(a, b)]]
+
+    def classify(self, a: int, b: int) -> str:
+        """Kind of an off-tree transition a -> b (O(1) interval checks)."""
+        if a not in self or b not in self:
+            return UNKNOWN_NODE
+        if a == b:
+            return REPEAT
+        if self.is_ancestor(a, b):
+            return SKIP_AHEAD
+        if self.is_ancestor(b, a):
+            return BACK_JUMP
+        return CROSS_BRANCH
+
+    def rollup(self, values: Mapping[int, int]) -> Dict[int, int]:
+        """Subtree totals of a per-node count, for every tree node (one reverse-preorder pass)."""
+        n = len(self.rule_ids)
+        totals = [0] * n
+        for rid, v in values.items():
+            i = self.pos.get(rid)
+            if i is not None:
+                totals[i] += v
+        parent = self.parent
+        for i in range(n - 1, 0, -1):
+            totals[parent[i]] += totals[i]
+        return {self.rule_ids[i]: totals[i] for i in range(1, n)}
+
+
+def subtree_rollups(
+    index: TreeIndex,
+    nodes: Mapping[int, Mapping[str, object]],
+    reach: Mapping[int, int],
+    terminations: Mapping[int, int],
+) -> Dict[int, Dict[str, int]]:
+    """
+    Per-node and per-subtree reach, terminations (calls ending at the node) and URL hits
+    (steps through nodes that carry a popUpURL), keyed by rule_id in preorder.
+    """
+    url_hits = {rid: c for rid, c in reach.items() if nodes.get(rid, {}).get("url")}
+    sub_reach = index.rollup(reach)
+    sub_term = index.rollup(terminations)
+    sub_urls = index.rollup(url_hits)
+    out: Dict[int, Dict[str, int]] = {}
+    for rid in index.rule_ids[1:]:
+        out[rid] = {
+            "depth": index.depth_of(rid),
+            "subtree_size": index.subtree_size(rid),
+            "reach": reach.get(rid, 0),
+            "subtree_reach": sub_reach[rid],
+            "terminations": terminations.get(rid, 0),
+            "subtree_terminations": sub_term[rid],
+            "url_hits": url_hits.get(rid, 0),
+            "subtree_url_hits": sub_urls[rid],
+        }
+    return out
+
+
+def classify_edges(index: TreeIndex, edges: Iterable[Tuple[Tuple[int, int], int]]) -> Dict[str, Dict[str, int]]:
+    """Edge and transition counts per anomaly kind, for (edge, count) pairs."""
+    totals = {kind: {"edges": 0, "count": 0} for kind in ANOMALY_KINDS}
+    for (a, b), c in edges:
+        t = totals[index.classify(a, b)]
+        t["edges"] += 1
+        t["count"] += c
+    return totals
+